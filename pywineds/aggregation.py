@@ -0,0 +1,328 @@
+"""
+Supports computing the totals that appear in the results files.
+
+The totals for every contest, area, and reporting type are computed
+once per run and stored in an ElectionAggregates object.  The results
+writers then only need to format rows from that object.
+
+"""
+
+from array import array
+from collections import namedtuple
+import logging
+from operator import add
+
+from pywineds.utils import time_it
+
+
+# The names of the area types whose areas are not districts.  These
+# names are also used in the area labels of the results files.
+AREA_TYPE_CITY = "City"
+AREA_TYPE_NEIGHBORHOOD = "Neighborhood"
+AREA_TYPE_PRECINCT = "Precinct"
+
+# The ID of the single area of type AREA_TYPE_CITY.
+CITY_AREA_ID = 0
+
+_log = logging.getLogger("wineds")
+
+
+class AreaTotals(namedtuple('AreaTotals', ['precinct_count', 'registered', 'voted',
+                                           'choice_totals'])):
+
+    """
+    The totals for a contest in an area for one or more reporting types.
+
+    Attributes:
+
+      precinct_count: the number of precincts in the area participating
+        in the contest.
+      registered: the registration count of those precincts.
+      voted: the ballots cast count of those precincts.
+      choice_totals: a tuple of the vote totals, one per choice in the
+        order of the contest's sorted choice IDs.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def turnout(self):
+        """
+        Return the turnout as a fraction, or None if there are no
+        registered voters.
+
+        """
+        if self.registered == 0:
+            return None
+        return self.voted / self.registered
+
+
+class AreaMembership:
+
+    """
+    An area x precinct membership matrix.
+
+    The matrix is sparse (each precinct belongs to only one area of each
+    area type), so it is stored in compressed sparse column form: the
+    precincts are indexed densely in sorted order, and the area rows of
+    the precinct with index i are--
+
+      row_indices[column_starts[i]:column_starts[i + 1]]
+
+    Attributes:
+
+      area_keys: a list of the area keys (see ContestAggregates), one per
+        row of the matrix.
+      precinct_ids: a sorted list of the precinct IDs, one per column.
+
+    """
+
+    def __init__(self, area_types):
+        """
+        Arguments:
+          area_types: an iterable of 2-tuples of: area_type_name, area_type,
+            where area_type is a dict mapping area ID to a set of precinct IDs.
+
+        """
+        area_keys = []
+        precincts_rows = {}
+        for area_type_name, area_type in area_types:
+            for area_id in sorted(area_type.keys()):
+                row = len(area_keys)
+                area_keys.append((area_type_name, area_id))
+                for precinct_id in area_type[area_id]:
+                    precincts_rows.setdefault(precinct_id, []).append(row)
+
+        precinct_ids = sorted(precincts_rows.keys())
+        column_starts = array('l', [0])
+        row_indices = array('l')
+        for precinct_id in precinct_ids:
+            row_indices.extend(precincts_rows[precinct_id])
+            column_starts.append(len(row_indices))
+
+        self.area_keys = area_keys
+        self.column_starts = column_starts
+        self.precinct_ids = precinct_ids
+        self.precinct_index = {precinct_id: i for i, precinct_id in enumerate(precinct_ids)}
+        self.row_indices = row_indices
+
+    def get_area_rows(self, precinct_id):
+        """
+        Return the rows of the areas containing a precinct.
+
+        """
+        try:
+            i = self.precinct_index[precinct_id]
+        except KeyError:
+            return ()
+        return self.row_indices[self.column_starts[i]:self.column_starts[i + 1]]
+
+    def multiply(self, precinct_vectors):
+        """
+        Multiply the matrix by a precinct x values matrix, and return a
+        dict mapping area row to a list of the summed values.
+
+        Rows whose areas contain none of the given precincts are omitted.
+
+        Arguments:
+          precinct_vectors: an iterable of 2-tuples of: precinct_id,
+            vector, where the vectors are lists of the same length.  The
+            omitted precincts are treated as having zero vectors.
+
+        """
+        sums = {}
+        for precinct_id, vector in precinct_vectors:
+            for row in self.get_area_rows(precinct_id):
+                try:
+                    row_sum = sums[row]
+                except KeyError:
+                    sums[row] = vector
+                    continue
+                sums[row] = list(map(add, row_sum, vector))
+        return sums
+
+
+class ContestAggregates:
+
+    """
+    Encapsulates the totals for a single contest.
+
+    Attributes:
+
+      areas: a dict mapping an area key to a dict that maps a reporting
+        key to an AreaTotals object.  An area key is a 2-tuple of
+        (area_type_name, area_id), for example ("Congressional", 12) or
+        (AREA_TYPE_PRECINCT, 1101).  A reporting key is a tuple of
+        reporting indices whose totals are combined.  Only areas with at
+        least one precinct participating in the contest are included.
+      choice_ids: a sorted list of the choice IDs of the contest.
+
+    """
+
+    def __init__(self, choice_ids):
+        self.areas = {}
+        self.choice_ids = choice_ids
+
+    def __contains__(self, area_key):
+        return area_key in self.areas
+
+    def get_totals(self, area_type_name, area_id, reporting_indices):
+        """
+        Return the AreaTotals object for an area and reporting key.
+
+        """
+        return self.areas[(area_type_name, area_id)][tuple(reporting_indices)]
+
+
+class ElectionAggregates:
+
+    """
+    Encapsulates the totals for all contests.
+
+    Attributes:
+
+      contests: a dict mapping contest_id to a ContestAggregates object.
+      reporting_keys: a tuple of the reporting keys for which totals are
+        computed: one for each reporting index, and one for all of the
+        reporting indices combined.
+
+    """
+
+    def __init__(self, reporting_indices):
+        reporting_indices = tuple(reporting_indices)
+        reporting_keys = [(r_index, ) for r_index in reporting_indices]
+        if len(reporting_indices) > 1:
+            reporting_keys.append(reporting_indices)
+
+        self.contests = {}
+        self.reporting_keys = tuple(reporting_keys)
+
+
+def make_precinct_vector(contest_results, registered, precinct_voted, precinct_id):
+    """
+    Return a list of the values needed for the totals of a precinct
+    participating in a contest.
+
+    The vector has the form--
+
+      [1, registration, ballots cast for reporting type #1, ...,
+       choice totals for reporting type #1, ...]
+
+    where the reporting types are in the order of the contest's
+    reporting_indices and the choice totals for each reporting type
+    are in the order of the contest's choice IDs.  Since every value
+    is a count, the vector of an area is the sum of the vectors of
+    its precincts.
+
+    """
+    vector = [1, registered[precinct_id]]
+    # The precinct can have no total listed (e.g. for ballots cast),
+    # in which case we interpret the total as zero.
+    #    Background to this: in June 2014, the results file included
+    # a total for every choice (even if 0).  However, the file provided
+    # for November 2014 did not include zero totals (except for
+    # "REGISTERED VOTERS - TOTAL").
+    vector.extend(precinct_voted.get(r_index, 0) for r_index in contest_results.reporting_indices)
+    # The contest totals for a precinct are stored contiguously, with
+    # the reporting types in the order of reporting_indices.
+    offset = contest_results.get_offset(precinct_id, contest_results.reporting_indices[0])
+    size = len(contest_results.reporting_indices) * contest_results.choice_count
+    vector.extend(contest_results.totals[offset:offset + size])
+
+    return vector
+
+
+def make_area_totals(aggregates, contest_results, vector):
+    """
+    Return a dict mapping reporting key to AreaTotals object, given the
+    vector of an area (see make_precinct_vector()).
+
+    """
+    reporting_indices = contest_results.reporting_indices
+    choice_count = contest_results.choice_count
+    # The index in the vector of the first choice total.
+    choices_start = 2 + len(reporting_indices)
+    positions = {r_index: i for i, r_index in enumerate(reporting_indices)}
+
+    precinct_count, registered = vector[0], vector[1]
+    area_totals = {}
+    for reporting_key in aggregates.reporting_keys:
+        voted = 0
+        choice_vectors = []
+        for r_index in reporting_key:
+            i = positions[r_index]
+            voted += vector[2 + i]
+            start = choices_start + i * choice_count
+            choice_vectors.append(vector[start:start + choice_count])
+        if len(choice_vectors) == 1:
+            choice_totals = tuple(choice_vectors[0])
+        else:
+            choice_totals = tuple(map(sum, zip(*choice_vectors)))
+        area_totals[reporting_key] = AreaTotals(precinct_count, registered, voted, choice_totals)
+
+    return area_totals
+
+
+def aggregate_contest(aggregates, membership, results, contest_results):
+    """
+    Return a ContestAggregates object for a contest.
+
+    The totals of the areas other than precincts are computed by
+    multiplying the area membership matrix by the contest's precinct
+    vectors.
+
+    Arguments:
+      membership: an AreaMembership object.
+      contest_results: a ContestResults object.
+
+    """
+    registered = results.registered
+    voted = results.voted
+
+    contest_aggregates = ContestAggregates(contest_results.choice_ids)
+    areas = contest_aggregates.areas
+
+    precinct_vectors = []
+    for precinct_id in contest_results.precinct_ids:
+        try:
+            vector = make_precinct_vector(contest_results, registered, voted[precinct_id],
+                                          precinct_id)
+        except:
+            raise Exception("while aggregating precinct: %d" % precinct_id)
+        precinct_vectors.append((precinct_id, vector))
+        areas[(AREA_TYPE_PRECINCT, precinct_id)] = make_area_totals(aggregates, contest_results,
+                                                                    vector)
+
+    area_keys = membership.area_keys
+    for row, vector in membership.multiply(precinct_vectors).items():
+        areas[area_keys[row]] = make_area_totals(aggregates, contest_results, vector)
+
+    return contest_aggregates
+
+
+def aggregate_results(info):
+    """
+    Compute the totals for all contests, and return an
+    ElectionAggregates object.
+
+    Arguments:
+      info: an ElectionInfo object.
+
+    """
+    contests_info = info.meta.contests
+    results = info.results
+    membership = info.areas_info.get_membership()
+    aggregates = ElectionAggregates(results.reporting_indices)
+
+    with time_it("aggregating totals for %d contests" % len(contests_info)):
+        for contest_id in sorted(contests_info.keys()):
+            contest_results = results.contests[contest_id]
+            try:
+                contest_aggregates = aggregate_contest(aggregates, membership, results,
+                                                       contest_results)
+            except:
+                raise Exception("while aggregating contest: %s" % contests_info[contest_id].name)
+            aggregates.contests[contest_id] = contest_aggregates
+
+    return aggregates
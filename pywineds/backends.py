@@ -0,0 +1,99 @@
+"""
+Supports the output formats of the results files.
+
+The results writers emit rows in batches (e.g. one batch per report
+section) to a "backend" object, which is responsible for encoding them
+in a particular output format.  A backend is any object with the
+methods of RowBackend.
+
+"""
+
+# The delimiter of the TSV format.
+TSV_DELIMITER = "\t"
+
+
+class RowBackend(object):
+
+    """
+    The interface of an output backend.
+
+    A row is a sequence of cell values, where each value is a string or
+    an integer.
+
+    """
+
+    def make_contest_start_rows(self, contest_title):
+        """
+        Return the rows with which to begin each contest.
+
+        """
+        return [(contest_title, ), ("", )]
+
+    def write_rows(self, rows):
+        """
+        Write a batch of rows.
+
+        """
+        raise NotImplementedError()
+
+
+class TSVBackend(RowBackend):
+
+    """
+    Writes rows as tab-separated lines to a text file.
+
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def make_contest_start_rows(self, contest_title):
+        # Begin each contest with a distinctive string.  We use 3 stars.
+        # Doing this makes it easier for people to both (1) search through
+        # the CSV (e.g. by using COMMAND+F or CTRL+F), and (2) parse the
+        # file with a script (since it gives people an easy way to find
+        # where the lines for each contest start).
+        return [("*** %s" % contest_title, )]
+
+    def write_text(self, text):
+        self.file.write(text)
+
+    def write_rows(self, rows):
+        # Join the whole batch so that it is written with a single call.
+        join = TSV_DELIMITER.join
+        self.file.write("".join([join(map(str, values)) + "\n" for values in rows]))
+
+
+class ExcelBackend(RowBackend):
+
+    """
+    Writes rows to an XlsxWriter worksheet, starting at a given row.
+
+    """
+
+    def __init__(self, worksheet, row_index=0):
+        self.row_index = row_index
+        self.worksheet = worksheet
+
+    def write_rows(self, rows):
+        # XlsxWriter has no method to write a block of cells at once, so
+        # we at least avoid the attribute lookups for each row.
+        write_row = self.worksheet.write_row
+        for row_index, values in enumerate(rows, start=self.row_index):
+            write_row(row_index, 0, values)
+        self.row_index += len(rows)
+
+
+class RecordingBackend(RowBackend):
+
+    """
+    Records the rows written to it in a list, e.g. to write them later
+    to an ExcelBackend object.
+
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
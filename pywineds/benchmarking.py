@@ -0,0 +1,323 @@
+"""
+Supports benchmarking conversions of synthetic datasets of fixed sizes.
+
+Each benchmark generates a synthetic election (see the synthetic module)
+with a fixed seed and converts it.  Every phase timed by time_it() is a
+stage of the benchmark: e.g. parsing the precinct file, each pass over
+the export file, initializing the results, each writer, and converting
+end to end.  For each stage, the wall-clock time, throughput, and growth
+of the peak memory are reported.
+
+Each run of a benchmark happens in a fresh worker process so that the
+peak memory of one run does not hide that of another.  Each benchmark is
+run a number of times, and the best time of each stage is kept.
+
+The results can be saved as a JSON baseline, and the results of a later
+run compared against it: a stage regresses if its time grew by more than
+a threshold percentage, and a benchmark regresses if its peak memory
+did.
+
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import tempfile
+
+from pywineds.main import convert, get_export_engine, FILE_ENCODING
+from pywineds.synthetic import SyntheticElection
+from pywineds.utils import get_peak_rss, record_metrics, time_it
+
+
+# The options of the SyntheticElection object of each benchmark.
+BENCHMARK_SCALES = OrderedDict([
+    # About the size of a San Francisco election.
+    ("small", dict(precinct_count=600, contest_count=20, choice_count=4)),
+    ("medium", dict(precinct_count=1500, contest_count=40, choice_count=4)),
+    ("large", dict(precinct_count=4000, contest_count=80, choice_count=4)),
+])
+DEFAULT_SCALES = ("small", "medium")
+
+BENCHMARK_SEED = 1
+# The export file has passes and an initializing step with this engine.
+DEFAULT_ENGINE = "two-pass"
+DEFAULT_REPEAT = 3
+# The percentage by which a time or peak memory can grow before it is
+# reported as a regression.
+DEFAULT_THRESHOLD = 10
+
+# Stages shorter than this in the baseline are not checked for
+# regressions, since timer noise dominates them.
+MIN_CHECKED_SECONDS = 0.05
+
+# The report time written in the results files.
+BENCHMARK_NOW = datetime(2014, 11, 4, 20, 0, 0)
+
+_log = logging.getLogger("wineds")
+
+
+def make_dataset(data_dir, scale_name, election_options, seed=None):
+    """
+    Write the input files of a benchmark to a directory, if not already
+    there, and return the 2-tuple (precincts_path, export_path).
+
+    Since the files depend only on the options and seed, existing files
+    are reused.
+
+    """
+    if seed is None:
+        seed = BENCHMARK_SEED
+    precincts_path, export_path = (os.path.join(data_dir, "%s_%d_%s" % (scale_name, seed, name))
+                                   for name in ("precincts.csv", "wineds.txt"))
+    if os.path.exists(precincts_path) and os.path.exists(export_path):
+        return precincts_path, export_path
+
+    election = SyntheticElection(seed=seed, **election_options)
+    with open(precincts_path, "w", encoding=FILE_ENCODING) as f:
+        election.write_precincts(f)
+    with time_it("writing benchmark export file: %s" % export_path):
+        # Write to a temporary path first so that an interrupted run
+        # does not leave a partial file to be reused.
+        temp_path = export_path + ".part"
+        with open(temp_path, "w", encoding=FILE_ENCODING) as f:
+            election.write_export(f)
+        os.replace(temp_path, export_path)
+    return precincts_path, export_path
+
+
+def count_lines(path):
+    with open(path, "rb") as f:
+        return sum(1 for line in f)
+
+
+def run_case(precincts_path, export_path, output_base, engine):
+    """
+    Convert the input files once, and return a 2-tuple of: a list of
+    the dicts of the PhaseMetrics objects, and the peak resident set size
+    of this process.
+
+    This is a module-level function so that it can be run in a worker
+    process.
+
+    """
+    with record_metrics() as recorder:
+        with time_it("converting") as phase:
+            convert("Benchmark Election", precincts_path, export_path, output_base,
+                    now=BENCHMARK_NOW, engine=engine, jobs=1)
+            phase.lines = count_lines(export_path)
+            phase.bytes = os.path.getsize(export_path)
+    return [phase.to_dict() for phase in recorder.phases], get_peak_rss()
+
+
+def get_rate(count, seconds):
+    if count is None or not seconds:
+        return None
+    return count / seconds
+
+
+def make_stage(phase, wall_seconds, peak_rss_delta):
+    lines, size = phase["lines"], phase["bytes"]
+    return OrderedDict([
+        ("wall_seconds", wall_seconds),
+        ("lines", lines),
+        ("bytes", size),
+        ("lines_per_second", get_rate(lines, wall_seconds)),
+        ("mb_per_second", get_rate(None if size is None else size / 2 ** 20, wall_seconds)),
+        ("peak_rss_delta", peak_rss_delta),
+    ])
+
+
+def run_benchmark(scale_name, election_options, data_dir, engine=None, repeat=None):
+    """
+    Run a benchmark, and return a dict of its results.
+
+    Arguments:
+      election_options: the options of the SyntheticElection object.
+      data_dir: the directory in which to write the input and output
+        files.
+      engine: the name of the export engine.  Defaults to DEFAULT_ENGINE.
+      repeat: the number of runs.  Defaults to DEFAULT_REPEAT.
+
+    """
+    if engine is None:
+        engine = DEFAULT_ENGINE
+    if repeat is None:
+        repeat = DEFAULT_REPEAT
+    # Fail before generating any files.
+    get_export_engine(engine)
+    precincts_path, export_path = make_dataset(data_dir, scale_name, election_options)
+    output_base = os.path.join(data_dir, "%s_output" % scale_name)
+
+    # A dict mapping stage name to the list of the phase dicts of each run.
+    runs = OrderedDict()
+    peak_rss_values = []
+    # The spawn method gives each run a process without the memory of
+    # this process.
+    context = multiprocessing.get_context("spawn")
+    for run_no in range(1, repeat + 1):
+        with time_it("running benchmark %r (run %d of %d)" % (scale_name, run_no, repeat)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(run_case, precincts_path, export_path, output_base,
+                                         engine)
+                phases, peak_rss = future.result()
+        for phase in phases:
+            runs.setdefault(phase["name"], []).append(phase)
+        peak_rss_values.append(peak_rss)
+
+    stages = OrderedDict()
+    for name, phases in runs.items():
+        wall_seconds = min(phase["wall_seconds"] for phase in phases)
+        deltas = [phase["peak_rss_delta"] for phase in phases
+                  if phase["peak_rss_delta"] is not None]
+        stages[name] = make_stage(phases[0], wall_seconds, min(deltas) if deltas else None)
+
+    config = OrderedDict(sorted(election_options.items()))
+    config.update(seed=BENCHMARK_SEED, engine=engine)
+    peak_rss_values = [value for value in peak_rss_values if value is not None]
+    return OrderedDict([
+        ("config", config),
+        ("lines", stages["converting"]["lines"]),
+        ("bytes", stages["converting"]["bytes"]),
+        ("peak_rss", min(peak_rss_values) if peak_rss_values else None),
+        ("stages", stages),
+    ])
+
+
+def run_benchmarks(scale_names=None, data_dir=None, engine=None, repeat=None):
+    """
+    Run the benchmarks with the given names in BENCHMARK_SCALES, and
+    return a dict of the results.
+
+    Arguments:
+      scale_names: defaults to DEFAULT_SCALES.
+      data_dir: a directory in which to keep the input files for later
+        runs, or None to use a temporary directory.
+
+    """
+    if scale_names is None:
+        scale_names = DEFAULT_SCALES
+    for scale_name in scale_names:
+        if scale_name not in BENCHMARK_SCALES:
+            raise Exception("benchmark scale should be one of %s: %r" %
+                            (", ".join(BENCHMARK_SCALES), scale_name))
+    if data_dir is None:
+        with tempfile.TemporaryDirectory(prefix="wineds-benchmark-") as temp_dir:
+            return run_benchmarks(scale_names, data_dir=temp_dir, engine=engine, repeat=repeat)
+    os.makedirs(data_dir, exist_ok=True)
+
+    cases = OrderedDict()
+    for scale_name in scale_names:
+        cases[scale_name] = run_benchmark(scale_name, BENCHMARK_SCALES[scale_name], data_dir,
+                                          engine=engine, repeat=repeat)
+    return OrderedDict([
+        ("python", platform.python_version()),
+        ("machine", platform.machine()),
+        ("cases", cases),
+    ])
+
+
+def read_results(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def write_results(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+        f.write("\n")
+    _log.info("wrote benchmark results: %s" % path)
+
+
+def get_change(value, baseline_value):
+    """
+    Return the percentage change from a baseline value, or None.
+
+    """
+    if value is None or not baseline_value:
+        return None
+    return 100 * (value - baseline_value) / baseline_value
+
+
+def compare_results(results, baseline, threshold=None):
+    """
+    Return a list of strings describing the regressions of the results
+    from a baseline.
+
+    Only the benchmarks and stages in both are compared.
+
+    Arguments:
+      threshold: the percentage by which a stage time or peak memory can
+        grow without regressing.  Defaults to DEFAULT_THRESHOLD.
+
+    """
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLD
+    regressions = []
+    for scale_name, case in results["cases"].items():
+        try:
+            baseline_case = baseline["cases"][scale_name]
+        except KeyError:
+            continue
+        if case["config"] != baseline_case["config"]:
+            raise Exception("benchmark %r has a different configuration from the baseline: "
+                            "%r != %r" % (scale_name, dict(case["config"]),
+                                          dict(baseline_case["config"])))
+        change = get_change(case["peak_rss"], baseline_case["peak_rss"])
+        if change is not None and change > threshold:
+            regressions.append("%s: peak memory grew %.1f%% (%d -> %d bytes)" %
+                               (scale_name, change, baseline_case["peak_rss"], case["peak_rss"]))
+        for name, stage in case["stages"].items():
+            try:
+                baseline_stage = baseline_case["stages"][name]
+            except KeyError:
+                continue
+            baseline_seconds = baseline_stage["wall_seconds"]
+            if baseline_seconds < MIN_CHECKED_SECONDS:
+                continue
+            change = get_change(stage["wall_seconds"], baseline_seconds)
+            if change > threshold:
+                regressions.append("%s: %s: time grew %.1f%% (%.3f -> %.3f seconds)" %
+                                   (scale_name, name, change, baseline_seconds,
+                                    stage["wall_seconds"]))
+    return regressions
+
+
+def format_number(value, format_spec):
+    return "-" if value is None else format(value, format_spec)
+
+
+def format_results(results, baseline=None):
+    """
+    Return a text report of the results, with the change in time of each
+    stage from a baseline if one is given.
+
+    """
+    lines = []
+    for scale_name, case in results["cases"].items():
+        try:
+            baseline_stages = baseline["cases"][scale_name]["stages"]
+        except (KeyError, TypeError):
+            baseline_stages = {}
+        lines.append("%s: %d lines, %.1f MiB, peak memory %s MiB" %
+                     (scale_name, case["lines"], case["bytes"] / 2 ** 20,
+                      format_number(None if case["peak_rss"] is None else
+                                    case["peak_rss"] / 2 ** 20, ".1f")))
+        lines.append("  %10s %12s %9s %11s %8s  %s" %
+                     ("seconds", "lines/sec", "MiB/sec", "peak +MiB", "change", "stage"))
+        for name, stage in case["stages"].items():
+            baseline_stage = baseline_stages.get(name)
+            change = (None if baseline_stage is None else
+                      get_change(stage["wall_seconds"], baseline_stage["wall_seconds"]))
+            peak_delta = stage["peak_rss_delta"]
+            lines.append("  %10.3f %12s %9s %11s %8s  %s" % (
+                stage["wall_seconds"], format_number(stage["lines_per_second"], ",.0f"),
+                format_number(stage["mb_per_second"], ".1f"),
+                format_number(None if peak_delta is None else peak_delta / 2 ** 20, ".1f"),
+                format_number(change, "+.1f"), name))
+        lines.append("")
+    return "\n".join(lines)
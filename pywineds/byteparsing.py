@@ -0,0 +1,172 @@
+"""
+Supports parsing WinEDS export files at the level of bytes.
+
+The parser in this module memory-maps the export file and splits each
+line using byte offsets rather than decoding the line to a string.
+Since most column values repeat across many lines (e.g. contest and
+choice names), each distinct byte value is decoded only once.
+
+"""
+
+import logging
+import mmap
+import os
+
+from pywineds.main import (parse_export_single_pass, prettify, DataField, Fields,
+                           SinglePassParser, FILE_ENCODING)
+
+
+_log = logging.getLogger("wineds")
+
+# The byte value of the character "0".
+ZERO_BYTE = ord("0")
+
+
+class MmapParser(SinglePassParser):
+
+    """
+    Single-pass parser that reads a memory-mapped export file as bytes.
+
+    The column offsets are those of the file's LineLayout object.
+    Because those offsets are character offsets, lines containing
+    non-ASCII characters are decoded and split as strings instead.
+
+    """
+
+    name = "Results File (single pass, memory-mapped)"
+    line_encoding = FILE_ENCODING
+
+    def __init__(self, info, results, **kwargs):
+        super().__init__(info, results, **kwargs)
+        # Each of these is a dict mapping the raw bytes of a column (or
+        # group of adjacent columns) to its parsed value.
+        self.choice_keys = {}
+        self.names = {}
+        self.party_codes = {}
+        self.precinct_names = {}
+        self.tails = {}
+
+    def log_line(self, msg):
+        line = self.line.decode(FILE_ENCODING)
+        return '%s:\n>>> [L%d]:"%s"' % (msg, self.line_no, line.strip())
+
+    def iter_lines(self, f):
+        line = None
+        line_no = 0
+        for line_no, line in enumerate(iter(f.readline, b""), start=1):
+            self.line = line
+            self.line_no = line_no
+            yield
+        _log.info("parsed: %d lines" % line_no)
+
+    def set_layout(self, layout):
+        super().set_layout(layout)
+        # The offsets at which the groups of columns looked up together
+        # begin and end (see split_raw_line()).
+        self.party_end = layout.get_bounds("data_field")[1]
+        self.choice_start, self.names_end = layout.get_bounds("choice_name")
+        self.precinct_end = layout.get_bounds("precinct_name")[1]
+        district_start, district_end = layout.get_bounds("district_name")
+        self.district_width = district_end - district_start
+
+    def detect_format(self, line):
+        return super().detect_format(line.decode(FILE_ENCODING))
+
+    def split_raw_line(self, line):
+        """
+        Split a line of bytes into a 2-tuple of: Fields, DataField.
+
+        """
+        if not line.isascii():
+            fields = self.split_line(line.decode(FILE_ENCODING))
+            return fields, self.parse_data(fields.data_field)
+
+        # Validate our assumptions about the initial data chunk.
+        assert line[0] == ZERO_BYTE
+        assert not line[15:16].isspace()
+
+        raw = line[:7]
+        try:
+            contest_number, choice_id = self.choice_keys[raw]
+        except KeyError:
+            contest_number, choice_id = int(raw[1:4]), int(raw[4:7])
+            self.choice_keys[raw] = contest_number, choice_id
+
+        raw = line[11:16]
+        vote_total = -1 if raw == b"000-1" else int(raw)
+
+        party_end = self.party_end
+        names_end = self.names_end
+        precinct_end = self.precinct_end
+
+        raw = line[16:party_end]
+        try:
+            party_code = self.party_codes[raw]
+        except KeyError:
+            party_code = raw.decode(FILE_ENCODING).strip()
+            self.party_codes[raw] = party_code
+
+        # The contest and choice names are adjacent, so we look them up
+        # together.
+        raw = line[party_end:names_end]
+        try:
+            contest_name, choice_name = self.names[raw]
+        except KeyError:
+            text = raw.decode(FILE_ENCODING)
+            i = self.choice_start - party_end
+            contest_name, choice_name = text[:i].strip(), text[i:].strip()
+            self.names[raw] = contest_name, choice_name
+
+        raw = line[names_end:precinct_end]
+        try:
+            precinct_name = self.precinct_names[raw]
+        except KeyError:
+            precinct_name = raw.decode(FILE_ENCODING).strip()
+            self.precinct_names[raw] = precinct_name
+
+        # This includes the district name and reporting type.
+        raw = line[precinct_end:]
+        try:
+            district_name, reporting_type = self.tails[raw]
+        except KeyError:
+            text = raw.decode(FILE_ENCODING)
+            i = self.district_width
+            district_name, reporting_type = text[:i].strip(), text[i:].strip()
+            self.tails[raw] = district_name, reporting_type
+
+        data = DataField(choice_id, contest_number, int(line[7:11]), vote_total, party_code)
+        # We leave the data_field value empty since it is only used to
+        # construct the DataField object.
+        fields = Fields("", contest_name, choice_name, precinct_name, district_name,
+                        reporting_type)
+
+        return fields, data
+
+    def parse_line(self, line):
+        self.process_line(*self.split_raw_line(line))
+
+    def parse_path(self, path):
+        info = {
+            "name": self.name,
+            "path": path,
+        }
+        _log.info("parsing file:\n{0}".format(prettify(info)))
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # An empty file cannot be memory-mapped, so we parse the
+                # file object instead, which fails as for the other
+                # parsers.
+                return self.parse_file(f)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return self.parse_file(mapped)
+
+
+def parse_export_mmap(areas_info, wineds_path, layout=None, trust=None, selection=None):
+    """
+    Parse a WinEDS export file using MmapParser.
+
+    The return value is the same as for parse_export_single_pass().
+
+    """
+    return parse_export_single_pass(areas_info, wineds_path, layout=layout, trust=trust,
+                                    parser_class=MmapParser, selection=selection)
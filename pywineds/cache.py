@@ -0,0 +1,183 @@
+"""
+Supports caching the parsed input files between runs.
+
+The objects returned by digest_input_files() are pickled into a
+snapshot file in a cache directory.  A snapshot is keyed by a hash of
+the contents of the input files and of CACHE_FORMAT_VERSION, so a
+snapshot is used only if neither the input files nor the format of the
+objects has changed.  When the snapshots in the directory exceed a
+maximum total size, the least recently used snapshots are deleted.
+
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+from pywineds.utils import time_it
+
+
+# This should be incremented whenever the attributes of the pickled
+# objects change (e.g. ElectionMeta, AreasInfo, or ElectionResults).
+CACHE_FORMAT_VERSION = 3
+
+# The default maximum total size in bytes of the snapshots in a cache
+# directory.
+DEFAULT_CACHE_SIZE = 500 * 2 ** 20
+
+# The number of bytes to read at a time when hashing a file.
+HASH_BLOCK_SIZE = 2 ** 20
+
+SNAPSHOT_EXTENSION = ".pickle"
+
+_log = logging.getLogger("wineds")
+
+
+def dump_atomic(value, path):
+    """
+    Pickle an object to a file.
+
+    The object is written to a temporary file first so that other
+    processes never see a partially written file.
+
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def hash_files(paths, extra=None):
+    """
+    Return a hex digest of the contents of the given files and of
+    CACHE_FORMAT_VERSION.
+
+    Arguments:
+      extra: a string of other input to include in the digest, or None.
+
+    """
+    sha = hashlib.sha256()
+    sha.update(b"wineds-cache-v%d" % CACHE_FORMAT_VERSION)
+    if extra is not None:
+        sha.update(("%d:%s" % (len(extra), extra)).encode("utf-8"))
+    for path in paths:
+        with open(path, "rb") as f:
+            # Include the size so that the boundaries between the files
+            # are part of the hash.
+            sha.update(b"%d:" % os.fstat(f.fileno()).st_size)
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+class SnapshotCache(object):
+
+    """
+    A directory of snapshot files.
+
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Arguments:
+          max_size: the maximum total size in bytes of the snapshots.
+            Defaults to DEFAULT_CACHE_SIZE.
+
+        """
+        if max_size is None:
+            max_size = DEFAULT_CACHE_SIZE
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + SNAPSHOT_EXTENSION)
+
+    def load(self, key):
+        """
+        Return the object stored with the given key, or None if there is
+        no usable snapshot.
+
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Then the snapshot is corrupt or from an incompatible version
+            # of the code, so we discard it.
+            _log.warning("discarding unreadable snapshot: %s" % path)
+            os.remove(path)
+            return None
+        # Update the modification time to record the use for eviction.
+        os.utime(path)
+        return value
+
+    def store(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        dump_atomic(value, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used snapshots until their total size
+        is at most max_size.
+
+        Arguments:
+          keep: the path of a snapshot not to delete.
+
+        """
+        snapshots = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(SNAPSHOT_EXTENSION):
+                stat = entry.stat()
+                snapshots.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for mtime, size, path in snapshots)
+        for mtime, size, path in sorted(snapshots):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            _log.info("evicting snapshot: %s (%d bytes)" % (path, size))
+            os.remove(path)
+            total_size -= size
+
+
+def digest_input_files_cached(digest, precinct_index_path, wineds_path, cache_dir,
+                              max_size=None, **kwargs):
+    """
+    Return the value of digest(precinct_index_path, wineds_path, **kwargs),
+    using a snapshot from the given cache directory if available.
+
+    Arguments:
+      digest: the digest_input_files() function.
+
+    """
+    cache = SnapshotCache(cache_dir, max_size=max_size)
+    # An explicit line layout or a selection can change the parsed values,
+    # and a snapshot of trusted input must not satisfy a run that
+    # validates every line.
+    extra = kwargs.get("layout")
+    for name in ("selection", "trust"):
+        value = kwargs.get(name)
+        if value is not None:
+            extra = "%s %s=%r" % (extra, name, value)
+    key = hash_files([precinct_index_path, wineds_path], extra=extra)
+    with time_it("loading snapshot: %s" % key):
+        value = cache.load(key)
+    if value is not None:
+        _log.info("using snapshot of the input files: %s" % cache.get_path(key))
+        return value
+
+    value = digest(precinct_index_path, wineds_path, **kwargs)
+    with time_it("storing snapshot: %s" % key):
+        cache.store(key, value)
+    return value
@@ -0,0 +1,74 @@
+"""
+Supports writing election results in a columnar format.
+
+The tables returned by make_results_tables() are written as Apache
+Parquet or Arrow IPC files, one file per table, with the string columns
+dictionary-encoded.
+
+This module requires PyArrow, which is an optional dependency.
+
+"""
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    raise Exception("PyArrow does not seem to be installed. "
+                    "It is required for writing columnar output files "
+                    "(see the \"columnar\" extra in setup.py).")
+
+from pywineds.tables import make_results_tables, COLUMNAR_FORMATS, TABLE_COLUMNS
+from pywineds.utils import time_it
+
+
+def make_arrow_table(table_name, table):
+    """
+    Convert a table returned by make_results_tables() to a pyarrow.Table.
+
+    """
+    arrays = []
+    names = []
+    for name, type_ in TABLE_COLUMNS[table_name]:
+        values = table[name]
+        if type_ is str:
+            array = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            array = pa.array(values, type=pa.int64())
+        arrays.append(array)
+        names.append(name)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+class ColumnarWriter(object):
+
+    name = "Columnar"
+
+    def __init__(self, output_base, format_name="parquet"):
+        if format_name not in COLUMNAR_FORMATS:
+            raise Exception("unsupported columnar format: %r" % format_name)
+        self.format_name = format_name
+        self.output_base = output_base
+
+    def get_path(self, table_name):
+        return "%s.%s.%s" % (self.output_base, table_name, self.format_name)
+
+    def write_table(self, path, arrow_table):
+        if self.format_name == "parquet":
+            pq.write_table(arrow_table, path)
+            return
+        with pa.OSFile(path, "wb") as f:
+            with pa.ipc.new_file(f, arrow_table.schema) as writer:
+                writer.write_table(arrow_table)
+
+    def write(self, info):
+        """
+        Write the tables, and return a list of the paths written.
+
+        """
+        paths = []
+        with time_it("writing output files: %s (%s)" % (self.name, self.format_name)):
+            for table_name, table in make_results_tables(info).items():
+                path = self.get_path(table_name)
+                self.write_table(path, make_arrow_table(table_name, table))
+                paths.append(path)
+        return paths
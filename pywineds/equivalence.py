@@ -0,0 +1,328 @@
+"""
+Supports checking that alternative engines are equivalent to the
+reference path.
+
+The reference path parses the export file with ElectionMetaParser and
+ResultsParser (the "two-pass" engine) and writes the results files
+without worker processes.  A candidate is a set of convert() options,
+e.g. another export engine, rendering with worker processes, or
+streaming.
+
+For each input case, the harness compares the parsed ElectionMeta and
+ElectionResults objects of each candidate with those of the reference
+path, and then the TSV files they write.  The first divergence of each
+candidate is reported with enough context to locate it: the path to the
+differing value (e.g. the contest, precinct, and choice of a vote total),
+or the lines preceding a differing line of the TSV file along with the
+contest it belongs to.
+
+The input cases are the test_data cases and randomly generated synthetic
+elections (see the synthetic module).
+
+"""
+
+from collections import namedtuple
+from collections.abc import Mapping
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import random
+
+from pywineds.layouts import LINE_LAYOUTS
+from pywineds.main import (convert, digest_input_files, get_export_engine, ContestInfo,
+                           ContestResults, EXPORT_ENGINES, FILE_ENCODING)
+from pywineds.synthetic import SyntheticElection
+from pywineds.trusted import TrustOptions
+
+
+REFERENCE_ENGINE = "two-pass"
+
+# The names of the test_data cases.
+TEST_DATA_LABELS = ("simple", "complete", "dupe_contest_id", "reporting_type")
+
+# The number of lines preceding a differing line of a TSV file to report.
+CONTEXT_LINES = 3
+
+# The report time written in the results files.
+EQUIVALENCE_NOW = datetime(2014, 11, 4, 20, 0, 0)
+
+# The options of convert() that also apply to digest_input_files().
+PARSE_OPTION_NAMES = ("engine", "jobs", "layout", "trust", "memory_budget", "spill_dir")
+
+META_ATTRS = ('precincts', 'parties', 'choices', 'has_reporting_type', 'overvote_id',
+              'undervote_id', 'layout', 'contests')
+CONTEST_INFO_ATTRS = ('name', 'raw_name', 'number', 'district_name', 'party_code', 'choice_ids',
+                      'precinct_ids')
+RESULTS_ATTRS = ('reporting_indices', 'registered', 'voted', 'contests')
+
+Candidate = namedtuple('Candidate', ['name', 'options'])
+Case = namedtuple('Case', ['name', 'precincts_path', 'export_path'])
+
+_log = logging.getLogger("wineds")
+
+
+def make_default_candidates():
+    """
+    Return a list of the default Candidate objects.
+
+    Engines whose optional dependencies are not installed are skipped.
+
+    """
+    candidates = []
+    for engine in EXPORT_ENGINES:
+        if engine == REFERENCE_ENGINE:
+            continue
+        try:
+            get_export_engine(engine)
+        except ImportError as err:
+            _log.warning("skipping engine %r: %s" % (engine, err))
+            continue
+        candidates.append(Candidate(engine, {"engine": engine}))
+    candidates.extend([
+        # This parses in chunks and renders the contests in worker
+        # processes.
+        Candidate("parallel-jobs", {"engine": "parallel", "jobs": 3}),
+        # A budget this small spills the totals every 25 lines.
+        Candidate("out-of-core-spilling", {"memory_budget": 1000}),
+        Candidate("trusted", {"trust": TrustOptions(every=7)}),
+        Candidate("streaming", {"streaming": True}),
+    ])
+    return candidates
+
+
+def get_test_data_cases(test_dir=None):
+    """
+    Return a list of the Case objects of the test_data directory.
+
+    """
+    if test_dir is None:
+        test_dir = Path(__file__).parents[1] / 'test_data'
+    test_dir = Path(test_dir)
+    precincts_path = str(test_dir / "precincts.csv")
+    return [Case(label, precincts_path, str(test_dir / label / ("wineds_%s.txt" % label)))
+            for label in TEST_DATA_LABELS]
+
+
+def make_random_options(rng):
+    """
+    Return a 2-tuple of the options of a random SyntheticElection object,
+    and the name of a random layout.
+
+    """
+    options = dict(precinct_count=rng.randint(1, 150), contest_count=rng.randint(1, 30),
+                   choice_count=rng.randint(1, 5), party_contest_count=rng.randint(0, 2),
+                   dupe_number_contest_count=rng.randint(0, 3),
+                   omit_zeros=rng.random() < 0.5,
+                   negative_fraction=rng.choice((0, 0, 0.02)),
+                   under_over=rng.random() < 0.5)
+    return options, rng.choice(sorted(LINE_LAYOUTS))
+
+
+def make_random_cases(data_dir, count, seed=0):
+    """
+    Write the input files of random synthetic elections to a directory,
+    and return a list of their Case objects.
+
+    """
+    rng = random.Random(seed)
+    cases = []
+    for case_no in range(1, count + 1):
+        options, layout_name = make_random_options(rng)
+        election = SyntheticElection(seed=rng.randrange(2 ** 32), **options)
+        name = "random-%d" % case_no
+        precincts_path, export_path = (os.path.join(data_dir, "%s_%s" % (name, suffix))
+                                       for suffix in ("precincts.csv", "wineds.txt"))
+        with open(precincts_path, "w", encoding=FILE_ENCODING) as f:
+            election.write_precincts(f)
+        with open(export_path, "w", encoding=FILE_ENCODING) as f:
+            election.write_export(f, layout=LINE_LAYOUTS[layout_name])
+        _log.info("generated %s (%s layout): %r" % (name, layout_name, options))
+        cases.append(Case(name, precincts_path, export_path))
+    return cases
+
+
+def format_set_difference(expected, actual):
+    missing, extra = (sorted(values, key=repr)[:5] for values in
+                      (set(expected) - set(actual), set(actual) - set(expected)))
+    return "missing %r, extra %r" % (missing, extra)
+
+
+def compare_contest_totals(path, expected, actual):
+    """
+    Return a description of the first differing total of two
+    ContestResults objects, or None.
+
+    """
+    for attr in ('choice_ids', 'precinct_ids', 'reporting_indices'):
+        if getattr(expected, attr) != getattr(actual, attr):
+            return ("%s.%s: %s" % (path, attr, format_set_difference(getattr(expected, attr),
+                                                                      getattr(actual, attr))))
+    for i, (expected_total, actual_total) in enumerate(zip(expected.totals, actual.totals)):
+        if expected_total == actual_total:
+            continue
+        row, choice_index = divmod(i, expected.choice_count)
+        precinct_index, reporting_index = divmod(row, len(expected.reporting_indices))
+        return ("%s.totals: precinct %d, reporting index %d, choice %d: expected %r, got %r" %
+                (path, expected.precinct_ids[precinct_index],
+                 expected.reporting_indices[reporting_index],
+                 expected.choice_ids[choice_index], expected_total, actual_total))
+    return None
+
+
+def compare_values(path, expected, actual):
+    """
+    Return a description of the first difference between two values, or
+    None if they are equal.
+
+    Mappings are compared key by key in the order of the expected keys,
+    ContestInfo and ContestResults objects attribute by attribute, and
+    other values by equality.
+
+    Arguments:
+      path: a string describing where the values come from, e.g.
+        "meta.contests".
+
+    """
+    if isinstance(expected, Mapping) and isinstance(actual, Mapping):
+        if set(expected) != set(actual):
+            return "%s: keys differ: %s" % (path, format_set_difference(expected, actual))
+        for key in expected:
+            description = compare_values("%s[%r]" % (path, key), expected[key], actual[key])
+            if description is not None:
+                return description
+        return None
+    if isinstance(expected, ContestInfo) and isinstance(actual, ContestInfo):
+        return compare_attrs(path, expected, actual, CONTEST_INFO_ATTRS)
+    if isinstance(expected, ContestResults) and isinstance(actual, ContestResults):
+        return compare_contest_totals(path, expected, actual)
+    if isinstance(expected, (set, frozenset)) and isinstance(actual, (set, frozenset)):
+        if expected != actual:
+            return "%s: %s" % (path, format_set_difference(expected, actual))
+        return None
+    if expected != actual:
+        return "%s: expected %r, got %r" % (path, expected, actual)
+    return None
+
+
+def compare_attrs(path, expected, actual, attrs):
+    for attr in attrs:
+        description = compare_values("%s.%s" % (path, attr), getattr(expected, attr),
+                                     getattr(actual, attr))
+        if description is not None:
+            return description
+    return None
+
+
+def compare_texts(path, expected, actual):
+    """
+    Return a description of the first differing line of two texts, with
+    the preceding lines and the contest header the line falls under, or
+    None if the texts are equal.
+
+    """
+    if expected == actual:
+        return None
+    expected_lines, actual_lines = expected.splitlines(), actual.splitlines()
+    for i, (expected_line, actual_line) in enumerate(zip(expected_lines, actual_lines)):
+        if expected_line != actual_line:
+            break
+    else:
+        i = min(len(expected_lines), len(actual_lines))
+        if len(expected_lines) == len(actual_lines):
+            # Then only the line endings differ.
+            return "%s: the line endings differ" % path
+    end_of_file = "<end of file>"
+    expected_line = expected_lines[i] if i < len(expected_lines) else end_of_file
+    actual_line = actual_lines[i] if i < len(actual_lines) else end_of_file
+
+    headers = [line for line in expected_lines[:i] if line.startswith("***")]
+    lines = ["%s: line %d differs%s:" % (path, i + 1, ", in contest: %s" % headers[-1][4:]
+                                          if headers else "")]
+    lines.extend("    %s" % line for line in expected_lines[max(0, i - CONTEXT_LINES):i])
+    lines.append("  - %s" % expected_line)
+    lines.append("  + %s" % actual_line)
+    return "\n".join(lines)
+
+
+def read_text(path):
+    with open(path, encoding=FILE_ENCODING) as f:
+        return f.read()
+
+
+class EquivalenceChecker(object):
+
+    """
+    Compares candidates with the reference path, writing the results
+    files to an output directory.
+
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        # A dict mapping case name to a 3-tuple of the ElectionMeta
+        # object, ElectionResults object, and TSV text of the reference.
+        self.references = {}
+
+    def convert(self, case, label, options):
+        output_base = os.path.join(self.output_dir, "%s_%s" % (case.name, label))
+        paths = convert("Equivalence Check", case.precincts_path, case.export_path,
+                        output_base, now=EQUIVALENCE_NOW, **options)
+        return read_text(paths[0])
+
+    def get_reference(self, case):
+        try:
+            return self.references[case.name]
+        except KeyError:
+            pass
+        meta, _, results = digest_input_files(case.precincts_path, case.export_path,
+                                              engine=REFERENCE_ENGINE)
+        tsv_text = self.convert(case, "reference", {"engine": REFERENCE_ENGINE, "jobs": 1})
+        reference = meta, results, tsv_text
+        self.references[case.name] = reference
+        return reference
+
+    def check(self, case, candidate):
+        """
+        Return a description of the first divergence of a candidate from
+        the reference path on a case, or None.
+
+        """
+        expected_meta, expected_results, expected_tsv = self.get_reference(case)
+        options = candidate.options
+        # Streaming does not expose the parsed objects, so only its TSV
+        # file is compared.
+        if not options.get("streaming"):
+            parse_options = {name: value for name, value in options.items()
+                             if name in PARSE_OPTION_NAMES}
+            meta, _, results = digest_input_files(case.precincts_path, case.export_path,
+                                                  **parse_options)
+            description = (compare_attrs("meta", expected_meta, meta, META_ATTRS) or
+                           compare_attrs("results", expected_results, results, RESULTS_ATTRS))
+            if description is not None:
+                return description
+        tsv_text = self.convert(case, candidate.name, options)
+        return compare_texts("TSV file", expected_tsv, tsv_text)
+
+    def check_all(self, cases, candidates):
+        """
+        Check each candidate on each case, and return a list of 3-tuples
+        (case name, candidate name, description) of the divergences.
+
+        An exception raised by a candidate is also a divergence.
+
+        """
+        divergences = []
+        for case in cases:
+            for candidate in candidates:
+                try:
+                    description = self.check(case, candidate)
+                except Exception as err:
+                    description = "raised: %r" % err
+                if description is None:
+                    _log.info("equivalent: %s on %s" % (candidate.name, case.name))
+                    continue
+                _log.error("divergence: %s on %s:\n%s" % (candidate.name, case.name,
+                                                           description))
+                divergences.append((case.name, candidate.name, description))
+        return divergences
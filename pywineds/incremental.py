@@ -0,0 +1,136 @@
+"""
+Supports re-converting successive export files incrementally.
+
+On election night, successive export files differ in only some of the
+contest totals.  A RenderState object records a digest of the inputs
+of each contest's sections in the results files, along with the
+rendered sections.  When the next export file is converted, only the
+contests whose digests changed are rendered again.
+
+"""
+
+import hashlib
+import logging
+import pickle
+
+from pywineds.cache import dump_atomic
+
+
+# This should be incremented whenever the rendered form of the contests
+# changes, so that the rendered contests of older versions are not used.
+RENDER_STATE_VERSION = 1
+
+_log = logging.getLogger("wineds")
+
+
+def digest_objects(*objs):
+    return hashlib.sha256(pickle.dumps(objs, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def digest_areas(areas_info):
+    """
+    Return a digest of the areas, which are common to all contests.
+
+    """
+    membership = areas_info.get_membership()
+    return digest_objects(membership.area_keys, membership.precinct_ids,
+                          membership.column_starts.tobytes(), membership.row_indices.tobytes(),
+                          sorted(areas_info.nbhd_names.items()))
+
+
+def digest_contest(info, contest_id):
+    """
+    Return a digest of everything that the rendered sections of a
+    contest depend on, other than the areas.
+
+    """
+    meta = info.meta
+    results = info.results
+    contest_info = meta.contests[contest_id]
+    contest_results = results.contests[contest_id]
+    # Each choices value is a 2-tuple of (contest_id, choice_name).
+    choice_names = [meta.choices[choice_id][1] for choice_id in contest_results.choice_ids]
+    precincts = [(precinct_id, meta.precincts[precinct_id], results.registered.get(precinct_id),
+                  sorted(results.voted.get(precinct_id, {}).items()))
+                 for precinct_id in contest_results.precinct_ids]
+
+    return digest_objects(contest_info.name, contest_info.number, contest_info.district_name,
+                          contest_results.choice_ids, choice_names, precincts,
+                          contest_results.reporting_indices, contest_results.totals.tobytes())
+
+
+class RenderState(object):
+
+    """
+    Encapsulates the rendered contests of a previous conversion.
+
+    Attributes:
+
+      areas_digest: the digest of the areas (see digest_areas()).
+      blocks: a dict mapping writer name to a dict mapping contest_id to
+        the rendered contest (see ResultsWriter.render_contest()).
+      digests: a dict mapping contest_id to the contest's digest (see
+        digest_contest()).
+
+    """
+
+    def __init__(self):
+        self.version = RENDER_STATE_VERSION
+
+        self.areas_digest = None
+        self.blocks = {}
+        self.digests = {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the RenderState object saved at the given path, or a new
+        object if there is no usable saved state.
+
+        """
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return cls()
+        except Exception:
+            _log.warning("ignoring unreadable render state: %s" % path)
+            return cls()
+        if not isinstance(state, cls) or state.version != RENDER_STATE_VERSION:
+            _log.warning("ignoring render state from another version: %s" % path)
+            return cls()
+        return state
+
+    def save(self, path):
+        dump_atomic(self, path)
+
+    def get_blocks(self, writer_name):
+        return self.blocks.setdefault(writer_name, {})
+
+    def update(self, info):
+        """
+        Update the digests for the given election, discarding the rendered
+        contests that changed, and return a list of the IDs of the contests
+        that changed.
+
+        """
+        areas_digest = digest_areas(info.areas_info)
+        if areas_digest != self.areas_digest:
+            self.areas_digest = areas_digest
+            self.blocks = {}
+            self.digests = {}
+
+        digests = {contest_id: digest_contest(info, contest_id)
+                   for contest_id in info.meta.contests}
+        changed_ids = sorted(contest_id for contest_id, digest in digests.items()
+                             if self.digests.get(contest_id) != digest)
+        self.digests = digests
+        for blocks in self.blocks.values():
+            for contest_id in list(blocks):
+                if contest_id in changed_ids or contest_id not in digests:
+                    del blocks[contest_id]
+
+        _log.info("contests changed since the last conversion: %d of %d" %
+                  (len(changed_ids), len(digests)))
+
+        return changed_ids
@@ -0,0 +1,173 @@
+"""
+Supports the fixed-width line layouts of WinEDS export files.
+
+The WinEDS Reporting Tool writes lines with fixed-width columns, but the
+widths of the columns can differ between counties and versions.  A
+LineLayout object describes the widths of the columns, and its
+make_splitter() method returns a function that splits lines using
+precomputed offsets.
+
+The layout of a file is detected from its first lines by trying each
+layout in LINE_LAYOUTS.  A layout can also be given explicitly as a
+comma-separated list of column widths (see get_line_layout()).
+
+"""
+
+from collections import namedtuple, OrderedDict
+
+from pywineds.utils import get_reporting_index
+
+
+# The names of the columns, in the order in which they occur in a line.
+# The data_field column is the initial data chunk (see parse_data_chunk()
+# in main.py), and the other columns are strings.  The reporting_type
+# column is not present in all files.
+FIELD_NAMES = ['data_field', 'contest_name', 'choice_name', 'precinct_name', 'district_name',
+               'reporting_type']
+
+# The minimum width of the data_field column.
+DATA_FIELD_MIN_WIDTH = 16
+
+Fields = namedtuple('Fields', FIELD_NAMES)
+
+
+class LineLayout(namedtuple('LineLayout', ['name', 'widths'])):
+
+    """
+    Describes the widths of the columns of the lines of an export file.
+
+    Attributes:
+
+      name: a name for display purposes.
+      widths: a tuple of the column widths, in the order of FIELD_NAMES.
+        The tuple has one fewer element if the lines have no
+        reporting_type column.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def has_reporting_type(self):
+        return len(self.widths) == len(FIELD_NAMES)
+
+    @property
+    def line_length(self):
+        """
+        The number of characters in a line, excluding the line ending.
+
+        """
+        return sum(self.widths)
+
+    def get_bounds(self, field_name):
+        """
+        Return the 2-tuple (start, end) of character offsets of a column.
+
+        The end of the reporting_type column is None since that column
+        extends to the end of the line.
+
+        """
+        index = FIELD_NAMES.index(field_name)
+        start = sum(self.widths[:index])
+        if field_name == FIELD_NAMES[-1]:
+            return start, None
+        return start, start + self.widths[index]
+
+    def make_splitter(self):
+        """
+        Return a function that splits a line into a Fields object.
+
+        The values are stripped of surrounding white space.  If a line is
+        longer than the layout, the extra characters are part of the
+        reporting_type value.
+
+        """
+        # We bind the offsets to local variables of a closure, which is
+        # faster than looking them up per line.
+        a, b, c, d, e = (self.get_bounds(name)[1] for name in FIELD_NAMES[:-1])
+        new_tuple = tuple.__new__
+
+        def split_line(line):
+            # Calling tuple.__new__() directly skips the Python-level
+            # __new__() method of the namedtuple.
+            return new_tuple(Fields, (line[:a].strip(), line[a:b].strip(), line[b:c].strip(),
+                                      line[c:d].strip(), line[d:e].strip(), line[e:].strip()))
+
+        return split_line
+
+
+# The layouts used by San Francisco.
+LAYOUT_SIMPLE = LineLayout("simple", (26, 56, 38, 30, 25))
+LAYOUT_COMPLETE = LineLayout("complete", (26, 56, 38, 30, 25, 30))
+
+# The layouts tried when detecting the layout of a file, in order.
+LINE_LAYOUTS = OrderedDict((layout.name, layout) for layout in (LAYOUT_SIMPLE, LAYOUT_COMPLETE))
+
+
+def get_line_layout(spec):
+    """
+    Return the LineLayout object for a layout name in LINE_LAYOUTS or for
+    a comma-separated list of column widths (e.g. "26,56,38,30,25,30").
+
+    """
+    try:
+        return LINE_LAYOUTS[spec]
+    except KeyError:
+        pass
+    try:
+        widths = tuple(int(width) for width in spec.split(","))
+        assert len(widths) in (len(FIELD_NAMES) - 1, len(FIELD_NAMES))
+        assert widths[0] >= DATA_FIELD_MIN_WIDTH
+        assert all(width > 0 for width in widths)
+    except (AssertionError, ValueError):
+        raise Exception("line layout should be one of %s or a list of %d or %d "
+                        "comma-separated column widths: %r" %
+                        (", ".join(LINE_LAYOUTS), len(FIELD_NAMES) - 1, len(FIELD_NAMES), spec))
+    return LineLayout(spec, widths)
+
+
+def check_line(layout, split_line, line):
+    """
+    Return whether a line has the given layout.
+
+    """
+    text = line.rstrip("\r\n")
+    if len(text) != layout.line_length:
+        return False
+    fields = split_line(text)
+    data = fields.data_field
+    if not (len(data) >= DATA_FIELD_MIN_WIDTH and data[0] == "0" and data[1:11].isdigit()):
+        return False
+    if not (fields.contest_name and fields.choice_name and fields.precinct_name):
+        return False
+    try:
+        get_reporting_index(fields.reporting_type)
+    except Exception:
+        return False
+    return True
+
+
+def sniff_layout(lines, layouts=None):
+    """
+    Return the first layout that all of the given lines have.
+
+    Arguments:
+      lines: an iterable of lines from the beginning of a file.
+      layouts: an iterable of LineLayout objects.  Defaults to the
+        values of LINE_LAYOUTS.
+
+    """
+    lines = list(lines)
+    if layouts is None:
+        layouts = LINE_LAYOUTS.values()
+    layouts = list(layouts)
+    for layout in layouts:
+        split_line = layout.make_splitter()
+        if all(check_line(layout, split_line, line) for line in lines):
+            return layout
+    lengths = sorted(set(len(line.rstrip("\r\n")) for line in lines))
+    raise Exception("could not detect the line layout (line lengths: %s).  The known "
+                    "layouts have lengths: %s" %
+                    (", ".join(str(length) for length in lengths),
+                     ", ".join("%d (%s)" % (layout.line_length, layout.name)
+                               for layout in layouts)))
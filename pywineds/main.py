@@ -1,18 +1,34 @@
+import argparse
+from array import array
 from collections import namedtuple, OrderedDict
+import importlib
 import logging
+import os
 import random
 import re
 import sys
+import tempfile
 import yaml
 
-from pywineds.resultswriting import ExcelWriter, TSVWriter
+from pywineds.aggregation import (aggregate_results, AreaMembership, AREA_TYPE_CITY,
+                                  AREA_TYPE_NEIGHBORHOOD, CITY_AREA_ID)
+from pywineds.cache import digest_input_files_cached, DEFAULT_CACHE_SIZE
+from pywineds.incremental import RenderState
+from pywineds.layouts import get_line_layout, sniff_layout, Fields, LAYOUT_COMPLETE, LINE_LAYOUTS
+from pywineds.profiling import profile_cpu, MemoryProfiler, DEFAULT_TOP_COUNT, PROFILE_MODES
+from pywineds.resultswriting import write_results_files, ExcelWriter, TSVWriter
+from pywineds.selection import make_selection
+from pywineds.sqlitewriting import SQLiteWriter
+from pywineds.tables import COLUMNAR_FORMATS
+from pywineds.trusted import TrustOptions, TrustReport, NO_LINE_NO
+from pywineds.watching import WatchConverter
 from pywineds import utils
-from pywineds.utils import assert_equal, get_reporting_index, prettify, time_it, EqualityMixin
+from pywineds.utils import (assert_equal, get_reporting_index, get_reporting_indices, prettify,
+                            record_metrics, time_it, EqualityMixin)
 
 
 FILE_ENCODING = "utf-8"
 DATA_PART_NAMES = ['choice_id', 'contest_number', 'precinct_id', 'vote_total', 'party_code']
-FIELD_NAMES = ['data_field', 'contest_name', 'choice_name', 'precinct_name', 'district_name', 'reporting_type']
 
 # This string contains a mapping from neighborhood labels in the
 # precinct-to-neighborhood file to the more human-friendly names that
@@ -49,7 +65,6 @@ WST ADDITION:WESTERN ADDITION
 _log = logging.getLogger("wineds")
 
 DataField = namedtuple('DataField', DATA_PART_NAMES)
-Fields = namedtuple('Fields', FIELD_NAMES)
 
 
 def configure_log():
@@ -113,14 +128,12 @@ def split_line_fixed(line):
 
     """
     # data_field, contest_name, choice_name, precinct_name, district_name, [reporting_type]
-    data_field = line[:26].strip()
-    contest_name = line[26:82].strip()
-    choice_name = line[82:120].strip()
-    precinct_name = line[120:150].strip()
-    district_name = line[150:175].strip()
-    reporting_type = line[175:].strip()
-    return Fields(data_field, contest_name, choice_name, precinct_name,
-                  district_name, reporting_type)
+    return _split_line_default(line)
+
+
+# The parsers split lines with a function compiled from the layout of
+# the file.  This one is for San Francisco's layouts.
+_split_line_default = LAYOUT_COMPLETE.make_splitter()
 
 
 class Party(EqualityMixin):
@@ -194,6 +207,8 @@ class AreasInfo:
 
       nbhd_names: a dict mapping neighborhood string label to string name.
         For example, "BAYVW/HTRSPT" maps to "BAYVIEW/HUNTERS POINT".
+      membership: an AreaMembership object, i.e. an area x precinct
+        membership matrix, or None if not yet constructed.
 
     """
 
@@ -225,6 +240,9 @@ class AreasInfo:
         self.senate = {}
         self.supervisor = {}
 
+        # An AreaMembership object.  See get_membership().
+        self.membership = None
+
     def get_area_type(self, district_type_name):
         area_attr = self.DISTRICT_TYPE_INFO[district_type_name][0]
         return getattr(self, area_attr)
@@ -233,6 +251,54 @@ class AreasInfo:
         format_str = self.DISTRICT_TYPE_INFO[district_type_name][1]
         return lambda area_id: format_str % area_id
 
+    def get_area_types(self):
+        """
+        Return a list of 2-tuples of: area_type_name, area_type.
+
+        Each area type is a dict mapping area ID to a set of precinct IDs.
+        This includes the city and neighborhood area types.
+
+        """
+        area_types = [(name, self.get_area_type(name)) for name in
+                      sorted(self.DISTRICT_TYPE_INFO.keys())]
+        area_types.extend([
+            (AREA_TYPE_NEIGHBORHOOD, self.neighborhoods),
+            (AREA_TYPE_CITY, {CITY_AREA_ID: self.city}),
+        ])
+        return area_types
+
+    def get_membership(self):
+        """
+        Return an AreaMembership object for the areas returned by
+        get_area_types().
+
+        The object is constructed once, so this should be called only
+        after all precincts have been added.
+
+        """
+        if self.membership is None:
+            self.membership = AreaMembership(self.get_area_types())
+        return self.membership
+
+    def restrict(self, precinct_ids):
+        """
+        Return a new AreasInfo object with only the given precincts, and
+        only the areas containing at least one of them.
+
+        """
+        areas_info = AreasInfo()
+        areas_info.precincts = {precinct_id: name for precinct_id, name in self.precincts.items()
+                                if precinct_id in precinct_ids}
+        areas_info.city = self.city & set(precinct_ids)
+        area_attrs = [info[0] for info in self.DISTRICT_TYPE_INFO.values()] + ["neighborhoods"]
+        for area_attr in area_attrs:
+            areas = getattr(areas_info, area_attr)
+            for area_id, area_precinct_ids in getattr(self, area_attr).items():
+                area_precinct_ids = area_precinct_ids & areas_info.city
+                if area_precinct_ids:
+                    areas[area_id] = area_precinct_ids
+        return areas_info
+
 
 class ElectionMeta:
 
@@ -256,6 +322,11 @@ class ElectionMeta:
         self.undervote_id = None
 
         self.has_reporting_type = None
+        # The LineLayout object of the export file.
+        self.layout = None
+        # If the export file was trusted, a summary of what was validated
+        # (see TrustReport).
+        self.validation = None
 
         self.choices = {}
         self.contests = {}
@@ -274,6 +345,118 @@ class ElectionMeta:
                     precincts=len(self.precincts)))
 
 
+class ContestResults(EqualityMixin):
+
+    """
+    Encapsulates the vote totals for a single contest.
+
+    The totals are stored in a single flat integer array that is laid
+    out as a 3-D array of shape (precincts, reporting types, choices).
+    Precincts and choices are indexed densely in sorted order, and
+    reporting types in the order of reporting_indices.  Totals that do
+    not appear in the export file are zero.
+
+    Attributes:
+
+      choice_ids: a sorted list of the choice IDs of the contest.
+      precinct_ids: a sorted list of the IDs of the precincts
+        participating in the contest.
+      reporting_indices: a tuple of the reporting indices used to
+        subdivide the totals (see the ElectionResults docstring).
+      totals: an array.array of the vote totals.
+
+    """
+
+    equality_attrs = ('choice_ids', 'precinct_ids', 'reporting_indices', 'totals')
+
+    def __init__(self, precinct_ids, choice_ids, reporting_indices):
+        self.choice_ids = sorted(choice_ids)
+        self.precinct_ids = sorted(precinct_ids)
+        self.reporting_indices = tuple(reporting_indices)
+
+        self.choice_index = {choice_id: i for i, choice_id in enumerate(self.choice_ids)}
+        self.precinct_index = {precinct_id: i for i, precinct_id in enumerate(self.precinct_ids)}
+        self.reporting_index = {r_index: i for i, r_index in enumerate(self.reporting_indices)}
+
+        self.choice_count = len(self.choice_ids)
+        self.size = len(self.precinct_ids) * len(self.reporting_indices) * self.choice_count
+        self.totals = array('q', [0]) * self.size
+        # A flag for each total, recording whether it was stored.  This
+        # lets us detect duplicate totals.
+        self.stored = bytearray(self.size)
+
+    def __contains__(self, precinct_id):
+        return precinct_id in self.precinct_index
+
+    def __repr__(self):
+        return ("<ContestResults object: {0} precincts, {1} reporting types, {2} choices>"
+                .format(len(self.precinct_ids), len(self.reporting_indices), self.choice_count))
+
+    def get_offset(self, precinct_id, r_index):
+        """
+        Return the index in the totals array of the first choice total
+        for the given precinct and reporting type.
+
+        """
+        row = self.precinct_index[precinct_id] * len(self.reporting_indices)
+        return (row + self.reporting_index[r_index]) * self.choice_count
+
+    def get_totals(self, precinct_id, r_index):
+        """
+        Return a sequence of the vote totals for a precinct and reporting
+        type, with one total per choice in the order of choice_ids.
+
+        """
+        offset = self.get_offset(precinct_id, r_index)
+        return self.totals[offset:offset + self.choice_count]
+
+    def get_total(self, precinct_id, r_index, choice_id):
+        return self.totals[self.get_offset(precinct_id, r_index) + self.choice_index[choice_id]]
+
+    def set_total(self, precinct_id, r_index, choice_id, vote_total):
+        i = self.get_offset(precinct_id, r_index) + self.choice_index[choice_id]
+        if self.stored[i]:
+            raise Exception("total for key=%d was already stored" % (choice_id, ))
+        self.stored[i] = 1
+        self.totals[i] = vote_total
+
+    def add_records(self, records):
+        """
+        Store the vote totals in an array of records.
+
+        Arguments:
+          records: a flat array of integers, where each consecutive group
+            of RECORD_SIZE integers is a record of the form: precinct_id,
+            r_index, choice_id, vote_total, line_no.
+
+        """
+        # This inlines set_total() since it is called once per line.
+        choice_index = self.choice_index
+        precinct_index = self.precinct_index
+        reporting_index = self.reporting_index
+        reporting_count = len(self.reporting_indices)
+        choice_count = self.choice_count
+        totals = self.totals
+        stored = self.stored
+
+        values = iter(records)
+        for precinct_id, r_index, choice_id, vote_total, line_no in zip(*(RECORD_SIZE * [values])):
+            try:
+                i = ((precinct_index[precinct_id] * reporting_count + reporting_index[r_index]) *
+                     choice_count + choice_index[choice_id])
+                if stored[i]:
+                    raise Exception("total for key=%d was already stored" % (choice_id, ))
+                stored[i] = 1
+                totals[i] = vote_total
+            except:
+                raise Exception("error while storing the total from line %d" % line_no)
+
+
+# The number of integers in a record of a vote total.  See the
+# ContestResults.add_records() docstring.
+RECORD_SIZE = 5
+
+
 class ElectionResults:
 
     """
@@ -281,19 +464,16 @@ class ElectionResults:
 
     Attributes:
 
-      contests: a dictionary, as described below.
+      contests: a dict mapping contest_id to a ContestResults object.
       registered: a dict mapping precinct_id to a registration count.
       voted: a dict mapping precinct_id to a voter count.
-
-    The contests dictionary is a tree-like structure as follows:
-
-      contests[contest_id] -> contest_results
-      contest_results[precinct_id] -> contest_precinct_results
-      contest_precinct_results[choice_id] -> vote_total
+      reporting_indices: an iterable of the keys used within the
+        ContestResults objects and the "voted" dict to subdivide the
+        vote totals by reporting type (e.g. Election Day and VBM).
 
     In particular, to get a vote total for a contest in a precinct:
 
-      results[contest_id][precinct_id][choice_id]
+      results.contests[contest_id].get_total(precinct_id, r_index, choice_id)
 
     """
 
@@ -314,6 +494,9 @@ class ElectionInfo:
         self.meta = meta
         self.results = results
         self.name = name
+        # An ElectionAggregates object.  This is set by convert() before
+        # the results files are written.
+        self.aggregates = None
 
 
 def init_results(info, results):
@@ -325,23 +508,13 @@ def init_results(info, results):
       results: an ElectionResults object.
 
     """
-    contests = results.contests
     registered = results.registered
     voted = results.voted
 
-    reporting_indices = (utils.REPORTING_INDICES_COMPLETE if info.has_reporting_type else
-                         utils.REPORTING_INDICES_SIMPLE)
+    reporting_indices = get_reporting_indices(info.has_reporting_type)
     results.reporting_indices = reporting_indices
 
-    for contest_id, contest_info in sorted(info.contests.items()):
-        contest_results = {}
-        contests[contest_id] = contest_results
-        for precinct_id in contest_info.precinct_ids:
-            # cp_results stands for contest_precinct_results
-            # It is a dict of reporting-type index to: dict of
-            # choice_id to vote total.
-            cp_results = {k: dict() for k in reporting_indices}
-            contest_results[precinct_id] = cp_results
+    init_contests_results(info, results)
 
     # Initialize the election-wide result attributes.
     for precinct_id in info.precincts.keys():
@@ -351,10 +524,57 @@ def init_results(info, results):
     return results
 
 
+def init_contests_results(info, results, contest_records=None):
+    """
+    Construct a ContestResults object for each contest, storing the
+    vote totals in the given records, if provided.
+
+    Arguments:
+      info: an ElectionMeta object.
+      results: an ElectionResults object.
+      contest_records: a dict mapping contest_id to an array of records
+        (see ContestResults.add_records()).
+
+    """
+    if contest_records is None:
+        contest_records = {}
+    contests = results.contests
+    reporting_indices = results.reporting_indices
+    for contest_id, contest_info in sorted(info.contests.items()):
+        contest_results = ContestResults(contest_info.precinct_ids, contest_info.choice_ids,
+                                         reporting_indices)
+        try:
+            records = contest_records[contest_id]
+        except KeyError:
+            pass
+        else:
+            contest_results.add_records(records)
+        contests[contest_id] = contest_results
+
+
+def get_file_size(f):
+    """
+    Return the size in bytes of an open file or memory map, or None if
+    the size is not known (e.g. for an in-memory text stream).
+
+    """
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        return len(f)
+    except TypeError:
+        return None
+
+
 class Parser:
 
     line_no = 0
     line = None
+    # The encoding of the lines passed to parse_line() if they are bytes,
+    # or None if they are strings.
+    line_encoding = None
 
     def log_line(self, msg):
         return '%s:\n>>> [L%d]:"%s"' % (msg, self.line_no, self.line.strip())
@@ -386,6 +606,22 @@ class Parser:
     def parse_line(self, line):
         raise NotImplementedError()
 
+    def select_lines(self, selection, layout):
+        """
+        Skip the lines not belonging to a Selection object without
+        splitting them.
+
+        """
+        parse_line = self.parse_line
+        accept_line = selection.make_line_filter(layout, encoding=self.line_encoding)
+
+        def parse_selected_line(line):
+            if accept_line(line):
+                parse_line(line)
+
+        # This shadows the method that parses each line.
+        self.parse_line = parse_selected_line
+
     def parse_lines(self, lines):
         next(lines)
         self.parse_first_line(self.line)
@@ -393,7 +629,8 @@ class Parser:
             self.parse_line(self.line)
 
     def parse_file(self, f):
-        with time_it("parsing {0}".format(self.name)):
+        with time_it("parsing {0}".format(self.name)) as phase:
+            phase.bytes = get_file_size(f)
             try:
                 with f:
                     lines = self.iter_lines(f)
@@ -401,6 +638,7 @@ class Parser:
             except:
                 raise Exception("error while parsing line %d: %r" %
                                 (self.line_no, self.line))
+            phase.lines = self.line_no
         return self.get_parse_return_value()
 
     def parse_path(self, path):
@@ -494,12 +732,17 @@ class ElectionMetaParser(Parser):
 
     name = "Results File (pass #1, for election metadata)"
 
-    def __init__(self, info):
+    def __init__(self, info, layout=None, selection=None):
         """
         Arguments:
           info: an ElectionMeta object.
+          layout: the LineLayout object of the file, or None to detect
+            the layout from the first line.
+          selection: a resolved Selection object to parse only the lines
+            of some contests and precincts, or None to parse all lines.
 
         """
+        self.selection = selection
         self.election_info = info
         # The following values are for convenience.
         self.contests = info.contests
@@ -508,6 +751,10 @@ class ElectionMetaParser(Parser):
         self.precincts = info.precincts
         self.raw_contests = info.raw_contests
 
+        self.layout = None
+        if layout is not None:
+            self.set_layout(layout)
+
     def make_choice(self, contest_id, choice_name):
         """Create the "choice" object for a given choice name, etc."""
         if choice_name in ('Under Vote', 'Over Vote'):
@@ -526,15 +773,33 @@ class ElectionMetaParser(Parser):
             _log.info("setting id=%r for: %r" % (choice_id, choice_name))
         self.choices[choice_id] = choice
 
+    def add_precinct(self, precinct_id, precinct_name):
+        """Store the precinct if it is new, and return whether it was added."""
+        return utils.add_to_dict(self.precincts, precinct_id, precinct_name, desc="precincts")
+
+    def set_layout(self, layout):
+        self.layout = layout
+        self.split_line = layout.make_splitter()
+        self.election_info.layout = layout
+        self.election_info.has_reporting_type = layout.has_reporting_type
+        if self.selection is not None:
+            self.select_lines(self.selection, layout)
+
+    def detect_format(self, line):
+        """
+        Set the layout of the file if not already given, and return
+        whether the lines have a reporting type.
+
+        """
+        if self.layout is None:
+            self.set_layout(sniff_layout([line]))
+        layout = self.layout
+        _log.info("detected file format: layout=%s, has_reporting_type=%r" %
+                  (layout.name, layout.has_reporting_type))
+        return layout.has_reporting_type
+
     def parse_first_line(self, line):
-        char_count = len(line.rstrip('\r\n'))
-        try:
-            assert char_count in (175, 205)
-        except AssertionError:
-            raise Exception("unexpected number of characters in first line: %d" % char_count)
-        has_reporting_type = (char_count == 205)
-        _log.info("detected file format: has_reporting_type=%r" % has_reporting_type)
-        self.election_info.has_reporting_type = has_reporting_type
+        self.detect_format(line)
         super().parse_first_line(line)
 
     def process_non_district_line(self, contest_number, contest_name, choice_id, choice_name, party_code):
@@ -574,6 +839,14 @@ class ElectionMetaParser(Parser):
 
         assert choice_name == expected_choice_name
 
+    def parse_data(self, data):
+        """Validate and parse the initial data chunk of a line."""
+        # If the party is present in the "data" string, then the length
+        # will be longer than 16.
+        assert len(data) >= 16
+        assert data[0] == '0'
+        return parse_data_chunk(data)
+
     def parse_line(self, line):
         """
         This function parses a single line, validates our assumptions
@@ -587,21 +860,25 @@ class ElectionMetaParser(Parser):
         afterwards.
 
         """
-        fields = split_line_fixed(line)
-        data, contest_name, choice_name, precinct_name, district_name, reporting_type = fields
+        fields = self.split_line(line)
+        self.process_meta(fields, self.parse_data(fields.data_field))
 
-        # Validate our assumptions about the initial data chunk.
-        #
-        # If the party is present in the "data" string, then the length
-        # will be longer than 16.
-        assert len(data) >= 16
-        assert data[0] == '0'
-        choice_id, contest_number, precinct_id, vote_total, party_code = parse_data_chunk(data)
+    def process_meta(self, fields, data):
+        """
+        Validate and store the metadata for an already split line.
+
+        Arguments:
+          fields: a Fields object.
+          data: a DataField object.
+
+        """
+        data_field, contest_name, choice_name, precinct_name, district_name, reporting_type = fields
+        choice_id, contest_number, precinct_id, vote_total, party_code = data
         # We don't need to know the vote_total here.
         del vote_total
 
         # Store the precinct if it is new.
-        utils.add_to_dict(self.precincts, precinct_id, precinct_name, desc="precincts")
+        self.add_precinct(precinct_id, precinct_name)
 
         if not district_name:
             self.process_non_district_line(contest_number, contest_name, choice_id,
@@ -662,13 +939,20 @@ class ResultsParser(Parser):
 
     name = "Results File (pass #2, for vote totals)"
 
-    def __init__(self, results):
+    def __init__(self, results, layout=None, selection=None):
         """
         Arguments:
           results: an ElectionResults object.
+          layout: the LineLayout object of the file.  This is required
+            to call parse_line().
+          selection: see ElectionMetaParser.  This requires layout.
 
         """
-        self.contests = results.contests
+        if layout is not None:
+            self.split_line = layout.make_splitter()
+            if selection is not None:
+                self.select_lines(selection, layout)
+        self.contests_results = results.contests
         self.registered = results.registered
         self.voted = results.voted
 
@@ -689,21 +973,40 @@ class ResultsParser(Parser):
         else:
             raise Exception("total for key=%d was already stored" % (key, ))
 
+    def log_negative_total(self, data):
+        choice_id, contest_number, precinct_id, vote_total, party_code = data
+        text = self.log_line("negative ballot total %d: choice_id=%d, "
+                             "contest_number=%d, precinct_id=%d" %
+                             (vote_total, choice_id, contest_number, precinct_id))
+        _log.warning(text)
+
+    def store_contest_total(self, contest_id, precinct_id, r_index, choice_id, vote_total):
+        contest_results = self.contests_results[contest_id]
+        try:
+            contest_results.set_total(precinct_id, r_index, choice_id, vote_total)
+        except KeyError:
+            raise Exception("precinct or choice not in contest: %r" % (contest_results, ))
+
     def parse_line(self, line):
-        fields = split_line_fixed(line)
+        fields = self.split_line(line)
+        self.process_totals(fields, parse_data_chunk(fields.data_field))
 
-        data_field = fields.data_field
-        reporting_type = fields.reporting_type
-        r_index = get_reporting_index(reporting_type)
+    def process_totals(self, fields, data):
+        """
+        Store the vote total for an already split line.
 
-        choice_id, contest_number, precinct_id, vote_total, party_code = parse_data_chunk(data_field)
+        Arguments:
+          fields: a Fields object.
+          data: a DataField object.
+
+        """
+        r_index = get_reporting_index(fields.reporting_type)
+
+        choice_id, contest_number, precinct_id, vote_total, party_code = data
         contest_id = contest_number, fields.contest_name
 
         if vote_total < 0:
-            text = self.log_line("negative ballot total %d: choice_id=%d, "
-                                 "contest_number=%d, precinct_id=%d" %
-                                 (vote_total, choice_id, contest_number, precinct_id))
-            _log.warning(text)
+            self.log_negative_total(data)
 
         if contest_number in (1, 2) and party_code:
             # For now we don't record totals broken down by party.
@@ -718,27 +1021,177 @@ class ResultsParser(Parser):
             totals_key = r_index
         else:
             # Otherwise, we have a normal contest with candidates.
-            contest_totals = self.contests[contest_id]
-            try:
-                precinct_totals = contest_totals[precinct_id]
-            except KeyError:
-                msg = contest_id
-                raise Exception(repr(contest_totals))
-            totals = precinct_totals[r_index]
-            totals_key = choice_id
+            self.store_contest_total(contest_id, precinct_id, r_index, choice_id, vote_total)
+            return
 
         self.add_vote_total(totals, totals_key, vote_total)
 
 
-def parse_export_file(path):
+class SinglePassParser(ElectionMetaParser, ResultsParser):
+
     """
-    Parse a WinEDS export file, and return an ElectionMeta object.
+    Parser that reads both the election metadata and the vote totals
+    in a single pass over the file.
+
+    This class performs the same validation as ElectionMetaParser and
+    ResultsParser combined.  However, since the precincts and choices of
+    each contest are not known until the end of the file, the parser
+    appends the contest vote totals to a compact array of records for
+    each contest (see ContestResults.add_records()).  After parsing,
+    make_contests_results() converts these to ContestResults objects,
+    which is also when duplicate contest totals are detected.
+
+    If the input is trusted, only a sample of the lines is validated
+    in this way (see the trusted module).
 
     """
-    election_info = ElectionMeta()
-    parser = ElectionMetaParser(election_info)
-    parser.parse_path(path)
 
+    name = "Results File (single pass, for election metadata and vote totals)"
+
+    def __init__(self, info, results, layout=None, trust=None, first_line_no=1,
+                 selection=None):
+        """
+        Arguments:
+          info: an ElectionMeta object.
+          results: an ElectionResults object.
+          layout: see ElectionMetaParser.
+          selection: see ElectionMetaParser.
+          trust: a TrustOptions object to skip validating the lines
+            other than a sample, or None to validate every line.
+          first_line_no: the line number in the file of the first line
+            parsed.  This is added to line numbers when storing records.
+
+        """
+        ElectionMetaParser.__init__(self, info, layout=layout, selection=selection)
+        ResultsParser.__init__(self, results)
+        self.results = results
+        # A dict mapping contest_id to an array of records.
+        self.contest_records = {}
+        self.first_line_no = first_line_no
+
+        self.trust_report = None
+        if trust is not None:
+            self.trust_report = TrustReport(trust)
+            self.sampled_line_nos = trust.iter_sampled_line_nos(first_line_no)
+            self.next_sampled_line_no = next(self.sampled_line_nos, NO_LINE_NO)
+            self.reporting_indices = {}
+            # This shadows the method that validates each line.
+            self.process_line = self.process_trusted_line
+
+    def detect_format(self, line):
+        has_reporting_type = super().detect_format(line)
+        self.results.reporting_indices = get_reporting_indices(has_reporting_type)
+        return has_reporting_type
+
+    def add_precinct(self, precinct_id, precinct_name):
+        added = super().add_precinct(precinct_id, precinct_name)
+        if added:
+            # This is a dict of reporting-type index to ballots cast.
+            self.voted[precinct_id] = {}
+        return added
+
+    def store_contest_total(self, contest_id, precinct_id, r_index, choice_id, vote_total):
+        try:
+            records = self.contest_records[contest_id]
+        except KeyError:
+            records = array('q')
+            self.contest_records[contest_id] = records
+        line_no = self.first_line_no + self.line_no - 1
+        records.extend((precinct_id, r_index, choice_id, vote_total, line_no))
+
+    def make_contests_results(self):
+        """
+        Construct the ContestResults objects from the stored records.
+
+        This should be called after finish_election_meta().
+
+        """
+        with time_it("storing contest vote totals"):
+            init_contests_results(self.election_info, self.results, self.contest_records)
+        self.contest_records = {}
+
+    def process_line(self, fields, data):
+        self.process_meta(fields, data)
+        self.process_totals(fields, data)
+
+    def process_trusted_line(self, fields, data):
+        """
+        Store the metadata and totals of a line without validating it,
+        unless the line is in the sample.
+
+        """
+        report = self.trust_report
+        report.line_count += 1
+
+        choice_id, contest_number, precinct_id, vote_total, party_code = data
+        if contest_number in (1, 2) and not party_code:
+            if contest_number == 1:
+                report.registered_count += 1
+            else:
+                report.voted_count += 1
+
+        line_no = self.first_line_no + self.line_no - 1
+        if line_no >= self.next_sampled_line_no:
+            self.next_sampled_line_no = next(self.sampled_line_nos, NO_LINE_NO)
+            report.validated_count += 1
+            self.process_meta(fields, data)
+            self.process_totals(fields, data)
+            return
+
+        if precinct_id not in self.precincts:
+            self.add_precinct(precinct_id, fields.precinct_name)
+        if vote_total < 0:
+            self.log_negative_total(data)
+
+        reporting_type = fields.reporting_type
+        try:
+            r_index = self.reporting_indices[reporting_type]
+        except KeyError:
+            r_index = get_reporting_index(reporting_type)
+            self.reporting_indices[reporting_type] = r_index
+
+        if contest_number == 1 or contest_number == 2:
+            if party_code:
+                if choice_id not in self.parties:
+                    group_name = fields.contest_name.split(" - ")[1]
+                    self.parties[choice_id] = Party(id=choice_id, code=party_code,
+                                                    name=group_name)
+            elif contest_number == 1:
+                self.registered[precinct_id] = vote_total
+            else:
+                self.voted[precinct_id][r_index] = vote_total
+            return
+
+        contest_id = contest_number, fields.contest_name
+        try:
+            contest = self.contests[contest_id]
+        except KeyError:
+            contest = ContestInfo(fields.contest_name, number=contest_number,
+                                  district_name=fields.district_name, party_code=party_code)
+            self.contests[contest_id] = contest
+        contest.precinct_ids.add(precinct_id)
+        if choice_id not in self.choices:
+            self.save_choice(choice_id, contest_id, fields.choice_name)
+
+        try:
+            records = self.contest_records[contest_id]
+        except KeyError:
+            records = array('q')
+            self.contest_records[contest_id] = records
+        records.extend((precinct_id, r_index, choice_id, vote_total, line_no))
+
+    def parse_line(self, line):
+        fields = self.split_line(line)
+        self.process_line(fields, self.parse_data(fields.data_field))
+
+
+def finish_election_meta(election_info):
+    """
+    Complete an ElectionMeta object after all lines have been parsed.
+
+    This disambiguates contest names and populates contest.choice_ids.
+
+    """
     choices = election_info.choices
     contest_map = election_info.contests
 
@@ -772,11 +1225,24 @@ def parse_export_file(path):
     return election_info
 
 
-def parse_export_file_with_check(areas_info, wineds_path):
-    election_info = parse_export_file(wineds_path)
+def parse_export_file(path, layout=None, selection=None):
+    """
+    Parse a WinEDS export file, and return an ElectionMeta object.
+
+    """
+    election_info = ElectionMeta()
+    parser = ElectionMetaParser(election_info, layout=layout, selection=selection)
+    parser.parse_path(path)
+
+    return finish_election_meta(election_info)
+
 
-    # Check that the precincts in the precinct index file match the
-    # precincts in the results file.
+def check_precincts(areas_info, election_info, wineds_path):
+    """
+    Check that the precincts in the precinct index file match the
+    precincts in the results file.
+
+    """
     for i, (precinct_id, wineds_precinct_id) in enumerate(zip(sorted(areas_info.city),
                                      sorted(election_info.precincts.keys())), start=1):
         try:
@@ -789,17 +1255,35 @@ def parse_export_file_with_check(areas_info, wineds_path):
             msg += ": %s" % wineds_path
             raise Exception(msg)
 
+
+def parse_export_file_with_check(areas_info, wineds_path, layout=None, selection=None):
+    election_info = parse_export_file(wineds_path, layout=layout, selection=selection)
+    check_precincts(areas_info, election_info, wineds_path)
+
     return election_info
 
 
-def digest_input_files(precinct_index_path, wineds_path):
-    """
-    Read the input files and return a 3-tuple of objects of the following
-    classes: ElectionMeta, AreasInfo, ElectionResults.
+def log_contests(election_info):
+    """Log the contests parsed."""
+    contests = election_info.contests
+    _log.info("parsed {0} contests:".format(len(contests)))
+    for i, contest_id in enumerate(sorted(contests.keys()), start=1):
+        contest = contests[contest_id]
+        number = "#{0}".format(i)
+        _log.info(" contest {0:>3}. {1}".format(number, contest.name))
 
+
+def parse_export_two_pass(areas_info, wineds_path, layout=None, selection=None):
     """
-    areas_info = parse_precinct_file(precinct_index_path)
+    Parse a WinEDS export file in two passes, and return a 2-tuple of
+    objects of the following classes: ElectionMeta, ElectionResults.
+
+    Arguments:
+      layout: the LineLayout object of the file, or None to detect it.
+      selection: a resolved Selection object to parse only the lines of
+        some contests and precincts, or None to parse all lines.
 
+    """
     # We parse the file in two passes to simplify the logic and make the
     # code easier to understand.
     #
@@ -817,50 +1301,461 @@ def digest_input_files(precinct_index_path, wineds_path):
     # the object structure.
 
     # Pass #1
-    election_info = parse_export_file_with_check(areas_info, wineds_path)
-
-    # Log the contests parsed.
-    contests = election_info.contests
-    _log.info("parsed {0} contests:".format(len(contests)))
-    for i, contest_id in enumerate(sorted(contests.keys()), start=1):
-        contest = contests[contest_id]
-        number = "#{0}".format(i)
-        _log.info(" contest {0:>3}. {1}".format(number, contest.name))
+    election_info = parse_export_file_with_check(areas_info, wineds_path, layout=layout,
+                                                 selection=selection)
+    log_contests(election_info)
 
     # Construct the results object.
     results = ElectionResults()
-    init_results(election_info, results)
+    with time_it("initializing results"):
+        init_results(election_info, results)
 
     # Pass #2
-    parser = ResultsParser(results)
+    parser = ResultsParser(results, layout=election_info.layout, selection=selection)
     parser.parse_path(wineds_path)
 
+    return election_info, results
+
+
+def parse_export_single_pass(areas_info, wineds_path, layout=None, trust=None,
+                             parser_class=None, selection=None):
+    """
+    Parse a WinEDS export file in a single pass, and return a 2-tuple of
+    objects of the following classes: ElectionMeta, ElectionResults.
+
+    The return value is the same as for parse_export_two_pass().
+
+    Arguments:
+      layout: the LineLayout object of the file, or None to detect it.
+      trust: a TrustOptions object to validate only a sample of the
+        lines, or None to validate every line.
+      parser_class: the SinglePassParser class (or subclass) to use.
+      selection: see parse_export_two_pass().
+
+    """
+    if parser_class is None:
+        parser_class = SinglePassParser
+    election_info = ElectionMeta()
+    results = ElectionResults()
+    parser = parser_class(election_info, results, layout=layout, trust=trust,
+                          selection=selection)
+    parser.parse_path(wineds_path)
+
+    finish_election_meta(election_info)
+    parser.make_contests_results()
+    check_precincts(areas_info, election_info, wineds_path)
+    if trust is not None:
+        election_info.validation = parser.trust_report.log(election_info, results)
+    log_contests(election_info)
+
+    return election_info, results
+
+
+# The available strategies for parsing a WinEDS export file.  Each value
+# is the dotted path to a function that accepts an AreasInfo object, the
+# path to the export file, and an optional "layout" keyword argument (a
+# LineLayout object), and returns a 2-tuple of (ElectionMeta,
+# ElectionResults).  We store paths rather than functions because some
+# engines live in modules that themselves import this module.
+EXPORT_ENGINES = OrderedDict([
+    ("single-pass", "pywineds.main:parse_export_single_pass"),
+    ("two-pass", "pywineds.main:parse_export_two_pass"),
+    ("mmap", "pywineds.byteparsing:parse_export_mmap"),
+    ("parallel", "pywineds.parallel:parse_export_parallel"),
+    ("numpy", "pywineds.vectorized:parse_export_numpy"),
+    ("out-of-core", "pywineds.spilling:parse_export_out_of_core"),
+])
+
+DEFAULT_EXPORT_ENGINE = "single-pass"
+
+# The engines that accept a "trust" keyword argument (a TrustOptions
+# object).
+TRUSTED_INPUT_ENGINES = ("single-pass", "mmap", "parallel", "out-of-core")
+
+# The engines that accept a "selection" keyword argument (a resolved
+# Selection object).
+SELECTING_ENGINES = ("single-pass", "two-pass", "mmap", "parallel", "out-of-core")
+
+
+def get_export_engine(name):
+    """
+    Return the function implementing the export engine with the given name.
+
+    """
+    try:
+        engine_path = EXPORT_ENGINES[name]
+    except KeyError:
+        raise Exception("unknown export engine: %r" % name)
+    module_name, func_name = engine_path.split(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, func_name)
+
+
+def digest_input_files(precinct_index_path, wineds_path, engine=None, jobs=None,
+                       areas_info=None, layout=None, trust=None, memory_budget=None,
+                       spill_dir=None, selection=None):
+    """
+    Read the input files and return a 3-tuple of objects of the following
+    classes: ElectionMeta, AreasInfo, ElectionResults.
+
+    Arguments:
+      areas_info: an AreasInfo object already parsed from the precinct
+        file, or None to parse the precinct file.
+      engine: the name of the strategy to use to parse the export file.
+        See EXPORT_ENGINES for the possible values.  Defaults to
+        DEFAULT_EXPORT_ENGINE, or to "parallel" if jobs is greater than 1.
+      jobs: the number of worker processes for the "parallel" engine.
+      layout: the line layout of the export file (see get_line_layout()
+        for the possible values), or None to detect it.
+      trust: a TrustOptions object to validate only a sample of the
+        lines of the export file, or None to validate every line.
+      memory_budget: the maximum number of bytes of vote total records to
+        hold in memory while parsing, for the "out-of-core" engine.
+        Giving a value selects that engine by default.
+      spill_dir: the directory in which the "out-of-core" engine creates
+        its temporary spill files, or None for the default.
+      selection: a Selection object to parse only the lines of some
+        contests and precincts, or None to parse all lines.  If precincts
+        are selected, the AreasInfo object returned is restricted to
+        those precincts.
+
+    """
+    options = {}
+    if layout is not None:
+        options["layout"] = get_line_layout(layout)
+    if jobs is not None:
+        if jobs < 1:
+            raise Exception("jobs should be a positive integer: %r" % jobs)
+        if engine is None and jobs > 1:
+            engine = "parallel"
+        if engine == "parallel":
+            options["jobs"] = jobs
+        elif jobs > 1:
+            raise Exception("engine %r does not support multiple jobs" % engine)
+    if engine is None:
+        engine = DEFAULT_EXPORT_ENGINE if memory_budget is None else "out-of-core"
+    if memory_budget is not None or spill_dir is not None:
+        if engine != "out-of-core":
+            raise Exception("engine %r does not support a memory budget" % engine)
+        options.update(memory_budget=memory_budget, spill_dir=spill_dir)
+    if trust is not None:
+        if engine not in TRUSTED_INPUT_ENGINES:
+            raise Exception("engine %r does not support trusted input" % engine)
+        options["trust"] = trust
+    if selection is not None and engine not in SELECTING_ENGINES:
+        raise Exception("engine %r does not support selecting contests or precincts" % engine)
+    parse_export = get_export_engine(engine)
+
+    if areas_info is None:
+        areas_info = parse_precinct_file(precinct_index_path)
+    if selection is not None:
+        _log.info("selecting: %s" % selection.describe())
+        selection, areas_info = selection.resolve(areas_info)
+        options["selection"] = selection
+    election_info, results = parse_export(areas_info, wineds_path, **options)
+
     return election_info, areas_info, results
 
 
-def convert(election_name, precincts_path, export_path, output_base, now=None):
-    election_meta, areas_info, results = digest_input_files(precincts_path, export_path)
-    election_info = ElectionInfo(areas_info, election_meta, election_name, results)
+def convert(election_name, precincts_path, export_path, output_base, now=None, engine=None,
+            jobs=None, columnar=None, sqlite=False, cache_dir=None, cache_size=None,
+            incremental=False, areas_info=None, render_state=None, layout=None, trust=None,
+            streaming=False, memory_budget=None, spill_dir=None, selection=None):
+    """
+    Convert the input files, and return a tuple of the paths of the
+    results files written.
 
-    tsv_path = "%s.tsv" % output_base
-    writer = TSVWriter(path=tsv_path, now=now)
-    writer.write(election_info)
+    Arguments:
+      areas_info: an AreasInfo object already parsed from the precinct
+        file, or None to parse the precinct file.
+      render_state: a RenderState object to use and update instead of
+        the one saved for OUTPUT_BASE (e.g. to keep it in memory across
+        conversions).  This is ignored if incremental is true.
+      layout: see digest_input_files().
+      trust: see digest_input_files().
+      memory_budget: see digest_input_files().  If given, the totals of
+        each contest are also aggregated only when the contest is
+        written, so that the writers hold the totals of only one contest
+        at a time.
+      spill_dir: see digest_input_files().
+      selection: see digest_input_files().  Only the selected contests
+        are written, with the rows of the selected precincts.
+      cache_dir: a directory in which to cache snapshots of the parsed
+        input files, or None not to use a cache.
+      cache_size: the maximum total size in bytes of the snapshots in
+        cache_dir.  Defaults to DEFAULT_CACHE_SIZE.
+      incremental: whether to reuse the rendered contests of the previous
+        conversion to the same OUTPUT_BASE for the contests that have not
+        changed.  The rendered contests are saved in "OUTPUT_BASE.state".
+      columnar: the name of a columnar format (see COLUMNAR_FORMATS) in
+        which to also write the results in long form, or None.
+      sqlite: whether to also write the results to an SQLite database
+        file with path "OUTPUT_BASE.sqlite".
+      streaming: whether to write only the TSV file, writing each contest
+        as soon as its lines have been parsed (see the streaming module).
+        If the export file is not grouped by contest, the TSV file is
+        written from memory instead.
 
-    excel_path = "%s.xlsx" % output_base
-    writer = ExcelWriter(path=excel_path, now=now)
-    writer.write(election_info)
+    """
+    tsv_path = "%s.tsv" % output_base
+    if streaming:
+        unsupported = [name for name, value in (
+            # A single job uses no worker processes, as with streaming.
+            ("engine", engine), ("jobs", jobs is not None and jobs > 1),
+            ("columnar", columnar), ("sqlite", sqlite),
+            ("cache_dir", cache_dir), ("incremental", incremental),
+            ("render_state", render_state), ("trust", trust),
+            ("memory_budget", memory_budget), ("spill_dir", spill_dir)) if value]
+        if unsupported:
+            raise Exception("streaming does not support: %s" % ", ".join(unsupported))
+        # pywineds.streaming imports this module, so we import it here.
+        from pywineds.streaming import write_tsv_streaming
+        if areas_info is None:
+            areas_info = parse_precinct_file(precincts_path)
+        writer = TSVWriter(path=tsv_path, now=now)
+        if write_tsv_streaming(writer, areas_info, election_name, export_path,
+                               layout=(None if layout is None else get_line_layout(layout)),
+                               selection=selection):
+            return (tsv_path, )
+        _log.info("export file is not grouped by contest: converting in memory")
+
+    if columnar is not None:
+        # Import this only if needed since PyArrow is an optional
+        # dependency.  We import it before parsing to fail early.
+        from pywineds.columnar import ColumnarWriter
+
+    out_of_core = (engine == "out-of-core" or memory_budget is not None or
+                   spill_dir is not None)
+    if cache_dir is None:
+        election_meta, areas_info, results = digest_input_files(
+            precincts_path, export_path, engine=engine, jobs=jobs, areas_info=areas_info,
+            layout=layout, trust=trust, memory_budget=memory_budget, spill_dir=spill_dir,
+            selection=selection)
+    elif out_of_core:
+        raise Exception("a memory budget cannot be combined with a cache directory")
+    else:
+        election_meta, areas_info, results = digest_input_files_cached(
+            digest_input_files, precincts_path, export_path, cache_dir, max_size=cache_size,
+            engine=engine, jobs=jobs, areas_info=areas_info, layout=layout, trust=trust,
+            selection=selection)
+    election_info = ElectionInfo(areas_info, election_meta, election_name, results)
+    if out_of_core:
+        # pywineds.spilling imports this module, so we import it here.
+        from pywineds.spilling import make_aggregates_on_demand
+        election_info.aggregates = make_aggregates_on_demand(election_info)
+    else:
+        # The totals are computed once and shared by the writers.
+        election_info.aggregates = aggregate_results(election_info)
+
+    if incremental:
+        state_path = "%s.state" % output_base
+        render_state = RenderState.load(state_path)
+    if render_state is not None:
+        render_state.update(election_info)
+
+    # With more than one job, the files are written one at a time, but
+    # the contests of each file are rendered using that many processes.
+    # Passing a single job means not to use worker processes at all.
+    render_jobs = jobs if (jobs is not None and jobs > 1) else None
+    writers = [TSVWriter(path=tsv_path, now=now, jobs=render_jobs, render_state=render_state)]
+    if not streaming:
+        excel_path = "%s.xlsx" % output_base
+        writers.append(ExcelWriter(path=excel_path, now=now, jobs=render_jobs,
+                                   render_state=render_state, constant_memory=out_of_core))
+    # The writers update the render state, so they need to run in this
+    # process in incremental mode.  In out-of-core mode, the results
+    # are read from spill files owned by this process.
+    write_results_files(election_info, writers,
+                        concurrent=(jobs is None and render_state is None and not out_of_core))
+    if incremental:
+        render_state.save(state_path)
+
+    if columnar is not None:
+        writer = ColumnarWriter(output_base, columnar)
+        writer.write(election_info)
+
+    if sqlite:
+        writer = SQLiteWriter("%s.sqlite" % output_base)
+        writer.write(election_info)
+
+    if out_of_core:
+        results.contests.spill_files.close()
+
+    return tuple(writer.path for writer in writers)
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def error(self, message):
+        err = "ERROR: %s" % message
+        exit_with_error("\n".join([err, self.description, err]))
+
+
+def make_arg_parser(docstr):
+    parser = ArgumentParser(prog="wineds-convert", usage=argparse.SUPPRESS, description=docstr,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("election_name", metavar="ELECTION_NAME")
+    parser.add_argument("precincts_path", metavar="PRECINCTS.csv")
+    parser.add_argument("export_path", metavar="WINEDS.txt")
+    parser.add_argument("output_base", metavar="OUTPUT_BASE")
+    parser.add_argument("--engine", choices=list(EXPORT_ENGINES),
+                        help="the strategy to use to parse the export file "
+                             "(default: %s)" % DEFAULT_EXPORT_ENGINE)
+    parser.add_argument("--layout", metavar="LAYOUT",
+                        help="the widths of the columns of the export file, either as one of "
+                             "the names %s, or as a comma-separated list of the widths of the "
+                             "data, contest, choice, precinct, district, and (optional) "
+                             "reporting type columns, e.g. \"26,56,38,30,25,30\".  By "
+                             "default, the layout is detected from the first line." %
+                             ", ".join(LINE_LAYOUTS))
+    parser.add_argument("--jobs", metavar="N", type=int,
+                        help="the number of processes to use.  A value greater than 1 "
+                             "selects the parallel engine and renders the contests of each "
+                             "output file in parallel.  A value of 1 uses no worker "
+                             "processes.  By default, the two output files are written "
+                             "concurrently.")
+    parser.add_argument("--trust-input", action="store_true",
+                        help="skip validating each line of the export file, e.g. for a file "
+                             "already validated by an earlier run.  Aggregate checks are still "
+                             "run, and a report of what was validated is logged.  This is "
+                             "supported by the engines: %s." % ", ".join(TRUSTED_INPUT_ENGINES))
+    parser.add_argument("--validate-every", metavar="N", type=int,
+                        help="with --trust-input, validate every Nth line in full.")
+    parser.add_argument("--validate-fraction", metavar="P", type=float,
+                        help="with --trust-input, validate a random fraction P of the lines "
+                             "in full.")
+    parser.add_argument("--columnar", metavar="FORMAT", choices=COLUMNAR_FORMATS,
+                        help="also write the results in long form as columnar files, "
+                             "one per table, in the given format (%s).  This requires "
+                             "PyArrow (the \"columnar\" extra)." % ", ".join(COLUMNAR_FORMATS))
+    parser.add_argument("--sqlite", action="store_true",
+                        help="also write the results to an SQLite database file, "
+                             "OUTPUT_BASE.sqlite, for ad-hoc queries.")
+    parser.add_argument("--memory-budget", metavar="MB", type=int,
+                        help="parse the export file out of core: whenever the vote totals "
+                             "held in memory reach MB megabytes, move them to temporary spill "
+                             "files, one per contest.  The output files are then written one "
+                             "contest at a time.")
+    parser.add_argument("--spill-dir", metavar="DIR",
+                        help="with --memory-budget, the directory in which to create the "
+                             "temporary spill files (default: the system temporary "
+                             "directory).")
+    parser.add_argument("--contests", metavar="CONTESTS", action="append",
+                        help="convert only the given contests, either as a comma-separated "
+                             "list of contest numbers (e.g. \"120,145\") or as a contest name "
+                             "as in the export file (e.g. \"US Representative, District "
+                             "14\").  This option can be repeated.")
+    parser.add_argument("--precincts", metavar="IDS", action="append",
+                        help="convert only the given comma-separated precinct IDs.  The "
+                             "district and city totals are then totals over these precincts.  "
+                             "This option can be repeated.")
+    parser.add_argument("--district", metavar="TYPE:ID", action="append", dest="districts",
+                        help="convert only the precincts of a district, where TYPE is one of "
+                             "%s, or Neighborhood (e.g. \"Supervisorial:3\" or "
+                             "\"Neighborhood:BAYVW/HTRSPT\").  This option can be repeated, "
+                             "and combined with --precincts." %
+                             ", ".join(sorted(AreasInfo.DISTRICT_TYPE_INFO)))
+    parser.add_argument("--streaming", action="store_true",
+                        help="write only OUTPUT_BASE.tsv, writing each contest as soon as "
+                             "its lines have been parsed and then discarding its totals, so "
+                             "that memory use is bounded by the largest contest.  This "
+                             "requires an export file grouped by contest; otherwise, the "
+                             "file is converted in memory as usual.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="re-render only the contests that changed since the last "
+                             "conversion to the same OUTPUT_BASE (e.g. for successive "
+                             "election-night exports).  The state of the last conversion "
+                             "is saved in OUTPUT_BASE.state.")
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="write the metrics of each phase of the conversion (e.g. wall "
+                             "and CPU time, lines and bytes processed, and growth of peak "
+                             "memory) to a JSON file at PATH.")
+    parser.add_argument("--profile", choices=PROFILE_MODES,
+                        help="profile the conversion.  With \"cpu\", the run is profiled "
+                             "with cProfile, and the statistics are written to "
+                             "OUTPUT_BASE.pstats, with a summary of the functions taking the "
+                             "most time in OUTPUT_BASE.cpu.txt.  With \"mem\", allocations "
+                             "are traced, and the peak memory and top allocation sites of "
+                             "each phase are written to OUTPUT_BASE.mem.txt.  Unless --jobs "
+                             "is given, this runs with one job so that all of the work is "
+                             "profiled.")
+    parser.add_argument("--profile-top", metavar="N", type=int,
+                        help="with --profile, the number of functions or allocation sites "
+                             "to report (default: %d)." % DEFAULT_TOP_COUNT)
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="a directory in which to cache the parsed input files.  "
+                             "Later runs with the same input files load the cached "
+                             "snapshot instead of parsing.")
+    parser.add_argument("--cache-size", metavar="MB", type=int,
+                        help="the maximum total size of the snapshots in the cache "
+                             "directory, in megabytes (default: %d).  The least recently "
+                             "used snapshots are deleted first." % (DEFAULT_CACHE_SIZE // 2 ** 20))
+    return parser
 
-    return tsv_path, excel_path
 
 def inner_main(docstr, argv):
-    try:
-        # TODO: use argparse.
-        election_name, precincts_path, export_path, output_path = argv[1:]
-    except ValueError:
-        err = "ERROR: incorrect number of arguments"
-        exit_with_error("\n".join([err, docstr, err]))
+    parser = make_arg_parser(docstr)
+    args = parser.parse_args(argv[1:])
+
+    trust = None
+    if args.trust_input:
+        try:
+            trust = TrustOptions(every=args.validate_every, fraction=args.validate_fraction)
+        except Exception as err:
+            parser.error(str(err))
+    elif args.validate_every is not None or args.validate_fraction is not None:
+        parser.error("--validate-every and --validate-fraction require --trust-input")
+    if args.spill_dir is not None and args.memory_budget is None:
+        parser.error("--spill-dir requires --memory-budget")
+
+    if args.profile_top is not None and args.profile is None:
+        parser.error("--profile-top requires --profile")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs should be a positive integer")
+    if args.memory_budget is not None and args.memory_budget < 1:
+        parser.error("--memory-budget should be a positive integer")
 
-    convert(election_name, precincts_path, export_path, output_path)
+    try:
+        selection = make_selection(contests=args.contests, precincts=args.precincts,
+                                   districts=args.districts, areas_info=AreasInfo)
+    except Exception as err:
+        parser.error(str(err))
+
+    jobs = args.jobs
+    if args.profile is not None and jobs is None and not args.streaming:
+        # Then do all of the work in this process so that it is profiled.
+        # Streaming already does all of its work in this process.
+        jobs = 1
+
+    def run():
+        with time_it("converting"):
+            convert(args.election_name, args.precincts_path, args.export_path, args.output_base,
+                    engine=args.engine, jobs=jobs, columnar=args.columnar,
+                    sqlite=args.sqlite, cache_dir=args.cache_dir,
+                    cache_size=(None if args.cache_size is None else args.cache_size * 2 ** 20),
+                    incremental=args.incremental, layout=args.layout, trust=trust,
+                    streaming=args.streaming,
+                    memory_budget=(None if args.memory_budget is None else
+                                   args.memory_budget * 2 ** 20),
+                    spill_dir=args.spill_dir, selection=selection)
+
+    recorder = None
+    if args.profile == "mem":
+        recorder = MemoryProfiler(top=args.profile_top)
+    with record_metrics(recorder) as recorder:
+        if args.profile == "cpu":
+            output_base = args.output_base
+            profile_cpu(run, "%s.pstats" % output_base, "%s.cpu.txt" % output_base,
+                        top=args.profile_top)
+        elif args.profile == "mem":
+            with recorder.tracing():
+                run()
+            recorder.write_report("%s.mem.txt" % args.output_base)
+        else:
+            run()
+    if args.metrics_json is not None:
+        recorder.write_json(args.metrics_json)
+        _log.info("wrote metrics: %s" % args.metrics_json)
 
 
 class FilterParser(Parser):
@@ -935,9 +1830,13 @@ def make_test_precincts(args):
     """
     Create a small precinct file for end-to-end testing purposes.
 
+    The optional argument is the seed with which to choose the precincts
+    (default: 0).
+
     """
     _log.info("making test precinct file")
-    assert not args
+    seed, = args or (0, )
+    rng = random.Random(int(seed))
     precincts_path = "data/precincts_2014.csv"
 
     areas_info = parse_precinct_file(precincts_path)
@@ -948,7 +1847,7 @@ def make_test_precincts(args):
     precincts = set((7509, 7527))
     def choose_from_area_type(area_type, precincts):
         for area_precincts in area_type.values():
-            precinct, = random.sample(area_precincts, 1)
+            precinct, = rng.sample(sorted(area_precincts), 1)
             precincts.add(precinct)
 
     # Choose at least one precinct from each district and neighborhood.
@@ -1021,6 +1920,166 @@ def make_test_export(args):
     parser.parse_path(export_path)
 
 
+def make_synthetic(args):
+    """
+    Create a synthetic precinct file and a matching WinEDS export file,
+    e.g. for benchmarks with inputs larger than real ones.
+
+    """
+    # pywineds.synthetic imports this module, so we import it here.
+    from pywineds.synthetic import SyntheticElection
+
+    parser = argparse.ArgumentParser(prog="wineds-convert make_synthetic",
+                                     description=make_synthetic.__doc__)
+    parser.add_argument("precincts_path", metavar="PRECINCTS.csv")
+    parser.add_argument("export_path", metavar="WINEDS.txt")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the seed of the random choices (default: %(default)s)")
+    parser.add_argument("--precincts", metavar="N", type=int, default=600,
+                        dest="precinct_count",
+                        help="the number of precincts (default: %(default)s)")
+    parser.add_argument("--contests", metavar="N", type=int, default=20, dest="contest_count",
+                        help="the number of contests other than the party and duplicate-number "
+                             "contests (default: %(default)s)")
+    parser.add_argument("--choices", metavar="N", type=int, default=4, dest="choice_count",
+                        help="the number of candidates per contest (default: %(default)s)")
+    parser.add_argument("--party-contests", metavar="N", type=int, default=0,
+                        dest="party_contest_count",
+                        help="the number of contest names shared by a contest of each party, "
+                             "which are then prefixed with the party (default: %(default)s)")
+    parser.add_argument("--dupe-number-contests", metavar="N", type=int, default=0,
+                        dest="dupe_number_contest_count",
+                        help="the number of contests sharing the contest number 255 "
+                             "(default: %(default)s)")
+    parser.add_argument("--omit-zeros", action="store_true",
+                        help="omit the lines whose total is zero")
+    parser.add_argument("--negative-fraction", metavar="P", type=float, default=0,
+                        help="the probability that a candidate total is -1 "
+                             "(default: %(default)s)")
+    parser.add_argument("--under-over", action="store_true",
+                        help="give each contest undervote and overvote choices")
+    parser.add_argument("--layout", metavar="LAYOUT", default=LAYOUT_COMPLETE.name,
+                        help="the layout of the export file, as for converting "
+                             "(default: %(default)s)")
+    ns = parser.parse_args(args)
+
+    layout = get_line_layout(ns.layout)
+    options = {name: value for name, value in vars(ns).items()
+               if name not in ("precincts_path", "export_path", "layout")}
+    _log.info("making synthetic election: %r" % options)
+    election = SyntheticElection(**options)
+
+    with open(ns.precincts_path, "w", encoding=FILE_ENCODING) as f:
+        election.write_precincts(f)
+    with time_it("writing synthetic export file"):
+        with open(ns.export_path, "w", encoding=FILE_ENCODING) as f:
+            election.write_export(f, layout=layout)
+    _log.info("wrote: %s and %s" % (ns.precincts_path, ns.export_path))
+
+
+def benchmark(args):
+    """
+    Benchmark converting synthetic datasets of fixed sizes, and check for
+    regressions from a baseline.
+
+    """
+    # pywineds.benchmarking imports this module, so we import it here.
+    from pywineds import benchmarking
+
+    parser = argparse.ArgumentParser(prog="wineds-convert benchmark",
+                                     description=benchmark.__doc__)
+    parser.add_argument("--scales", metavar="NAMES",
+                        default=",".join(benchmarking.DEFAULT_SCALES),
+                        help="a comma-separated list of the benchmarks to run, from: %s "
+                             "(default: %%(default)s)" % ", ".join(benchmarking.BENCHMARK_SCALES))
+    parser.add_argument("--engine", choices=list(EXPORT_ENGINES),
+                        default=benchmarking.DEFAULT_ENGINE,
+                        help="the export engine (default: %(default)s)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=benchmarking.DEFAULT_REPEAT,
+                        help="the number of runs of each benchmark, keeping the best time of "
+                             "each stage (default: %(default)s)")
+    parser.add_argument("--data-dir", metavar="DIR",
+                        help="a directory in which to keep the generated input files for "
+                             "later runs (default: a temporary directory)")
+    parser.add_argument("--output", metavar="PATH", help="write the results as JSON to PATH")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="a JSON file of baseline results to check the results against")
+    parser.add_argument("--threshold", metavar="PCT", type=float,
+                        default=benchmarking.DEFAULT_THRESHOLD,
+                        help="the percentage by which a stage time or peak memory can grow "
+                             "from the baseline before failing (default: %(default)s)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="write the results to the --baseline file instead of checking "
+                             "against it")
+    ns = parser.parse_args(args)
+    if ns.update_baseline and ns.baseline is None:
+        parser.error("--update-baseline requires --baseline")
+
+    baseline = None
+    if ns.baseline is not None and not ns.update_baseline:
+        baseline = benchmarking.read_results(ns.baseline)
+
+    results = benchmarking.run_benchmarks(ns.scales.split(","), data_dir=ns.data_dir,
+                                          engine=ns.engine, repeat=ns.repeat)
+    sys.stdout.write(benchmarking.format_results(results, baseline=baseline))
+    if ns.output is not None:
+        benchmarking.write_results(results, ns.output)
+    if ns.update_baseline:
+        benchmarking.write_results(results, ns.baseline)
+    if baseline is None:
+        return
+
+    regressions = benchmarking.compare_results(results, baseline, threshold=ns.threshold)
+    for regression in regressions:
+        _log.error("regression: %s" % regression)
+    if regressions:
+        exit_with_error("%d regressions beyond %s%% from baseline: %s" %
+                        (len(regressions), ns.threshold, ns.baseline))
+    _log.info("no regressions beyond %s%% from baseline: %s" % (ns.threshold, ns.baseline))
+
+
+def check_equivalence(args):
+    """
+    Check that alternative engines and options give the same parsed
+    results and TSV file as the reference path, on the test_data cases
+    and on random synthetic elections.
+
+    """
+    # pywineds.equivalence imports this module, so we import it here.
+    from pywineds import equivalence
+
+    candidates = equivalence.make_default_candidates()
+    parser = argparse.ArgumentParser(prog="wineds-convert check_equivalence",
+                                     description=check_equivalence.__doc__)
+    parser.add_argument("--candidates", metavar="NAMES",
+                        help="a comma-separated list of the candidates to check, from: %s "
+                             "(default: all)" % ", ".join(c.name for c in candidates))
+    parser.add_argument("--random", metavar="N", type=int, default=10, dest="random_count",
+                        help="the number of random synthetic elections (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the seed of the random elections (default: %(default)s)")
+    parser.add_argument("--no-test-data", action="store_true",
+                        help="do not check the test_data cases")
+    ns = parser.parse_args(args)
+
+    if ns.candidates is not None:
+        candidates_by_name = OrderedDict((c.name, c) for c in candidates)
+        try:
+            candidates = [candidates_by_name[name] for name in ns.candidates.split(",")]
+        except KeyError as err:
+            parser.error("unknown candidate: %s" % err)
+
+    with tempfile.TemporaryDirectory(prefix="wineds-equivalence-") as temp_dir:
+        cases = [] if ns.no_test_data else equivalence.get_test_data_cases()
+        cases += equivalence.make_random_cases(temp_dir, ns.random_count, seed=ns.seed)
+        checker = equivalence.EquivalenceChecker(temp_dir)
+        divergences = checker.check_all(cases, candidates)
+
+    if divergences:
+        exit_with_error("%d divergences from the reference path" % len(divergences))
+    _log.info("all %d candidates are equivalent on %d cases" % (len(candidates), len(cases)))
+
+
 def generate_audited(precinct_names, audit_config):
     for info in audit_config:
         precinct_id = info['precinct_id']
@@ -1103,6 +2162,36 @@ def make_audit(precinct_index_path, tsv_path, yaml_path):
                 break
 
 
+def watch(args):
+    """
+    Convert each new export file dropped into a directory, publishing
+    the output files to the same OUTPUT_BASE.
+
+    """
+    parser = argparse.ArgumentParser(prog="wineds-convert watch", description=watch.__doc__)
+    parser.add_argument("drop_dir", metavar="DIR",
+                        help="the directory into which the export files are dropped")
+    parser.add_argument("--name", metavar="ELECTION_NAME", required=True, dest="election_name",
+                        help='the name of the election, e.g. "November 4, 2014 Election"')
+    parser.add_argument("--precincts", metavar="PRECINCTS.csv", required=True,
+                        dest="precincts_path", help="the path to the precinct index file")
+    parser.add_argument("--output-base", metavar="OUTPUT_BASE",
+                        help="the base path of the output files (default: DIR/results)")
+    ns = parser.parse_args(args)
+    if not os.path.isdir(ns.drop_dir):
+        parser.error("not a directory: %s" % ns.drop_dir)
+    output_base = ns.output_base
+    if output_base is None:
+        output_base = os.path.join(ns.drop_dir, "results")
+
+    # The precinct file is parsed only once.
+    areas_info = parse_precinct_file(ns.precincts_path)
+    areas_info.get_membership()
+    converter = WatchConverter(convert, ns.election_name, ns.precincts_path, output_base,
+                               areas_info)
+    converter.watch(ns.drop_dir)
+
+
 def main(docstr, argv):
     configure_log()
     logging.debug("argv: %r" % argv)
@@ -1117,9 +2206,21 @@ def main(docstr, argv):
         elif command == "make_test_export":
             make_test_export(args)
             return
+        elif command == "make_synthetic":
+            make_synthetic(args)
+            return
+        elif command == "benchmark":
+            benchmark(args)
+            return
+        elif command == "check_equivalence":
+            check_equivalence(args)
+            return
         elif command == "audit":
             make_audit(*args)
             return
+        elif command == "watch":
+            watch(args)
+            return
 
     with time_it("full program"):
         inner_main(docstr, argv)
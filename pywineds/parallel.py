@@ -0,0 +1,289 @@
+"""
+Supports parsing a WinEDS export file in parallel.
+
+The file is divided at line boundaries into byte ranges, and each range
+is parsed in a separate process into partial election metadata and
+partial vote totals.  The partial objects are then merged and validated
+in the parent process.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import mmap
+import os
+
+from pywineds.byteparsing import MmapParser
+from pywineds.main import (check_precincts, finish_election_meta, log_contests, ElectionMeta,
+                           ElectionResults, SinglePassParser, FILE_ENCODING)
+from pywineds import utils
+from pywineds.utils import get_reporting_indices, time_it
+
+
+# The number of bytes to read at a time when counting lines.
+COUNT_BLOCK_SIZE = 2 ** 20
+
+_log = logging.getLogger("wineds")
+
+
+def count_newlines(mapped, start, end):
+    """
+    Return the number of newline characters in a byte range of a file.
+
+    """
+    count = 0
+    for block_start in range(start, end, COUNT_BLOCK_SIZE):
+        block_end = min(block_start + COUNT_BLOCK_SIZE, end)
+        count += mapped[block_start:block_end].count(b"\n")
+    return count
+
+
+def find_chunk_bounds(mapped, count):
+    """
+    Divide a file into at most count ranges that begin and end at line
+    boundaries, and return a list of (start, end) byte offsets.
+
+    Arguments:
+      mapped: an mmap object for the file.
+
+    """
+    size = len(mapped)
+    bounds = []
+    start = 0
+    for i in range(1, count + 1):
+        if start >= size:
+            break
+        # Each chunk should contain at least one line.
+        target = max(size * i // count, start + 1)
+        newline = mapped.find(b"\n", target - 1)
+        end = size if (newline < 0 or i == count) else newline + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+class ChunkParser(MmapParser):
+
+    """
+    Parses the lines in a byte range of a memory-mapped export file.
+
+    Since the line layout is detected from the first line of the file
+    (which need not be in the range), the layout is passed in.
+
+    """
+
+    name = "Results File (chunk)"
+
+    def __init__(self, info, results, layout, start, end, first_line_no, trust=None,
+                 selection=None):
+        """
+        Arguments:
+          layout: the LineLayout object of the file.
+          first_line_no: the line number in the file of the first line
+            in the range.
+
+        """
+        super().__init__(info, results, layout=layout, trust=trust, first_line_no=first_line_no,
+                         selection=selection)
+        self.start = start
+        self.end = end
+
+        results.reporting_indices = get_reporting_indices(layout.has_reporting_type)
+
+    def log_line(self, msg):
+        line = self.line.decode(FILE_ENCODING)
+        line_no = self.first_line_no + self.line_no - 1
+        return '%s:\n>>> [L%d]:"%s"' % (msg, line_no, line.strip())
+
+    def iter_lines(self, f):
+        f.seek(self.start)
+        line_no = 0
+        while f.tell() < self.end:
+            line_no += 1
+            self.line = f.readline()
+            self.line_no = line_no
+            yield
+        _log.info("parsed: %d lines (bytes %d-%d)" % (line_no, self.start, self.end))
+
+    def parse_first_line(self, line):
+        self.parse_line(line)
+
+    def parse_lines(self, lines):
+        try:
+            super().parse_lines(lines)
+        except:
+            # Make the line number relative to the whole file so that
+            # the error message raised by parse_file() is accurate.
+            self.line_no += self.first_line_no - 1
+            raise
+
+
+def parse_chunk(path, start, end, layout, first_line_no, trust=None, selection=None):
+    """
+    Parse a byte range of an export file, and return a 4-tuple of
+    partial results: an ElectionMeta object, an ElectionResults object
+    (without contest results), a dict of contest records (see
+    SinglePassParser), and a TrustReport object (or None if trust is
+    None).
+
+    """
+    meta = ElectionMeta()
+    results = ElectionResults()
+    parser = ChunkParser(meta, results, layout, start=start, end=end,
+                         first_line_no=first_line_no, trust=trust, selection=selection)
+    parser.parse_path(path)
+
+    return meta, results, parser.contest_records, parser.trust_report
+
+
+def merge_meta(parser, partial):
+    """
+    Merge a partial ElectionMeta object into the ElectionMeta object
+    of the given ElectionMetaParser.
+
+    This performs the same consistency checks across chunks that
+    ElectionMetaParser.parse_line() performs across lines.
+
+    """
+    meta = parser.election_info
+    for precinct_id, precinct_name in partial.precincts.items():
+        parser.add_precinct(precinct_id, precinct_name)
+
+    for party_id, party in partial.parties.items():
+        added = utils.add_to_dict(meta.parties, party_id, party)
+        if added:
+            _log.info("added party: {0}".format(party))
+
+    meta.raw_contests.update(partial.raw_contests)
+
+    contests = meta.contests
+    for contest_id, partial_contest in partial.contests.items():
+        try:
+            contest = contests[contest_id]
+        except KeyError:
+            contests[contest_id] = partial_contest
+            continue
+        district_name = partial_contest.district_name
+        try:
+            assert contest.district_name == district_name
+        except AssertionError:
+            raise Exception("district_name=%r, contest.district_name=%s" %
+                            (district_name, contest.district_name))
+        contest.precinct_ids.update(partial_contest.precinct_ids)
+
+    for choice_id, choice in partial.choices.items():
+        contest_id, choice_name = choice
+        try:
+            prior_choice = meta.choices[choice_id]
+        except KeyError:
+            parser.save_choice(choice_id, contest_id, choice_name)
+            continue
+        try:
+            assert choice == prior_choice
+        except AssertionError:
+            raise Exception("choice id %d (name=%r) for contest id %r already assigned to: "
+                            "contest_id=%r, choice_name=%r" %
+                            (choice_id, choice_name, contest_id, prior_choice[0], prior_choice[1]))
+
+
+def merge_results(parser, partial, partial_records):
+    """
+    Merge a partial ElectionResults object and partial contest records
+    into the ElectionResults object and contest records of the given
+    SinglePassParser, checking for duplicate registration and ballots
+    cast totals.
+
+    Duplicate contest totals are detected later, when the ContestResults
+    objects are constructed from the merged records.
+
+    """
+    for precinct_id, total in partial.registered.items():
+        parser.add_vote_total(parser.registered, precinct_id, total)
+
+    voted = parser.voted
+    for precinct_id, partial_voted in partial.voted.items():
+        try:
+            precinct_voted = voted[precinct_id]
+        except KeyError:
+            voted[precinct_id] = partial_voted
+            continue
+        for r_index, total in partial_voted.items():
+            parser.add_vote_total(precinct_voted, r_index, total)
+
+    contest_records = parser.contest_records
+    for contest_id, records in partial_records.items():
+        try:
+            contest_records[contest_id].extend(records)
+        except KeyError:
+            contest_records[contest_id] = records
+
+
+def parse_export_parallel(areas_info, wineds_path, jobs=None, layout=None, trust=None,
+                          selection=None):
+    """
+    Parse a WinEDS export file using a pool of processes.
+
+    The return value is the same as for parse_export_single_pass().
+
+    Arguments:
+      jobs: the number of worker processes.  Defaults to the number
+        of CPUs.
+      layout: the LineLayout object of the file, or None to detect it.
+      trust: a TrustOptions object to validate only a sample of the
+        lines, or None to validate every line.
+      selection: a resolved Selection object to parse only the lines of
+        some contests and precincts, or None to parse all lines.
+
+    """
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    election_info = ElectionMeta()
+    results = ElectionResults()
+    # This parser is used only for its methods that validate and store
+    # values, and not for parsing lines.
+    parser = SinglePassParser(election_info, results, layout=layout, trust=trust)
+
+    with open(wineds_path, "rb") as f:
+        first_line = f.readline()
+        if not first_line:
+            raise Exception("export file is empty: %s" % wineds_path)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapped:
+        bounds = find_chunk_bounds(mapped, jobs)
+        first_line_nos = []
+        line_count = 0
+        for start, end in bounds:
+            first_line_nos.append(line_count + 1)
+            line_count += count_newlines(mapped, start, end)
+
+    parser.detect_format(first_line.decode(FILE_ENCODING))
+
+    with time_it("parsing export file in %d chunks: %s" % (len(bounds), wineds_path)) as phase:
+        phase.lines = line_count
+        phase.bytes = os.path.getsize(wineds_path)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(parse_chunk, wineds_path, start, end, parser.layout,
+                                       first_line_no, trust=trust, selection=selection)
+                       for (start, end), first_line_no in zip(bounds, first_line_nos)]
+            # Merge in file order so that the merged objects are the
+            # same as if the file were parsed sequentially.
+            for chunk_no, ((start, end), future) in enumerate(zip(bounds, futures), start=1):
+                partial_meta, partial_results, partial_records, partial_report = future.result()
+                try:
+                    merge_meta(parser, partial_meta)
+                    merge_results(parser, partial_results, partial_records)
+                    if partial_report is not None:
+                        parser.trust_report.merge(partial_report)
+                except:
+                    raise Exception("while merging chunk #%d (bytes %d-%d)" %
+                                    (chunk_no, start, end))
+
+    finish_election_meta(election_info)
+    parser.make_contests_results()
+    check_precincts(areas_info, election_info, wineds_path)
+    if trust is not None:
+        election_info.validation = parser.trust_report.log(election_info, results)
+    log_contests(election_info)
+
+    return election_info, results
@@ -0,0 +1,157 @@
+"""
+Supports profiling the CPU time and memory allocations of a run.
+
+In CPU mode, the run is wrapped in cProfile, and the statistics are
+dumped to a .pstats file (for e.g. pstats or snakeviz) along with a
+summary of the functions taking the most time.
+
+In memory mode, allocations are traced with tracemalloc, and at the end
+of each phase timed by time_it() (e.g. parsing the precinct file, each
+pass over the export file, and each writer), the peak and current
+traced memory and the top allocation sites are recorded.
+
+Only the allocations and calls of this process are seen, so the
+conversion should be run without worker processes (i.e. with one job).
+
+"""
+
+import cProfile
+from contextlib import contextmanager
+import logging
+import pstats
+import tracemalloc
+
+from pywineds.utils import MetricsRecorder
+
+
+# The default number of functions or allocation sites to report.
+DEFAULT_TOP_COUNT = 20
+
+PROFILE_MODES = ("cpu", "mem")
+
+# The traces to exclude from the allocation sites.
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+_log = logging.getLogger("wineds")
+
+
+def format_size(size):
+    return "%.1f MiB" % (size / 2 ** 20)
+
+
+def profile_cpu(func, stats_path, summary_path, top=None):
+    """
+    Call a function with cProfile enabled, and write the statistics.
+
+    Arguments:
+      stats_path: the path to which to dump the statistics.
+      summary_path: the path to which to write the functions with the
+        most internal time, in descending order.
+      top: the number of functions to summarize.  Defaults to
+        DEFAULT_TOP_COUNT.
+
+    """
+    if top is None:
+        top = DEFAULT_TOP_COUNT
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(stats_path)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats(pstats.SortKey.TIME, pstats.SortKey.CUMULATIVE).print_stats(top)
+        _log.info("wrote CPU profile: %s (summary: %s)" % (stats_path, summary_path))
+
+
+class MemoryProfiler(MetricsRecorder):
+
+    """
+    Records the traced memory of each phase timed by time_it().
+
+    An instance should be passed to record_metrics(), and the phases
+    should run inside tracing().
+
+    Attributes:
+
+      reports: a dict mapping each PhaseMetrics object that ended while
+        tracing to a 3-tuple of: the peak traced memory during the
+        phase, the traced memory at the end of the phase, and a list of
+        tracemalloc.Statistic objects for the top allocation sites at
+        the end of the phase.
+
+    """
+
+    def __init__(self, top=None):
+        super().__init__()
+        if top is None:
+            top = DEFAULT_TOP_COUNT
+        self.top = top
+        self.reports = {}
+        # The peak traced memory of each phase that has not yet ended,
+        # from the outermost to the innermost.
+        self.peaks = []
+
+    @contextmanager
+    def tracing(self):
+        tracemalloc.start()
+        try:
+            yield self
+        finally:
+            tracemalloc.stop()
+
+    def update_peaks(self):
+        """
+        Fold the peak since the last update into the peaks of the
+        phases that have not yet ended.
+
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peaks = [max(phase_peak, peak) for phase_peak in self.peaks]
+        return current
+
+    def begin_phase(self, phase):
+        if not tracemalloc.is_tracing():
+            return
+        self.update_peaks()
+        self.peaks.append(0)
+
+    def end_phase(self, phase):
+        if not tracemalloc.is_tracing():
+            return
+        current = self.update_peaks()
+        peak = self.peaks.pop()
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+        statistics = snapshot.statistics("lineno")[:self.top]
+        del snapshot
+        # Exclude the memory used to take the snapshot.
+        tracemalloc.reset_peak()
+        self.reports[phase] = peak, current, statistics
+
+    def format_report(self):
+        lines = []
+        for phase in self.phases:
+            try:
+                peak, current, statistics = self.reports[phase]
+            except KeyError:
+                continue
+            indent = "  " * phase.depth
+            lines.append("%s%s: peak %s, at end %s" %
+                         (indent, phase.name, format_size(peak), format_size(current)))
+            for stat in statistics:
+                frame = stat.traceback[0]
+                lines.append("%s    %s:%d: %s in %d blocks" %
+                             (indent, frame.filename, frame.lineno, format_size(stat.size),
+                              stat.count))
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.format_report())
+        _log.info("wrote memory profile: %s" % path)
@@ -4,9 +4,13 @@ Supports writing results files.
 
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
+from io import StringIO
+from itertools import repeat
 import logging
+import os
 
 try:
     import xlsxwriter
@@ -15,17 +19,41 @@ except ImportError:
                     "Please follow the setup instructions.")
 
 from pywineds import utils
+from pywineds.aggregation import (aggregate_results, AREA_TYPE_CITY, AREA_TYPE_NEIGHBORHOOD,
+                                  AREA_TYPE_PRECINCT, CITY_AREA_ID)
+from pywineds.backends import ExcelBackend, RecordingBackend, TSVBackend
 from pywineds.utils import (time_it, REPORTING_INDICES_SIMPLE, REPORTING_INDICES_COMPLETE,
                             REPORTING_INDEX_ELD, REPORTING_INDEX_VBM)
 
 
 GRAND_TOTALS_HEADER = "Grand Totals"
-WRITER_DELIMITER = "\t"
 
 log = logging.getLogger(__name__)
 
 
-class ContestWriter(object):
+class RowBuffer(object):
+
+    """
+    Buffers rows and sends them in batches to the backend attribute,
+    which should be a RowBackend object.
+
+    """
+
+    backend = None
+
+    def write_row(self, values):
+        self.rows.append(values)
+
+    def write_ln(self, s=""):
+        self.rows.append((s, ))
+
+    def flush_rows(self):
+        if self.rows:
+            self.backend.write_rows(self.rows)
+        self.rows = []
+
+
+class ContestWriter(RowBuffer):
 
     district_type_names = (
         'Congressional',
@@ -35,19 +63,21 @@ class ContestWriter(object):
         'Supervisorial'
     )
 
-    def __init__(self, info, contest_info, contest_results):
+    def __init__(self, info, contest_info, contest_aggregates, backend):
         """
         Arguments:
 
-          contest_results: a value in the results.contests dictionary,
-            where results is an ElectionResults object.  See the
-            ElectionResults docstring for information on the structure
-            of these values.
+          contest_aggregates: a ContestAggregates object, i.e. a value in
+            the aggregates.contests dictionary, where aggregates is an
+            ElectionAggregates object.
+          backend: the RowBackend object to which to write the rows.
 
         """
+        self.backend = backend
+        self.rows = []
         self.areas_info = info.areas_info
+        self.contest_aggregates = contest_aggregates
         self.contest_info = contest_info
-        self.contest_results = contest_results
         self.election_info = info.meta
         self.results = info.results
         self.sorted_choice_ids = sorted(contest_info.choice_ids)
@@ -84,21 +114,13 @@ class ContestWriter(object):
         values.extend(choice_names)
         self.write_row(values)
 
-    def get_total(self, mapping, key):
-        try:
-            total = mapping[key]
-        except KeyError:
-            # Then the precinct had no total listed for this choice.
-            # So we interpret this as zero.
-            #    Background to this: in June 2014, the results file included
-            # a total for every choice (even if 0), so there was no need for
-            # this except clause.  However, the file provided for November 2014
-            # did not include zero totals (except for "REGISTERED VOTERS - TOTAL"),
-            # which necessitated the logic in this except clause.
-            total = 0
-        return total
-
-    def write_totals_row(self, area_precinct_ids, area_name, area_label, reporting_indices):
+    def format_turnout(self, turnout):
+        if turnout is None:
+            # Then there were no registered voters.
+            return "0.00"
+        return "{:.2%}".format(turnout)[:-1]
+
+    def write_totals_row(self, area_type_name, area_id, area_name, area_label, reporting_indices):
         """
         Write a row for a contest, for a participating district or area.
 
@@ -120,43 +142,13 @@ class ContestWriter(object):
            8) choice #2 vote total
            9) etc.
 
-        Arguments:
-          area_precinct_ids: an iterable of precinct IDs in the given area.
-
         """
-        # Add four extra columns for:
-        # precinct count, registration, ballots cast, and percent turnout.
-        extra_columns = 4
-        choice_ids = self.sorted_choice_ids
-        totals = (extra_columns + len(choice_ids)) * [0]
-        registered = self.results.registered
-        voted = self.results.voted
-
-        contest_results = self.contest_results
-        for precinct_id in area_precinct_ids:
-            try:
-                precinct_results = contest_results[precinct_id]
-            except KeyError:
-                # Then this precinct in the district did not
-                # participate in the contest.
-                continue
-            totals[0] += 1
-            totals[1] += registered[precinct_id]
-            precinct_voted = voted[precinct_id]
-            for r_index in reporting_indices:
-                voted_total = self.get_total(precinct_voted, r_index)
-                totals[2] += voted_total
-
-                for i, choice_id in enumerate(choice_ids, start=extra_columns):
-                    precinct_type_results = precinct_results[r_index]
-                    choice_total = self.get_total(precinct_type_results, choice_id)
-                    totals[i] += choice_total
-
-        assert totals[0] > 0
-        # Prevent division by zero.
-        totals[3] = "0.00" if totals[1] == 0 else "{:.2%}".format(totals[2] / totals[1])[:-1]
+        totals = self.contest_aggregates.get_totals(area_type_name, area_id, reporting_indices)
         values = list(self.make_first_fields(area_name, area_label, reporting_indices))
-        values.extend(totals)
+        values.extend((totals.precinct_count, totals.registered, totals.voted,
+                       self.format_turnout(totals.turnout)))
+        # The choice totals are in the same order as sorted_choice_ids.
+        values.extend(totals.choice_totals)
         self.write_row(values)
 
     def write_grand_totals_row(self, header, reporting_indices=None):
@@ -166,10 +158,10 @@ class ContestWriter(object):
         """
         if reporting_indices is None:
             reporting_indices = self.reporting_indices
-        all_precinct_ids = self.areas_info.city
         # The area ID "City:0" is just a placeholder value so the column
         # value can have the same format as other rows in the summary.
-        self.write_totals_row(all_precinct_ids, header, "City:0", reporting_indices)
+        area_label = "%s:%d" % (AREA_TYPE_CITY, CITY_AREA_ID)
+        self.write_totals_row(AREA_TYPE_CITY, CITY_AREA_ID, header, area_label, reporting_indices)
 
     def write_precincts(self):
         """Write the rows for all precincts."""
@@ -181,19 +173,18 @@ class ContestWriter(object):
     def write_post_precincts(self, header):
         pass
 
-    def write_area_rows(self, area_type, area_type_name, make_area_name, area_ids):
-        contest_precinct_ids = self.precinct_ids
+    def write_area_rows(self, area_type_name, make_area_name, area_ids):
+        contest_aggregates = self.contest_aggregates
         for area_id in area_ids:
             area_name = make_area_name(area_id)
             area_label = "%s:%s" % (area_type_name, area_id)
-            area_precinct_ids = area_type[area_id]
-            assert type(area_precinct_ids) is set
-            if area_precinct_ids.isdisjoint(contest_precinct_ids):
+            if (area_type_name, area_id) not in contest_aggregates:
                 # Then no precincts in the district overlapped the contest, so skip it.
                 log.debug("  skipping area: contest has no precincts in: %s" % (area_name, ))
                 continue
             try:
-                self.write_totals_row(area_precinct_ids, area_name, area_label, self.reporting_indices)
+                self.write_totals_row(area_type_name, area_id, area_name, area_label,
+                                      self.reporting_indices)
             except:
                 raise Exception("while processing area: %s" % area_name)
 
@@ -208,7 +199,7 @@ class ContestWriter(object):
         area_type = areas_info.get_area_type(district_type_name)
         make_area_name = areas_info.get_area_name_function(district_type_name)
         area_ids = sorted(area_type.keys())
-        self.write_area_rows(area_type, district_type_name, make_area_name, area_ids)
+        self.write_area_rows(district_type_name, make_area_name, area_ids)
 
     def write_precinct_report(self):
         self.write_ln("Precinct Totals")
@@ -232,11 +223,10 @@ class ContestWriter(object):
         # Alphabetize the pairs by the full name and not the label.
         nbhd_pairs = sorted(nbhd_pairs, key=lambda pair: pair[1])
 
-        neighborhoods_area = self.areas_info.neighborhoods
         make_nbhd_name = lambda nbhd_id: nbhd_names[nbhd_id]
         nbhd_ids = [pair[0] for pair in nbhd_pairs]
 
-        self.write_area_rows(neighborhoods_area, "Neighborhood", make_nbhd_name, nbhd_ids)
+        self.write_area_rows(AREA_TYPE_NEIGHBORHOOD, make_nbhd_name, nbhd_ids)
         self.write_grand_totals_row(GRAND_TOTALS_HEADER)
 
     def write(self):
@@ -247,22 +237,24 @@ class ContestWriter(object):
         # TODO: move this assertion earlier in the script?
         assert type(self.precinct_ids) is set
         contest_title = "%s - %s (%d)" % (contest_name, contest_info.district_name, contest_info.number)
-        self.write_contest_start(contest_title)
+        self.rows.extend(self.backend.make_contest_start_rows(contest_title))
         self.write_precinct_report()
         self.write_ln()
+        # Send the rows to the backend one report section at a time.
+        self.flush_rows()
         # Repeat the contest title for the convenience of people looking
         # at the district summary.
         self.write_ln(contest_title)
         self.write_district_report()
+        self.flush_rows()
 
 
 class SimpleContestWriter(ContestWriter):
 
     def write_precinct(self, precinct_id, precinct_name):
         """Write the row or rows for a single precinct."""
-        # Convert precinct_id into an iterable with one element in order
-        # to use write_totals_row().
-        self.write_totals_row((precinct_id, ), precinct_name, precinct_id, REPORTING_INDICES_SIMPLE)
+        self.write_totals_row(AREA_TYPE_PRECINCT, precinct_id, precinct_name, precinct_id,
+                              REPORTING_INDICES_SIMPLE)
 
 
 class CompleteContestWriter(ContestWriter):
@@ -285,26 +277,52 @@ class CompleteContestWriter(ContestWriter):
     def write_precinct(self, precinct_id, precinct_name):
         """Write the row or rows for a single precinct."""
         for r_index in REPORTING_INDICES_COMPLETE:
-            self.write_totals_row((precinct_id, ), precinct_name, precinct_id, (r_index, ))
+            self.write_totals_row(AREA_TYPE_PRECINCT, precinct_id, precinct_name, precinct_id,
+                                  (r_index, ))
 
     def write_post_precincts(self, header):
         for r_index in REPORTING_INDICES_COMPLETE:
             self.write_grand_totals_row(GRAND_TOTALS_HEADER, (r_index, ))
 
 
-class ResultsWriter(object):
+class ResultsWriter(RowBuffer):
+
+    def __init__(self, path, now=None, jobs=None, render_state=None):
+        """
+        Arguments:
+          jobs: the number of worker processes to use to render the
+            contests.  If None or 1, the contests are rendered in this
+            process.
+          render_state: a RenderState object whose rendered contests
+            should be reused and updated, or None.
 
-    def __init__(self, path, now=None):
+        """
         if now is None:
             now = datetime.now()
+        self.jobs = jobs
         self.path = path
         self.now = now
+        self.render_state = render_state
+        self.rows = []
+
+    @classmethod
+    def get_writer_class(cls, info):
+        return CompleteContestWriter if info.meta.has_reporting_type else SimpleContestWriter
 
     def write(self, info):
-        with time_it("writing output file: %s" % self.name):
+        if info.aggregates is None:
+            info.aggregates = aggregate_results(info)
+        with time_it("writing output file: %s" % self.name) as phase:
             with self.writer():
                 self.write_start(info)
-                self.write_contests(info)
+                self.flush_rows()
+                if self.render_state is not None:
+                    self.write_contests_incremental(info)
+                elif self.jobs is not None and self.jobs > 1:
+                    self.write_contests_rendered(info)
+                else:
+                    self.write_contests(info)
+            phase.bytes = os.path.getsize(self.path)
 
     def write_header(self, info):
         self.write_ln(info.name)
@@ -317,114 +335,177 @@ class ResultsWriter(object):
                        now.day,  # strftime lacks an option not to zero-pad the month.
                        now.strftime("%Y at %I:%M:%S %p")))
 
+    @classmethod
+    def make_contest_writer(cls, info, contest_id, backend):
+        contest_info = info.meta.contests[contest_id]
+        contest_aggregates = info.aggregates.contests[contest_id]
+        writer_cls = cls.get_writer_class(info)
+        return writer_cls(info, contest_info, contest_aggregates, backend)
+
     def write_contests(self, info):
         contests_info = info.meta.contests
-        contests_results = info.results.contests
 
         for contest_id in sorted(contests_info.keys()):
-            contest_info = contests_info[contest_id]
-            contest_results = contests_results[contest_id]
+            try:
+                backend = self.make_contest_backend(contests_info[contest_id])
+                contest_writer = self.make_contest_writer(info, contest_id, backend)
+                contest_writer.write()
+            except:
+                raise Exception("while processing contest: %s" % contests_info[contest_id].name)
 
-            writer_cls = self.get_writer_class(info)
+    def iter_rendered_contests(self, info, contest_ids):
+        """
+        Render the given contests, and return an iterator over the values
+        to pass to write_rendered_contest(), in the same order.
+
+        If jobs is greater than 1, the contests are rendered in a pool of
+        worker processes.
+
+        """
+        if self.jobs is None or self.jobs <= 1:
+            for contest_id in contest_ids:
+                try:
+                    rendered = self.render_contest(info, contest_id)
+                except:
+                    raise Exception("while processing contest: %s" %
+                                    info.meta.contests[contest_id].name)
+                yield rendered
+            return
+
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_render_worker,
+                                 initargs=(info, )) as executor:
+            # Since map() returns the results in order, the contests are
+            # reassembled in the same order as in write_contests().
+            yield from executor.map(render_contest, repeat(type(self)), contest_ids)
+
+    def write_rendered_contests(self, info, contest_ids, rendered_contests):
+        contests_info = info.meta.contests
+        for contest_id, rendered in zip(contest_ids, rendered_contests):
+            contest_info = contests_info[contest_id]
             try:
-                contest_writer = writer_cls(info, contest_info, contest_results)
-                self.write_contest(contest_writer)
+                self.write_rendered_contest(contest_info, rendered)
             except:
                 raise Exception("while processing contest: %s" % contest_info.name)
 
+    def write_contests_rendered(self, info):
+        """
+        Render the contests in a pool of worker processes, and write them
+        in sorted order.
 
-class TSVMixin(object):
+        """
+        contest_ids = sorted(info.meta.contests.keys())
+        rendered_contests = self.iter_rendered_contests(info, contest_ids)
+        self.write_rendered_contests(info, contest_ids, rendered_contests)
 
-    def write_ln(self, s=""):
-        print(s, file=self.file)
+    def write_contests_incremental(self, info):
+        """
+        Write the contests in sorted order, rendering only the contests
+        without a rendered block in render_state.
 
-    def write_row(self, values):
-        self.write_ln(WRITER_DELIMITER.join([str(v) for v in values]))
+        """
+        contest_ids = sorted(info.meta.contests.keys())
+        blocks = self.render_state.get_blocks(self.name)
+        changed_ids = [contest_id for contest_id in contest_ids if contest_id not in blocks]
+        log.info("rendering %d of %d contests (%s)" % (len(changed_ids), len(contest_ids),
+                                                       self.name))
+        blocks.update(zip(changed_ids, self.iter_rendered_contests(info, changed_ids)))
+        rendered_contests = (blocks[contest_id] for contest_id in contest_ids)
+        self.write_rendered_contests(info, contest_ids, rendered_contests)
 
-    def write_contest_start(self, contest_title):
-        # Begin each contest with a distinctive string.  We use 3 stars.
-        # Doing this makes it easier for people to both (1) search through
-        # the CSV (e.g. by using COMMAND+F or CTRL+F), and (2) parse the
-        # file with a script (since it gives people an easy way to find
-        # where the lines for each contest start).
-        self.write_ln("*** %s" % contest_title)
 
+# The ElectionInfo object of a render worker process.  This is set once
+# per process rather than passed with each contest.
+_render_info = None
 
-class TSVSimpleContestWriter(SimpleContestWriter, TSVMixin):
-    pass
 
+def init_render_worker(info):
+    global _render_info
+    _render_info = info
 
-class TSVCompleteContestWriter(CompleteContestWriter, TSVMixin):
-    pass
 
+def render_contest(results_writer_cls, contest_id):
+    """
+    Render a contest in a render worker process, and return the value
+    to pass to the ResultsWriter object's write_rendered_contest().
 
-class TSVWriter(ResultsWriter, TSVMixin):
+    """
+    info = _render_info
+    try:
+        return results_writer_cls.render_contest(info, contest_id)
+    except:
+        raise Exception("while processing contest: %s" % info.meta.contests[contest_id].name)
+
+
+class TSVWriter(ResultsWriter):
 
     name = "TSV"
 
-    def get_writer_class(self, info):
-        return TSVCompleteContestWriter if info.meta.has_reporting_type else TSVSimpleContestWriter
+    @classmethod
+    def render_contest(cls, info, contest_id):
+        """
+        Return the text of a contest.
+
+        """
+        with StringIO() as f:
+            cls.make_contest_writer(info, contest_id, TSVBackend(f)).write()
+            return f.getvalue()
 
     @contextmanager
     def writer(self):
         with open(self.path, "w", encoding='utf-8') as f:
-            self.file = f
+            self.backend = TSVBackend(f)
             yield self
 
     def write_start(self, info):
         self.write_header(info)
 
-    def write_contest(self, contest_writer):
-        self.write_ln()
-        self.write_ln()
-        contest_writer.file = self.file
-        contest_writer.write()
-
+    def make_contest_backend(self, contest_info):
+        self.backend.write_rows([("", ), ("", )])
+        return self.backend
 
-class ExcelMixin(object):
+    def write_rendered_contest(self, contest_info, text):
+        self.make_contest_backend(contest_info).write_text(text)
 
-    row_index = 0
 
-    def write_row(self, values):
-        self.worksheet.write_row(self.row_index, 0, values)
-        self.row_index += 1
-
-    def write_ln(self, s=""):
-        self.write_row((s, ))
+class ExcelWriter(ResultsWriter):
 
-    def write_contest_start(self, contest_title):
-        self.write_ln(contest_title)
-        self.write_ln()
-
-
-class ExcelSimpleContestWriter(SimpleContestWriter, ExcelMixin):
-    pass
-
-
-class ExcelCompleteContestWriter(CompleteContestWriter, ExcelMixin):
-    pass
+    name = "Excel"
 
+    def __init__(self, path, constant_memory=False, **kwargs):
+        """
+        Arguments:
+          constant_memory: whether XlsxWriter should write each row to a
+            temporary file as soon as the next row is started, rather than
+            keeping the whole workbook in memory until it is closed.
 
-class ExcelWriter(ResultsWriter, ExcelMixin):
+        """
+        super().__init__(path, **kwargs)
+        self.constant_memory = constant_memory
 
-    name = "Excel"
+    @classmethod
+    def render_contest(cls, info, contest_id):
+        """
+        Return a list of the rows of cell values of a contest worksheet.
 
-    def get_writer_class(self, info):
-        return ExcelCompleteContestWriter if info.meta.has_reporting_type else ExcelSimpleContestWriter
+        """
+        backend = RecordingBackend()
+        cls.make_contest_writer(info, contest_id, backend).write()
+        return backend.rows
 
     @contextmanager
     def writer(self):
-        workbook = xlsxwriter.Workbook(self.path)
+        workbook = xlsxwriter.Workbook(self.path, {"constant_memory": self.constant_memory})
         self.workbook = workbook
         yield self
-        with time_it("cleaning up Excel file"):
+        with time_it("cleaning up Excel file") as phase:
             workbook.close()
+            phase.bytes = os.path.getsize(self.path)
 
     def write_start(self, info):
         workbook = self.workbook
         contests_info = info.meta.contests
         worksheet = workbook.add_worksheet("Contents")
-        self.worksheet = worksheet
+        self.backend = ExcelBackend(worksheet)
 
         self.write_header(info)
 
@@ -436,14 +517,63 @@ class ExcelWriter(ResultsWriter, ExcelMixin):
             contest_info = contests_info[contest_id]
             self.write_row((contest_info.number, contest_info.name))
 
-    def write_contest(self, contest_writer):
-        workbook = self.workbook
-        contest_info = contest_writer.contest_info
-
+    def make_contest_backend(self, contest_info):
         name = "%d - %s" % (contest_info.number, contest_info.name)
         # Worksheet names must be 31 characters or less.
         name = name[:31]
-        worksheet = workbook.add_worksheet(name)
-
-        contest_writer.worksheet = worksheet
-        contest_writer.write()
+        worksheet = self.workbook.add_worksheet(name)
+        return ExcelBackend(worksheet)
+
+    def write_rendered_contest(self, contest_info, rows):
+        self.make_contest_backend(contest_info).write_rows(rows)
+
+
+def write_results_file(writer, info):
+    """
+    Write a results file using the given ResultsWriter object.
+
+    This is a module-level function so that it can be run in a worker
+    process.
+
+    """
+    writer.write(info)
+    return writer.path
+
+
+def write_results_files(info, writers, concurrent=True):
+    """
+    Write results files from the same ElectionInfo object, and return a
+    list of the paths written.
+
+    Arguments:
+      writers: an iterable of ResultsWriter objects.
+      concurrent: whether to run each writer in its own process.  Since
+        the totals are computed before the processes start, the processes
+        only format and write rows.
+
+    """
+    writers = list(writers)
+    # Compute the totals in this process so that they are shared with
+    # the worker processes rather than computed in each.
+    if info.aggregates is None:
+        info.aggregates = aggregate_results(info)
+
+    if not concurrent or len(writers) < 2:
+        return [write_results_file(writer, info) for writer in writers]
+
+    with time_it("writing %d output files concurrently" % len(writers)):
+        with ProcessPoolExecutor(max_workers=len(writers)) as executor:
+            # The phases of each writer are recorded in its process and
+            # returned along with the path.
+            futures = [executor.submit(utils.call_recording_metrics, write_results_file,
+                                       writer, info) for writer in writers]
+            paths = []
+            for writer, future in zip(writers, futures):
+                try:
+                    path, phases = future.result()
+                except:
+                    raise Exception("while writing output file: %s" % writer.name)
+                paths.append(path)
+                utils.add_phases(phases)
+
+    return paths
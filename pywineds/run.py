@@ -1,5 +1,5 @@
 """
-Usage: wineds-convert ELECTION_NAME PRECINCTS.csv WINEDS.txt OUTPUT_BASE
+Usage: wineds-convert [OPTIONS] ELECTION_NAME PRECINCTS.csv WINEDS.txt OUTPUT_BASE
 
 Parses the given files and writes a new output file to stdout.
 
@@ -25,6 +25,8 @@ Arguments:
 
 In the above, relative paths will be interpreted as relative to the
 current working directory.
+
+For the available OPTIONS, see the list below.
 """
 
 import sys
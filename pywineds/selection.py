@@ -0,0 +1,233 @@
+"""
+Supports converting only some of the contests or precincts.
+
+A Selection object describes the contests and precincts to convert.
+Rather than parsing every line and discarding the unselected values
+afterwards, the parsers skip the lines of unselected contests and
+precincts before splitting them into fields.  A line is checked using
+only slices of the raw line: the contest number and precinct ID digits
+of the initial data chunk, and the contest name column.  The contests
+and precincts of the skipped lines are then never stored, so no results
+structures are allocated for them and no rows are rendered for them.
+
+The registered voter and ballots cast lines (contests 1 and 2) of the
+selected precincts are always kept since they are needed for turnout.
+
+When precincts are selected, the AreasInfo object is restricted to those
+precincts, so that the district, neighborhood, and city totals are
+totals over the selected precincts.
+
+"""
+
+from collections import namedtuple
+
+
+# The contest numbers of the registered voter and ballots cast lines.
+TOTALS_CONTEST_NUMBERS = (1, 2)
+
+# The slices of a line containing the digits of the contest number and
+# precinct ID (see parse_data_chunk() in main.py).
+CONTEST_NUMBER_SLICE = slice(1, 4)
+PRECINCT_ID_SLICE = slice(7, 11)
+
+# The name of the neighborhood area type in district selectors.
+NEIGHBORHOOD_TYPE_NAME = "Neighborhood"
+
+
+class Selection(namedtuple('Selection', ['contest_numbers', 'contest_names', 'precinct_ids',
+                                         'districts'])):
+
+    """
+    Describes the contests and precincts to convert.
+
+    Attributes:
+
+      contest_numbers: a tuple of the numbers of the contests to select.
+      contest_names: a tuple of the names of the contests to select, as
+        in the export file (i.e. without any party prefix).
+      precinct_ids: a tuple of the IDs of the precincts to select, or
+        None to select all precincts unless districts are given.
+      districts: a tuple of 2-tuples (district type name, area ID) of
+        the districts whose precincts to select.
+
+    If both contest_numbers and contest_names are empty, all contests
+    are selected.  The tuples are sorted so that equal selections have
+    equal string representations (e.g. for cache keys).
+
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, contest_numbers=(), contest_names=(), precinct_ids=None, districts=()):
+        if precinct_ids is not None:
+            precinct_ids = tuple(sorted(set(precinct_ids)))
+        return super().__new__(cls, tuple(sorted(set(contest_numbers))),
+                               tuple(sorted(set(contest_names))), precinct_ids,
+                               tuple(sorted(set(districts))))
+
+    @property
+    def selects_contests(self):
+        return bool(self.contest_numbers or self.contest_names)
+
+    @property
+    def selects_precincts(self):
+        return self.precinct_ids is not None or bool(self.districts)
+
+    def describe(self):
+        parts = []
+        if self.contest_numbers:
+            parts.append("contest numbers %s" % ", ".join(str(n) for n in self.contest_numbers))
+        if self.contest_names:
+            parts.append("contests %s" % ", ".join(repr(name) for name in self.contest_names))
+        if self.precinct_ids is not None:
+            parts.append("%d precincts" % len(self.precinct_ids))
+        if self.districts:
+            parts.append("districts %s" % ", ".join("%s %s" % district
+                                                    for district in self.districts))
+        return "; ".join(parts)
+
+    def resolve(self, areas_info):
+        """
+        Return a 2-tuple of: a Selection object whose districts are
+        replaced by their precincts, and an AreasInfo object restricted
+        to the selected precincts.
+
+        """
+        if not self.selects_precincts:
+            return self, areas_info
+        precinct_ids = set()
+        if self.precinct_ids is not None:
+            unknown_ids = set(self.precinct_ids) - areas_info.city
+            if unknown_ids:
+                raise Exception("unknown precinct IDs: %s" %
+                                ", ".join(str(precinct_id) for precinct_id in
+                                          sorted(unknown_ids)))
+            precinct_ids.update(self.precinct_ids)
+        for type_name, area_id in self.districts:
+            if type_name == NEIGHBORHOOD_TYPE_NAME:
+                areas = areas_info.neighborhoods
+            else:
+                areas = areas_info.get_area_type(type_name)
+            try:
+                precinct_ids.update(areas[area_id])
+            except KeyError:
+                raise Exception("unknown %s district: %r" % (type_name, area_id))
+        selection = self._replace(precinct_ids=tuple(sorted(precinct_ids)), districts=())
+        return selection, areas_info.restrict(precinct_ids)
+
+    def make_line_filter(self, layout, encoding=None):
+        """
+        Return a function that accepts a line of the export file and
+        returns whether the line belongs to the selection.
+
+        This should be called only after resolve().
+
+        Arguments:
+          layout: the LineLayout object of the file.
+          encoding: the encoding of the file if the lines are bytes, or
+            None if the lines are strings.
+
+        """
+        assert not self.districts
+        precinct_keys = None
+        if self.precinct_ids is not None:
+            precinct_keys = {"%04d" % precinct_id for precinct_id in self.precinct_ids}
+        number_keys = None
+        if self.selects_contests:
+            number_keys = {"%03d" % number for number in
+                           TOTALS_CONTEST_NUMBERS + self.contest_numbers}
+        names = set(self.contest_names)
+        name_slice = slice(*layout.get_bounds("contest_name"))
+
+        text_filter = None
+        if encoding is not None:
+            text_filter = self.make_line_filter(layout)
+            if precinct_keys is not None:
+                precinct_keys = {key.encode(encoding) for key in precinct_keys}
+            if number_keys is not None:
+                number_keys = {key.encode(encoding) for key in number_keys}
+            names = {name.encode(encoding) for name in names}
+
+        def accept_line(line):
+            if precinct_keys is not None and line[PRECINCT_ID_SLICE] not in precinct_keys:
+                return False
+            if number_keys is None or line[CONTEST_NUMBER_SLICE] in number_keys:
+                return True
+            if not names:
+                return False
+            if text_filter is not None and not line.isascii():
+                # The column offsets are character offsets, so we check
+                # the name using the decoded line.
+                return text_filter(line.decode(encoding))
+            return line[name_slice].strip() in names
+
+        return accept_line
+
+
+def parse_contest_selectors(specs):
+    """
+    Return a 2-tuple (contest_numbers, contest_names) for a list of
+    contest selectors.
+
+    Each selector is either a comma-separated list of contest numbers
+    (e.g. "120,145") or a contest name (e.g. "US Representative,
+    District 14").
+
+    """
+    numbers, names = [], []
+    for spec in specs:
+        parts = [part.strip() for part in spec.split(",")]
+        if all(part.isdigit() for part in parts):
+            numbers.extend(int(part) for part in parts)
+        else:
+            names.append(spec.strip())
+    return numbers, names
+
+
+def parse_district_selector(spec, areas_info):
+    """
+    Return the 2-tuple (district type name, area ID) for a district
+    selector of the form TYPE:ID (e.g. "Supervisorial:3" or
+    "Neighborhood:BAYVW/HTRSPT").
+
+    The type name is case-insensitive.
+
+    """
+    type_names = sorted(areas_info.DISTRICT_TYPE_INFO) + [NEIGHBORHOOD_TYPE_NAME]
+    try:
+        type_name, area_id = spec.split(":", 1)
+        type_name, = (name for name in type_names if name.lower() == type_name.strip().lower())
+        area_id = area_id.strip()
+        if type_name != NEIGHBORHOOD_TYPE_NAME:
+            area_id = int(area_id)
+    except ValueError:
+        raise Exception("district should have the form TYPE:ID, where TYPE is one of %s: %r" %
+                        (", ".join(type_names), spec))
+    return type_name, area_id
+
+
+def make_selection(contests=None, precincts=None, districts=None, areas_info=None):
+    """
+    Return a Selection object for lists of command-line selectors, or
+    None if none are given.
+
+    Arguments:
+      contests: a list of contest selectors (see parse_contest_selectors()).
+      precincts: a list of comma-separated lists of precinct IDs.
+      districts: a list of district selectors (see
+        parse_district_selector()).
+      areas_info: an AreasInfo object (or class) for the district types.
+
+    """
+    if not (contests or precincts or districts):
+        return None
+    contest_numbers, contest_names = parse_contest_selectors(contests or [])
+    precinct_ids = None
+    if precincts:
+        try:
+            precinct_ids = [int(part) for spec in precincts for part in spec.split(",")]
+        except ValueError:
+            raise Exception("precincts should be comma-separated precinct IDs: %r" % precincts)
+    districts = [parse_district_selector(spec, areas_info) for spec in districts or []]
+    return Selection(contest_numbers=contest_numbers, contest_names=contest_names,
+                     precinct_ids=precinct_ids, districts=districts)
@@ -0,0 +1,237 @@
+"""
+Supports converting export files that do not fit in memory.
+
+The single-pass parser keeps the records of every contest's vote totals
+in memory until the end of the file.  In out-of-core mode, the parser
+instead appends the records to one spill file per contest whenever the
+records held in memory reach a memory budget.  After parsing, the
+ContestResults object of a contest is constructed from its spill file
+only when the contest is accessed, and the totals of each contest are
+aggregated only when the contest is written.  The results writers then
+hold the totals of only one contest at a time.
+
+"""
+
+from array import array
+from collections.abc import Mapping
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+
+from pywineds.aggregation import aggregate_contest, ElectionAggregates
+from pywineds.main import (parse_export_single_pass, ContestResults, SinglePassParser,
+                           RECORD_SIZE)
+
+
+# The default maximum number of bytes of records to hold in memory while
+# parsing.
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+
+_log = logging.getLogger("wineds")
+
+
+class SpillFiles(object):
+
+    """
+    Stores the records of each contest in a file of its own, in a
+    temporary directory that is deleted along with this object.
+
+    """
+
+    def __init__(self, spill_dir=None):
+        """
+        Arguments:
+          spill_dir: the directory in which to create the temporary
+            directory, or None for the default temporary directory.
+
+        """
+        self.dir_path = tempfile.mkdtemp(prefix="wineds-spill-", dir=spill_dir)
+        self.cleanup = weakref.finalize(self, shutil.rmtree, self.dir_path, ignore_errors=True)
+        # A dict mapping contest_id to the path of its spill file.
+        self.paths = {}
+
+    def get_path(self, contest_id):
+        try:
+            return self.paths[contest_id]
+        except KeyError:
+            pass
+        path = os.path.join(self.dir_path, "%d.records" % len(self.paths))
+        self.paths[contest_id] = path
+        return path
+
+    def append(self, contest_id, records):
+        with open(self.get_path(contest_id), "ab") as f:
+            records.tofile(f)
+
+    def load(self, contest_id):
+        """
+        Return an array of the records of a contest.
+
+        """
+        records = array('q')
+        try:
+            path = self.paths[contest_id]
+        except KeyError:
+            return records
+        with open(path, "rb") as f:
+            records.frombytes(f.read())
+        return records
+
+    def close(self):
+        self.cleanup()
+
+
+class SpilledContests(Mapping):
+
+    """
+    A read-only mapping from contest_id to ContestResults object that
+    constructs each ContestResults object from its spill file on access.
+
+    Duplicate totals in the export file are detected on access rather
+    than after parsing.
+
+    """
+
+    def __init__(self, election_meta, reporting_indices, spill_files):
+        self.contests_info = election_meta.contests
+        self.reporting_indices = reporting_indices
+        self.spill_files = spill_files
+
+    def __getitem__(self, contest_id):
+        contest_info = self.contests_info[contest_id]
+        contest_results = ContestResults(contest_info.precinct_ids, contest_info.choice_ids,
+                                         self.reporting_indices)
+        contest_results.add_records(self.spill_files.load(contest_id))
+        return contest_results
+
+    def __iter__(self):
+        return iter(self.contests_info)
+
+    def __len__(self):
+        return len(self.contests_info)
+
+
+class AggregatesOnDemand(Mapping):
+
+    """
+    A read-only mapping from contest_id to ContestAggregates object that
+    aggregates each contest on access, keeping only the last one.
+
+    """
+
+    def __init__(self, info, aggregates):
+        self.aggregates = aggregates
+        self.membership = info.areas_info.get_membership()
+        self.results = info.results
+        self.last_item = None
+
+    def __getitem__(self, contest_id):
+        if self.last_item is not None and self.last_item[0] == contest_id:
+            return self.last_item[1]
+        # Release the last contest before loading the next.
+        self.last_item = None
+        contest_results = self.results.contests[contest_id]
+        contest_aggregates = aggregate_contest(self.aggregates, self.membership, self.results,
+                                               contest_results)
+        self.last_item = contest_id, contest_aggregates
+        return contest_aggregates
+
+    def __iter__(self):
+        return iter(self.results.contests)
+
+    def __len__(self):
+        return len(self.results.contests)
+
+
+def make_aggregates_on_demand(info):
+    """
+    Return an ElectionAggregates object whose contests attribute is an
+    AggregatesOnDemand object.
+
+    """
+    aggregates = ElectionAggregates(info.results.reporting_indices)
+    aggregates.contests = AggregatesOnDemand(info, aggregates)
+    return aggregates
+
+
+class SpillingParser(SinglePassParser):
+
+    """
+    Single-pass parser that moves the records of the contest vote totals
+    to spill files whenever the records held reach a maximum.
+
+    """
+
+    name = "Results File (single pass, spilling to disk)"
+
+    def __init__(self, info, results, spill_files, memory_budget=None, **kwargs):
+        """
+        Arguments:
+          spill_files: a SpillFiles object.
+          memory_budget: the maximum number of bytes of records to hold
+            in memory.  Defaults to DEFAULT_MEMORY_BUDGET.
+
+        """
+        super().__init__(info, results, **kwargs)
+        if memory_budget is None:
+            memory_budget = DEFAULT_MEMORY_BUDGET
+        elif memory_budget < 1:
+            raise Exception("memory_budget should be a positive integer: %r" % memory_budget)
+        self.spill_files = spill_files
+        self.max_records = max(1, memory_budget // (RECORD_SIZE * array('q').itemsize))
+
+    def iter_lines(self, f):
+        # Since each line adds at most one record, we spill after every
+        # max_records lines rather than counting the records.
+        lines_left = self.max_records
+        for x in super().iter_lines(f):
+            yield
+            lines_left -= 1
+            if not lines_left:
+                self.spill()
+                lines_left = self.max_records
+
+    def spill(self):
+        """
+        Append the records held in memory to the spill files.
+
+        """
+        spill_files = self.spill_files
+        for contest_id, records in self.contest_records.items():
+            spill_files.append(contest_id, records)
+        self.contest_records = {}
+
+    def make_contests_results(self):
+        self.spill()
+        _log.info("spilled the totals of %d contests to: %s" %
+                  (len(self.spill_files.paths), self.spill_files.dir_path))
+        self.results.contests = SpilledContests(self.election_info,
+                                                self.results.reporting_indices,
+                                                self.spill_files)
+
+
+def parse_export_out_of_core(areas_info, wineds_path, layout=None, trust=None,
+                             memory_budget=None, spill_dir=None, selection=None):
+    """
+    Parse a WinEDS export file using SpillingParser.
+
+    The return value is the same as for parse_export_single_pass(),
+    except that the contests attribute of the ElectionResults object is
+    a SpilledContests object.  The spill files are deleted along with
+    that object.
+
+    Arguments:
+      memory_budget: see SpillingParser.
+      spill_dir: see SpillFiles.
+
+    """
+    spill_files = SpillFiles(spill_dir)
+
+    def make_parser(info, results, **kwargs):
+        return SpillingParser(info, results, spill_files, memory_budget=memory_budget,
+                              **kwargs)
+
+    return parse_export_single_pass(areas_info, wineds_path, layout=layout, trust=trust,
+                                    parser_class=make_parser, selection=selection)
@@ -0,0 +1,182 @@
+"""
+Supports writing election results to an SQLite database file.
+
+The database contains the election metadata, the precinct memberships
+of each area, and the vote totals, so that area totals can be computed
+with indexed SQL queries.  For example, to get the vote totals of each
+choice of contest 16 in Supervisorial District 5, by reporting type--
+
+    SELECT choices.name, votes.reporting_type, SUM(votes.votes)
+    FROM votes
+    JOIN area_precincts USING (precinct_id)
+    JOIN areas USING (area_key)
+    JOIN contests USING (contest_key)
+    JOIN choices USING (choice_id)
+    WHERE contests.number = 16 AND areas.area_type = 'Supervisorial'
+      AND areas.area_id = '5'
+    GROUP BY choices.choice_id, votes.reporting_type;
+
+"""
+
+import os
+import sqlite3
+
+from pywineds.tables import REPORTING_TYPE_NAMES
+from pywineds.utils import time_it
+
+
+SCHEMA = """
+CREATE TABLE contests (
+    contest_key INTEGER PRIMARY KEY,
+    number INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    raw_name TEXT NOT NULL,
+    district_name TEXT NOT NULL,
+    party_code TEXT NOT NULL
+);
+CREATE TABLE choices (
+    choice_id INTEGER PRIMARY KEY,
+    contest_key INTEGER REFERENCES contests,
+    name TEXT NOT NULL
+);
+CREATE TABLE precincts (
+    precinct_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    registered INTEGER
+);
+CREATE TABLE areas (
+    area_key INTEGER PRIMARY KEY,
+    area_type TEXT NOT NULL,
+    area_id TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE TABLE area_precincts (
+    area_key INTEGER NOT NULL REFERENCES areas,
+    precinct_id INTEGER NOT NULL
+);
+CREATE TABLE ballots_cast (
+    precinct_id INTEGER NOT NULL,
+    reporting_type TEXT NOT NULL,
+    ballots_cast INTEGER NOT NULL
+);
+CREATE TABLE votes (
+    contest_key INTEGER NOT NULL REFERENCES contests,
+    precinct_id INTEGER NOT NULL,
+    reporting_type TEXT NOT NULL,
+    choice_id INTEGER NOT NULL REFERENCES choices,
+    votes INTEGER NOT NULL
+);
+"""
+
+# The indexes are created after the rows are inserted since that is
+# faster than updating them with each insert.
+INDEXES = """
+CREATE INDEX choices_contest ON choices (contest_key);
+CREATE UNIQUE INDEX areas_area ON areas (area_type, area_id);
+CREATE INDEX area_precincts_area ON area_precincts (area_key, precinct_id);
+CREATE INDEX area_precincts_precinct ON area_precincts (precinct_id, area_key);
+CREATE INDEX ballots_cast_precinct ON ballots_cast (precinct_id);
+CREATE INDEX votes_contest ON votes (contest_key, precinct_id);
+CREATE INDEX votes_precinct ON votes (precinct_id);
+"""
+
+
+def iter_area_rows(areas_info):
+    """
+    Yield a 4-tuple for each area of: area_key, area_type, area_id, name.
+
+    The area keys are the row indices of the AreaMembership object.
+
+    """
+    nbhd_names = areas_info.nbhd_names
+    membership = areas_info.get_membership()
+    for area_key, (area_type_name, area_id) in enumerate(membership.area_keys):
+        if area_type_name in areas_info.DISTRICT_TYPE_INFO:
+            name = areas_info.get_area_name_function(area_type_name)(area_id)
+        else:
+            name = nbhd_names.get(area_id, area_type_name)
+        yield area_key, area_type_name, str(area_id), name
+
+
+def iter_area_precinct_rows(areas_info):
+    membership = areas_info.get_membership()
+    for precinct_id in membership.precinct_ids:
+        for area_key in membership.get_area_rows(precinct_id):
+            yield area_key, precinct_id
+
+
+def iter_vote_rows(info, contest_keys):
+    contests_results = info.results.contests
+    for contest_id, contest_key in contest_keys.items():
+        contest_results = contests_results[contest_id]
+        choice_ids = contest_results.choice_ids
+        for precinct_id in contest_results.precinct_ids:
+            for r_index in contest_results.reporting_indices:
+                reporting_type = REPORTING_TYPE_NAMES[r_index]
+                totals = contest_results.get_totals(precinct_id, r_index)
+                for choice_id, total in zip(choice_ids, totals):
+                    yield contest_key, precinct_id, reporting_type, choice_id, total
+
+
+def iter_ballots_cast_rows(info):
+    results = info.results
+    for precinct_id, precinct_voted in sorted(results.voted.items()):
+        for r_index in results.reporting_indices:
+            # A missing total means zero, as in the other results files.
+            yield precinct_id, REPORTING_TYPE_NAMES[r_index], precinct_voted.get(r_index, 0)
+
+
+class SQLiteWriter(object):
+
+    name = "SQLite"
+
+    def __init__(self, path):
+        self.path = path
+
+    def insert_rows(self, connection, info):
+        meta = info.meta
+        results = info.results
+        areas_info = info.areas_info
+
+        # Number the contests in sorted order.
+        contest_keys = {contest_id: contest_key for contest_key, contest_id in
+                        enumerate(sorted(meta.contests.keys()), start=1)}
+        connection.executemany(
+            "INSERT INTO contests VALUES (?, ?, ?, ?, ?, ?)",
+            ((contest_keys[contest_id], contest.number, contest.name, contest.raw_name,
+              contest.district_name, contest.party_code)
+             for contest_id, contest in sorted(meta.contests.items())))
+        # Each choices value is a 2-tuple of (contest_id, choice_name).
+        # The contest_id is None for the "Under Vote" and "Over Vote"
+        # choices, which are shared by all contests.
+        connection.executemany(
+            "INSERT INTO choices VALUES (?, ?, ?)",
+            ((choice_id, contest_keys.get(contest_id), choice_name)
+             for choice_id, (contest_id, choice_name) in sorted(meta.choices.items())))
+        connection.executemany(
+            "INSERT INTO precincts VALUES (?, ?, ?)",
+            ((precinct_id, precinct_name, results.registered.get(precinct_id))
+             for precinct_id, precinct_name in sorted(meta.precincts.items())))
+        connection.executemany("INSERT INTO areas VALUES (?, ?, ?, ?)",
+                               iter_area_rows(areas_info))
+        connection.executemany("INSERT INTO area_precincts VALUES (?, ?)",
+                               iter_area_precinct_rows(areas_info))
+        connection.executemany("INSERT INTO ballots_cast VALUES (?, ?, ?)",
+                               iter_ballots_cast_rows(info))
+        connection.executemany("INSERT INTO votes VALUES (?, ?, ?, ?, ?)",
+                               iter_vote_rows(info, contest_keys))
+
+    def write(self, info):
+        with time_it("writing output file: %s" % self.name):
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            connection = sqlite3.connect(self.path)
+            try:
+                connection.executescript(SCHEMA)
+                # The connection context manager commits the inserts in a
+                # single transaction.
+                with connection:
+                    self.insert_rows(connection, info)
+                connection.executescript(INDEXES)
+            finally:
+                connection.close()
@@ -0,0 +1,199 @@
+"""
+Supports writing the TSV results file while parsing the export file.
+
+WinEDS export files are normally grouped by contest: the registered
+voter and ballots cast lines come first, followed by the lines of each
+contest in turn.  For such a file, a contest's block of the TSV file can
+be written as soon as the contest's last line is read, after which the
+contest's vote totals are discarded.  The memory used for vote totals
+is then bounded by the largest contest rather than by the whole
+election.
+
+If a file turns out not to be grouped in this way, streaming stops, and
+the caller falls back to converting in memory.
+
+"""
+
+import logging
+
+from pywineds.aggregation import aggregate_contest, ElectionAggregates
+from pywineds.main import (check_precincts, finish_election_meta, log_contests, ContestResults,
+                           ElectionInfo, ElectionMeta, ElectionResults, SinglePassParser)
+from pywineds.utils import time_it
+
+
+_log = logging.getLogger("wineds")
+
+
+class StreamingParser(SinglePassParser):
+
+    """
+    Single-pass parser that hands off each contest as soon as the
+    contest's lines end.
+
+    The contests must occur in sorted order, which is the order of the
+    results files, and the lines of each contest must be contiguous.
+    Otherwise, or if a registered voter or ballots cast line follows a
+    contest, streaming stops: the remaining lines are skipped, and the
+    stop_reason attribute says why.
+
+    """
+
+    name = "Results File (single pass, streaming contests)"
+
+    def __init__(self, info, results, handle_contest, layout=None, selection=None):
+        """
+        Arguments:
+          handle_contest: a function that accepts a contest_id and the
+            contest's ContestResults object.  The contest's ContestInfo
+            object is then complete, except that the contest name has not
+            been disambiguated (see finish_election_meta()).
+
+        """
+        super().__init__(info, results, layout=layout, selection=selection)
+        self.handle_contest = handle_contest
+        # The contest_id of the contest whose lines are being read.
+        self.contest_id = None
+        # The IDs of the choices seen in the lines of that contest.
+        self.contest_choice_ids = set()
+        # A dict mapping the contest_id of each contest handed off to the
+        # 2-tuple (name, choice_ids) the contest was handed off with.
+        self.handled = {}
+        # The IDs of the undervote and overvote choices, which apply to
+        # all contests.
+        self.shared_choice_ids = set()
+        self.stop_reason = None
+
+    def stop(self, reason):
+        self.stop_reason = reason
+        _log.info("stopped streaming contests: %s" % reason)
+        # This shadows the method that parses each line.
+        self.parse_line = self.skip_line
+
+    def skip_line(self, line):
+        pass
+
+    def save_choice(self, choice_id, contest_id, choice_name):
+        super().save_choice(choice_id, contest_id, choice_name)
+        if self.choices[choice_id][0] is None:
+            self.shared_choice_ids.add(choice_id)
+
+    def add_vote_total(self, totals, key, vote_total):
+        if self.contest_id is not None:
+            self.stop("a registered voter or ballots cast line follows a contest")
+            return
+        super().add_vote_total(totals, key, vote_total)
+
+    def store_contest_total(self, contest_id, precinct_id, r_index, choice_id, vote_total):
+        if contest_id != self.contest_id:
+            # Every contest handed off sorts before the current contest,
+            # so this also detects contests whose lines are not contiguous.
+            if self.contest_id is not None and contest_id < self.contest_id:
+                self.stop("contest %r follows contest %r" % (contest_id, self.contest_id))
+                return
+            self.finish_contest()
+            self.contest_id = contest_id
+        self.contest_choice_ids.add(choice_id)
+        super().store_contest_total(contest_id, precinct_id, r_index, choice_id, vote_total)
+
+    def finish_contest(self):
+        """
+        Hand off the current contest, if any, and discard its records.
+
+        """
+        contest_id = self.contest_id
+        if contest_id is None:
+            return
+        contest = self.contests[contest_id]
+        contest.choice_ids.update(self.contest_choice_ids, self.shared_choice_ids)
+        self.contest_choice_ids = set()
+
+        records = self.contest_records.pop(contest_id)
+        contest_results = ContestResults(contest.precinct_ids, contest.choice_ids,
+                                         self.results.reporting_indices)
+        try:
+            contest_results.add_records(records)
+        except:
+            raise Exception("while processing contest: %s" % contest.name)
+
+        self.handled[contest_id] = contest.name, frozenset(contest.choice_ids)
+        self.handle_contest(contest_id, contest_results)
+
+    def finish(self):
+        """
+        Hand off the last contest and complete the ElectionMeta object.
+
+        This should be called after parsing.  Streaming stops if a
+        contest already handed off changed after it was handed off (e.g.
+        if its name needed a party prefix, or if an undervote choice
+        first occurred in a later contest).
+
+        """
+        if self.stop_reason is not None:
+            return
+        self.finish_contest()
+        finish_election_meta(self.election_info)
+        for contest_id, (name, choice_ids) in self.handled.items():
+            contest = self.contests[contest_id]
+            if contest.name != name or contest.choice_ids != choice_ids:
+                self.stop("contest %r changed after it was written" % (contest_id, ))
+                return
+
+
+def write_tsv_streaming(writer, areas_info, election_name, wineds_path, layout=None,
+                        selection=None):
+    """
+    Write a TSV results file while parsing the export file, and return
+    whether the file was written.
+
+    If False is returned, the export file is not grouped by contest, and
+    the partially written file should be overwritten by converting in
+    memory.  Since the contests are written before the end of the file is
+    reached, the precincts are checked against the precinct file only
+    after writing.
+
+    Arguments:
+      writer: a TSVWriter object.
+      layout: the LineLayout object of the file, or None to detect it.
+      selection: a Selection object to write only some contests and
+        precincts, or None.
+
+    """
+    if selection is not None:
+        selection, areas_info = selection.resolve(areas_info)
+    election_meta = ElectionMeta()
+    results = ElectionResults()
+    info = ElectionInfo(areas_info, election_meta, election_name, results)
+    membership = areas_info.get_membership()
+
+    def write_contest(contest_id, contest_results):
+        if info.aggregates is None:
+            info.aggregates = ElectionAggregates(results.reporting_indices)
+        aggregates = info.aggregates
+        contest_info = election_meta.contests[contest_id]
+        try:
+            aggregates.contests[contest_id] = aggregate_contest(aggregates, membership, results,
+                                                                contest_results)
+            backend = writer.make_contest_backend(contest_info)
+            writer.make_contest_writer(info, contest_id, backend).write()
+        except:
+            raise Exception("while processing contest: %s" % contest_info.name)
+        # Only the metadata of the contest is kept.
+        del aggregates.contests[contest_id]
+
+    parser = StreamingParser(election_meta, results, write_contest, layout=layout,
+                             selection=selection)
+    with time_it("writing output file while parsing: %s" % writer.name):
+        with writer.writer():
+            writer.write_start(info)
+            writer.flush_rows()
+            parser.parse_path(wineds_path)
+            parser.finish()
+
+    if parser.stop_reason is not None:
+        return False
+
+    check_precincts(areas_info, election_meta, wineds_path)
+    log_contests(election_meta)
+
+    return True
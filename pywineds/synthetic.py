@@ -0,0 +1,335 @@
+"""
+Supports generating synthetic input files, e.g. for scale benchmarks.
+
+A SyntheticElection object describes a made-up election in the shape of
+a San Francisco election: precincts assigned to districts and
+neighborhoods, and contests that are either city-wide or limited to a
+district.  It writes a precinct file with the same columns as
+data/precincts_2014.csv and a matching WinEDS export file in a given
+line layout.
+
+All choices are made with a random.Random object seeded from the given
+seed, so the same arguments always produce the same files.
+
+The sizes are limited by the export format: precinct IDs have four
+digits, choice IDs (which are unique across contests) have three, and
+contest numbers have three.  As in WinEDS, contests beyond contest
+number 254 can share the number 255.
+
+"""
+
+from collections import namedtuple
+import random
+
+from pywineds.layouts import LAYOUT_COMPLETE
+from pywineds.main import make_nbhd_names
+
+
+PRECINCT_HEADER = ("VotingPrecinctID,VotingPrecinctName,MailBallotPrecinct,BalType,Assembly,"
+                   "BART,Congressional,Neighborhood,Senatorial,Supervisorial")
+
+# The IDs of the districts of each district type, as in San Francisco.
+DISTRICT_IDS = {
+    "Assembly": (17, 19),
+    "BART": (7, 8, 9),
+    "Congressional": (12, 14),
+    "Senatorial": (11, ),
+    "Supervisorial": tuple(range(1, 12)),
+}
+
+# The formats of the contest and district names of the contests of
+# each district type.
+DISTRICT_CONTEST_FORMATS = {
+    "Assembly": ("State Assembly, District %d", "%s ASSEMBLY DISTRICT"),
+    "BART": ("BART Director, District %d", "BART DISTRICT %d"),
+    "Congressional": ("US Representative, District %d", "%s CONGRESSIONAL DISTRICT"),
+    "Senatorial": ("State Senator, District %d", "%s SENATORIAL DISTRICT"),
+    "Supervisorial": ("Board of Supervisors, District %d", "SUPERVISORIAL DISTRICT %d"),
+}
+
+CITY_DISTRICT_NAME = "CITY/COUNTY OF SAN FRANCISCO"
+
+# The party codes and names of the parties of the party contests, and
+# the codes used for the candidates of the other contests.
+PARTIES = (("DEM", "Democratic"), ("REP", "Republican"))
+CANDIDATE_PARTY_CODES = ("DEM", "REP", "GRN", "LIB", "NPP", "")
+
+# The first and last contest numbers, other than the duplicate number.
+FIRST_CONTEST_NUMBER = 3
+LAST_CONTEST_NUMBER = 254
+DUPLICATE_CONTEST_NUMBER = 255
+
+FIRST_PRECINCT_ID = 1001
+MAX_PRECINCT_ID = 9999
+# The maximum choice ID.  Choice ID 1 is used by the registered voter
+# and ballots cast lines.
+MAX_CHOICE_ID = 999
+
+REPORTING_TYPES_COMPLETE = ("TC-Election Day Reporting", "TC-VBM Reporting")
+
+Contest = namedtuple('Contest', ['number', 'name', 'district_name', 'party_code',
+                                 'precinct_ids', 'choices'])
+
+
+def make_ordinal(number):
+    if 10 <= number % 100 <= 20:
+        suffix = "TH"
+    else:
+        suffix = {1: "ST", 2: "ND", 3: "RD"}.get(number % 10, "TH")
+    return "%d%s" % (number, suffix)
+
+
+def format_vote_total(vote_total):
+    return "000-1" if vote_total < 0 else "%05d" % vote_total
+
+
+class SyntheticElection(object):
+
+    """
+    A made-up election with the given numbers of precincts, contests,
+    and choices.
+
+    """
+
+    def __init__(self, seed=0, precinct_count=600, contest_count=20, choice_count=4,
+                 party_contest_count=0, dupe_number_contest_count=0, omit_zeros=False,
+                 negative_fraction=0, under_over=False):
+        """
+        Arguments:
+          contest_count: the number of contests other than the party and
+            duplicate-number contests.
+          choice_count: the number of candidates of each contest.
+          party_contest_count: the number of contest names to use for a
+            contest of each party in PARTIES.  The contest names are then
+            prefixed with the party when converted.
+          dupe_number_contest_count: the number of contests that share
+            the contest number 255.  Their lines are interleaved, as in
+            the November 2014 export file.
+          omit_zeros: whether to omit the lines with a total of zero, as
+            in the November 2014 export file.
+          negative_fraction: the probability that a candidate total is
+            written as -1.
+          under_over: whether each contest also has "Under Vote" and
+            "Over Vote" choices, which share their choice IDs across
+            contests.
+
+        """
+        if not 0 < precinct_count <= MAX_PRECINCT_ID - FIRST_PRECINCT_ID + 1:
+            raise Exception("the number of precincts should be between 1 and %d: %d" %
+                            (MAX_PRECINCT_ID - FIRST_PRECINCT_ID + 1, precinct_count))
+        numbered_count = contest_count + party_contest_count * len(PARTIES)
+        if numbered_count > LAST_CONTEST_NUMBER - FIRST_CONTEST_NUMBER + 1:
+            raise Exception("too many contests with distinct numbers: %d" % numbered_count)
+        all_count = numbered_count + dupe_number_contest_count
+        choice_id_count = all_count * choice_count + (2 if under_over else 0)
+        if choice_id_count > MAX_CHOICE_ID - 1:
+            raise Exception("too many choices in all (at most %d): %d" %
+                            (MAX_CHOICE_ID - 1, choice_id_count))
+
+        self.rng = random.Random(seed)
+        self.negative_fraction = negative_fraction
+        self.omit_zeros = omit_zeros
+
+        self.precincts = self.make_precincts(precinct_count)
+        self.make_totals()
+
+        self.next_choice_id = 2
+        self.shared_choices = []
+        if under_over:
+            self.shared_choices = [(self.make_choice_id(), name, "")
+                                   for name in ("Under Vote", "Over Vote")]
+
+        self.contests = []
+        for i in range(contest_count):
+            self.contests.append(self.make_contest(i, choice_count))
+        for i in range(party_contest_count):
+            for party_code, party_name in PARTIES:
+                name = "County Central Committee, Seat %d" % (i + 1)
+                self.contests.append(self.make_city_contest(name, choice_count,
+                                                            party_code=party_code))
+        self.contests = [contest._replace(number=number) for number, contest in
+                         enumerate(self.contests, start=FIRST_CONTEST_NUMBER)]
+        self.dupe_contests = [
+            self.make_city_contest("Regional Measure %d" % (i + 1), choice_count,
+                                   number=DUPLICATE_CONTEST_NUMBER)
+            for i in range(dupe_number_contest_count)]
+
+    def make_choice_id(self):
+        choice_id = self.next_choice_id
+        self.next_choice_id += 1
+        return choice_id
+
+    def make_precincts(self, precinct_count):
+        """
+        Return a list of the rows of the precinct file.
+
+        Each district type divides the precincts into contiguous blocks,
+        one per district, so that districts of different types overlap.
+
+        """
+        nbhd_labels = sorted(make_nbhd_names())
+        # A dict mapping district type name to a dict mapping district
+        # ID to the list of the district's precinct IDs.
+        self.district_precinct_ids = {type_name: {} for type_name in DISTRICT_IDS}
+        rows = []
+        for i in range(precinct_count):
+            precinct_id = FIRST_PRECINCT_ID + i
+            districts = {}
+            for type_name, district_ids in DISTRICT_IDS.items():
+                district_id = district_ids[i * len(district_ids) // precinct_count]
+                districts[type_name] = district_id
+                self.district_precinct_ids[type_name].setdefault(district_id, []).append(
+                    precinct_id)
+            nbhd_label = nbhd_labels[i * len(nbhd_labels) // precinct_count]
+            rows.append((precinct_id, "Pct %d" % precinct_id, "N", 1, districts["Assembly"],
+                         districts["BART"], districts["Congressional"], nbhd_label,
+                         districts["Senatorial"], districts["Supervisorial"]))
+        return rows
+
+    def make_totals(self):
+        """
+        Choose the registration and the ballots cast of each reporting
+        type (election day and vote by mail) of each precinct.
+
+        """
+        rng = self.rng
+        self.registered = {}
+        self.voted = {}
+        for row in self.precincts:
+            precinct_id = row[0]
+            registered = rng.randint(100, 1500)
+            self.registered[precinct_id] = registered
+            self.voted[precinct_id] = (rng.randint(0, registered // 3),
+                                       rng.randint(0, registered // 2))
+
+    def make_choices(self, choice_count, party_code=None):
+        rng = self.rng
+        choices = []
+        for i in range(choice_count):
+            code = rng.choice(CANDIDATE_PARTY_CODES) if party_code is None else party_code
+            choices.append((self.make_choice_id(), "CANDIDATE %d" % (i + 1), code))
+        return choices + self.shared_choices
+
+    def make_city_contest(self, name, choice_count, party_code=None, number=None):
+        """
+        Arguments:
+          party_code: the party of a party contest, or None.
+
+        """
+        precinct_ids = [row[0] for row in self.precincts]
+        return Contest(number, name, CITY_DISTRICT_NAME, party_code or "", precinct_ids,
+                       self.make_choices(choice_count, party_code=party_code))
+
+    def make_contest(self, index, choice_count):
+        """
+        Return the contest with the given index, using each district once
+        before making city-wide measures.
+
+        """
+        for type_name in sorted(DISTRICT_CONTEST_FORMATS):
+            district_ids = DISTRICT_IDS[type_name]
+            if index < len(district_ids):
+                break
+            index -= len(district_ids)
+        else:
+            return self.make_city_contest("Local Measure %d" % (index + 1), choice_count)
+
+        district_id = district_ids[index]
+        name_format, district_format = DISTRICT_CONTEST_FORMATS[type_name]
+        if "%s" in district_format:
+            district_name = district_format % make_ordinal(district_id)
+        else:
+            district_name = district_format % district_id
+        precinct_ids = self.district_precinct_ids[type_name].get(district_id, [])
+        return Contest(None, name_format % district_id, district_name, "", precinct_ids,
+                       self.make_choices(choice_count))
+
+    def write_precincts(self, f):
+        f.write(PRECINCT_HEADER + "\n")
+        for row in self.precincts:
+            f.write(",".join(str(value) for value in row) + "\n")
+
+    def iter_contest_rows(self, contest, precinct_ids, reporting_types, voted):
+        """
+        Yield the column values of the lines of a contest, for the given
+        precincts, in WinEDS order: by choice, precinct, and reporting
+        type.
+
+        Arguments:
+          voted: a dict mapping precinct ID to a tuple of the ballots
+            cast of each reporting type.
+
+        """
+        rng = self.rng
+        negative_fraction = self.negative_fraction
+        omit_zeros = self.omit_zeros
+        for choice_id, choice_name, party_code in contest.choices:
+            for precinct_id in precinct_ids:
+                precinct_voted = voted[precinct_id]
+                for i, reporting_type in enumerate(reporting_types):
+                    limit = precinct_voted[i] // max(1, len(contest.choices) - 1)
+                    vote_total = rng.randint(0, limit)
+                    if negative_fraction and rng.random() < negative_fraction:
+                        vote_total = -1
+                    if omit_zeros and vote_total == 0:
+                        continue
+                    data = "0%03d%03d%04d%s%s" % (contest.number, choice_id, precinct_id,
+                                                  format_vote_total(vote_total), party_code)
+                    yield (data, contest.name, choice_name, "Pct %d" % precinct_id,
+                           contest.district_name, reporting_type)
+
+    def iter_rows(self, has_reporting_type):
+        """
+        Yield the column values of the lines of the export file.
+
+        """
+        if has_reporting_type:
+            reporting_types = REPORTING_TYPES_COMPLETE
+            voted = self.voted
+        else:
+            # Then each precinct has a single total for all ballots.
+            reporting_types = ("", )
+            voted = {precinct_id: (sum(ballots), ) for precinct_id, ballots in self.voted.items()}
+        precinct_ids = [row[0] for row in self.precincts]
+
+        for precinct_id in precinct_ids:
+            data = "0001001%04d%s" % (precinct_id,
+                                      format_vote_total(self.registered[precinct_id]))
+            yield (data, "REGISTERED VOTERS - TOTAL", "VOTERS", "Pct %d" % precinct_id, "", "")
+        party_codes = sorted(set(contest.party_code for contest in self.contests) - {""})
+        for choice_id, (party_code, party_name) in enumerate(PARTIES, start=2):
+            if party_code not in party_codes:
+                continue
+            for precinct_id in precinct_ids:
+                data = "0001%03d%04d00000%s" % (choice_id, precinct_id, party_code)
+                yield (data, "REGISTERED VOTERS - %s" % party_name, "VOTERS",
+                       "Pct %d" % precinct_id, "", "")
+        for precinct_id in precinct_ids:
+            for vote_total, reporting_type in zip(voted[precinct_id], reporting_types):
+                if self.omit_zeros and vote_total == 0:
+                    continue
+                data = "0002001%04d%s" % (precinct_id, format_vote_total(vote_total))
+                yield (data, "BALLOTS CAST - TOTAL", "BALLOTS CAST", "Pct %d" % precinct_id,
+                       "", reporting_type)
+
+        for contest in self.contests:
+            yield from self.iter_contest_rows(contest, contest.precinct_ids, reporting_types,
+                                              voted)
+        for precinct_id in precinct_ids:
+            for contest in self.dupe_contests:
+                yield from self.iter_contest_rows(contest, [precinct_id], reporting_types, voted)
+
+    def write_export(self, f, layout=None):
+        """
+        Write the export file.
+
+        Arguments:
+          layout: a LineLayout object.  Defaults to LAYOUT_COMPLETE.
+
+        """
+        if layout is None:
+            layout = LAYOUT_COMPLETE
+        widths = layout.widths
+        line_format = "".join("%%-%d.%ds" % (width, width) for width in widths) + "\n"
+        for row in self.iter_rows(layout.has_reporting_type):
+            f.write(line_format % row[:len(widths)])
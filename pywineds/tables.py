@@ -0,0 +1,137 @@
+"""
+Supports converting election results to tables in "long" form.
+
+Unlike the Statement of Vote layouts of the TSV and Excel files, each
+row of these tables holds a single total, which makes the tables easy
+to load into analytics tools.  The tables are built as plain Python
+lists, one per column, so that they can be encoded in any columnar
+format.
+
+"""
+
+from collections import OrderedDict
+
+from pywineds.utils import REPORTING_INDEX_ALL, REPORTING_INDEX_ELD, REPORTING_INDEX_VBM
+
+
+# The file formats supported by the columnar writer, which are also the
+# file extensions.
+COLUMNAR_FORMATS = ("parquet", "arrow")
+
+REPORTING_TYPE_NAMES = {
+    REPORTING_INDEX_ALL: "All",
+    REPORTING_INDEX_ELD: "Election Day",
+    REPORTING_INDEX_VBM: "VBM",
+}
+
+# The names and types of the columns of each table.  A type is either
+# int or str.
+TABLE_COLUMNS = OrderedDict([
+    ("votes", (
+        ("contest_number", int),
+        ("contest_name", str),
+        ("district_name", str),
+        ("party", str),
+        ("precinct_id", int),
+        ("reporting_type", str),
+        ("choice_id", int),
+        ("choice_name", str),
+        ("votes", int),
+    )),
+    ("registered", (
+        ("precinct_id", int),
+        ("precinct_name", str),
+        ("registered", int),
+    )),
+    ("ballots_cast", (
+        ("precinct_id", int),
+        ("reporting_type", str),
+        ("ballots_cast", int),
+    )),
+])
+
+
+def make_empty_table(table_name):
+    return OrderedDict((name, []) for name, type_ in TABLE_COLUMNS[table_name])
+
+
+def make_votes_table(info):
+    """
+    Return the table of contest vote totals.
+
+    The table has a row for every choice of every contest, for every
+    participating precinct and reporting type (including zero totals).
+
+    """
+    table = make_empty_table("votes")
+    (contest_numbers, contest_names, district_names, parties, precinct_ids, reporting_types,
+     choice_ids, choice_names, votes) = table.values()
+
+    choices = info.meta.choices
+    contests_results = info.results.contests
+    for contest_id, contest_info in sorted(info.meta.contests.items()):
+        contest_results = contests_results[contest_id]
+        # Each choices value is a 2-tuple of (contest_id, choice_name).
+        contest_choice_ids = contest_results.choice_ids
+        contest_choice_names = [choices[choice_id][1] for choice_id in contest_choice_ids]
+        choice_count = contest_results.choice_count
+        for precinct_id in contest_results.precinct_ids:
+            for r_index in contest_results.reporting_indices:
+                choice_ids.extend(contest_choice_ids)
+                choice_names.extend(contest_choice_names)
+                votes.extend(contest_results.get_totals(precinct_id, r_index))
+                precinct_ids.extend(choice_count * [precinct_id])
+                reporting_types.extend(choice_count * [REPORTING_TYPE_NAMES[r_index]])
+        row_count = len(votes) - len(contest_numbers)
+        contest_numbers.extend(row_count * [contest_info.number])
+        contest_names.extend(row_count * [contest_info.name])
+        district_names.extend(row_count * [contest_info.district_name])
+        parties.extend(row_count * [contest_info.party_code])
+
+    return table
+
+
+def make_registered_table(info):
+    table = make_empty_table("registered")
+    precinct_ids, precinct_names, registered = table.values()
+
+    precincts = info.meta.precincts
+    for precinct_id, total in sorted(info.results.registered.items()):
+        precinct_ids.append(precinct_id)
+        precinct_names.append(precincts[precinct_id])
+        registered.append(total)
+
+    return table
+
+
+def make_ballots_cast_table(info):
+    table = make_empty_table("ballots_cast")
+    precinct_ids, reporting_types, ballots_cast = table.values()
+
+    results = info.results
+    for precinct_id, precinct_voted in sorted(results.voted.items()):
+        for r_index in results.reporting_indices:
+            precinct_ids.append(precinct_id)
+            reporting_types.append(REPORTING_TYPE_NAMES[r_index])
+            # A missing total means zero, as in the other results files.
+            ballots_cast.append(precinct_voted.get(r_index, 0))
+
+    return table
+
+
+def make_results_tables(info):
+    """
+    Return an OrderedDict mapping table name to table, where each table
+    is an OrderedDict mapping column name to a list of values.
+
+    See TABLE_COLUMNS for the tables and columns.
+
+    Arguments:
+      info: an ElectionInfo object.
+
+    """
+    return OrderedDict([
+        ("votes", make_votes_table(info)),
+        ("registered", make_registered_table(info)),
+        ("ballots_cast", make_ballots_cast_table(info)),
+    ])
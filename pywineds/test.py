@@ -1,9 +1,48 @@
 
+from array import array
+from contextlib import redirect_stderr
 from datetime import datetime
+from io import StringIO
 from pathlib import Path
+import pstats
+import sqlite3
+import tempfile
 import unittest
 
-from pywineds.main import convert, parse_data_chunk, split_line_fixed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from pywineds.aggregation import aggregate_results, AreaMembership, AreaTotals
+from pywineds.backends import TSVBackend
+from pywineds.benchmarking import compare_results, format_results, run_benchmark
+from pywineds.byteparsing import MmapParser
+from pywineds.cache import digest_input_files_cached, SnapshotCache
+from pywineds.equivalence import (compare_attrs, compare_texts, get_test_data_cases,
+                                  make_random_cases, Candidate, EquivalenceChecker,
+                                  RESULTS_ATTRS)
+from pywineds.incremental import RenderState
+from pywineds.parallel import find_chunk_bounds
+from pywineds.layouts import get_line_layout, sniff_layout, LAYOUT_COMPLETE, LAYOUT_SIMPLE
+from pywineds.main import (convert, digest_input_files, inner_main, parse_data_chunk,
+                           parse_precinct_file, split_line_fixed, watch, ContestResults, ElectionInfo, ElectionMeta,
+                           ElectionResults, AreasInfo, EXPORT_ENGINES, SELECTING_ENGINES,
+                           TRUSTED_INPUT_ENGINES)
+from pywineds.profiling import profile_cpu, MemoryProfiler
+from pywineds.resultswriting import write_results_files, ExcelWriter, TSVWriter
+from pywineds.selection import make_selection
+from pywineds.sqlitewriting import SQLiteWriter
+from pywineds.streaming import write_tsv_streaming
+from pywineds.synthetic import SyntheticElection
+from pywineds.tables import make_results_tables, TABLE_COLUMNS
+from pywineds.trusted import TrustOptions
+from pywineds.utils import record_metrics, time_it, REPORTING_INDEX_VBM
+from pywineds.watching import ExportWatcher, WatchConverter
 
 
 class ModuleTest(unittest.TestCase):
@@ -30,29 +69,842 @@ class ModuleTest(unittest.TestCase):
                     'TC-Election Day Reporting')
         self.assertEqual(actual, expected)
 
+    def test_split_raw_line(self):
+        """Check that MmapParser splits lines the same as split_line_fixed()."""
+        lines = [
+            ("0001001110800827          REGISTERED VOTERS - TOTAL"
+             "                               VOTERS"
+             "                                Pct 1108"
+             "                                               \n"),
+            ("0010073990000000PF        US Representative, District 13                          "
+             "LAWERENCE N. ALLEN                    Pct 9900 MB                   "
+             "13TH CONGRESSIONAL DISTRITC-Election Day Reporting     \n"),
+            # A line with a non-ASCII character.
+            ("01000167208000-1NON       Governor                                                "
+             "JOSÉ N. SMITH                         Pct 7208                      "
+             "CALIFORNIA               TC-VBM Reporting              \n"),
+        ]
+        parser = MmapParser(ElectionMeta(), ElectionResults(), layout=LAYOUT_COMPLETE)
+        for line in lines:
+            with self.subTest(line=line):
+                fields, data = parser.split_raw_line(line.encode("utf-8"))
+                expected = split_line_fixed(line)
+                self.assertEqual(fields[1:], expected[1:])
+                self.assertEqual(data, parse_data_chunk(expected.data_field))
+
     def test_parse_data_chunk(self):
         self.assertEqual(parse_data_chunk("0001001110100484"), (1, 1, 1101, 484, ''))
         self.assertEqual(parse_data_chunk("0100016113100001NON"), (16, 100, 1131, 1, 'NON'))
         self.assertEqual(parse_data_chunk("01000167208000-1NON"), (16, 100, 7208, -1, 'NON'))
 
+    def test_contest_results(self):
+        results = ContestResults([12, 10], [3, 1, 2], (1, 2))
+        self.assertEqual(results.size, 12)
+        results.add_records(array('q', [12, 2, 3, 50, 1, 10, 1, 2, 7, 2]))
+        self.assertEqual(list(results.get_totals(12, 2)), [0, 0, 50])
+        self.assertEqual(list(results.get_totals(10, 1)), [0, 7, 0])
+        self.assertEqual(results.get_total(12, 2, 3), 50)
+        self.assertIn(10, results)
+        self.assertNotIn(11, results)
+        # Check that a duplicate total raises an error with the line number.
+        with self.assertRaisesRegex(Exception, "line 9"):
+            results.add_records(array('q', [12, 2, 3, 50, 9]))
+
+    def test_area_membership(self):
+        area_types = [("Congressional", {12: {1, 3}, 13: {2}}),
+                      ("City", {0: {1, 2, 3}})]
+        membership = AreaMembership(area_types)
+        self.assertEqual(membership.area_keys,
+                         [("Congressional", 12), ("Congressional", 13), ("City", 0)])
+        self.assertEqual(list(membership.get_area_rows(3)), [0, 2])
+        self.assertEqual(list(membership.get_area_rows(4)), [])
+        sums = membership.multiply([(1, [1, 10]), (3, [1, 5]), (4, [1, 7])])
+        self.assertEqual(sums, {0: [2, 15], 2: [2, 15]})
+
+    def test_tsv_backend(self):
+        with StringIO() as f:
+            backend = TSVBackend(f)
+            backend.write_rows(backend.make_contest_start_rows("Title"))
+            backend.write_rows([("a", 1, 2), ("", )])
+            self.assertEqual(f.getvalue(), "*** Title\na\t1\t2\n\n")
+
+    def test_area_totals__turnout(self):
+        self.assertEqual(AreaTotals(1, 200, 50, ()).turnout, 0.25)
+        self.assertIsNone(AreaTotals(1, 0, 0, ()).turnout)
+
+
+# The engines that can run in the current environment.
+ENGINES = [engine for engine in EXPORT_ENGINES if numpy is not None or engine != "numpy"]
+
 
-def parse_test_file(label, name, now=None):
+def get_test_paths(label):
+    """
+    Return a 3-tuple of paths: precincts_path, export_path, expected_path.
+
+    """
     test_dir = Path(__file__).parents[1] / 'test_data'
 
     precincts_path = str(test_dir / "precincts.csv")
     test_dir /= label
     input_name = "wineds_%s.txt" % label
-    exports_path, expected_path = (str(test_dir / name) for name in (input_name, "output.tsv"))
+    export_path, expected_path = (str(test_dir / name) for name in (input_name, "output.tsv"))
+
+    return precincts_path, export_path, expected_path
+
+
+def parse_test_file(label, name, now=None, engine=None, jobs=None):
+    precincts_path, exports_path, expected_path = get_test_paths(label)
 
     output_base = "temp_%s" % label
 
     tsv_path, excel_path = convert(election_name=name, precincts_path=precincts_path,
                                    export_path=exports_path, output_base=output_base,
-                                   now=now)
+                                   now=now, engine=engine, jobs=jobs)
 
     return tsv_path, expected_path
 
 
+class EngineTest(unittest.TestCase):
+
+    def get_contests_meta(self, election_meta):
+        contests = {}
+        for contest_id, contest in election_meta.contests.items():
+            contests[contest_id] = (contest.name, contest.district_name, contest.party_code,
+                                    contest.choice_ids, contest.precinct_ids)
+        return contests
+
+    def check_engine(self, label, engine, jobs=None):
+        precincts_path, export_path, expected_path = get_test_paths(label)
+        expected_meta, _, expected_results = digest_input_files(precincts_path, export_path,
+                                                                engine="two-pass")
+        meta, _, results = digest_input_files(precincts_path, export_path, engine=engine,
+                                              jobs=jobs)
+
+        self.assertEqual(self.get_contests_meta(meta), self.get_contests_meta(expected_meta))
+        for attr in ('choices', 'parties', 'precincts', 'has_reporting_type',
+                     'overvote_id', 'undervote_id'):
+            self.assertEqual(getattr(meta, attr), getattr(expected_meta, attr), msg=attr)
+        for attr in ('contests', 'registered', 'voted', 'reporting_indices'):
+            self.assertEqual(getattr(results, attr), getattr(expected_results, attr), msg=attr)
+
+    def test_engines(self):
+        for engine in ENGINES:
+            for label in ("simple", "complete", "dupe_contest_id", "reporting_type"):
+                with self.subTest(engine=engine, label=label):
+                    self.check_engine(label, engine)
+
+    def test_parallel_engine__multiple_chunks(self):
+        for label in ("simple", "complete"):
+            with self.subTest(label=label):
+                self.check_engine(label, "parallel", jobs=3)
+
+    def test_empty_export_file(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = str(Path(temp_dir) / "export.txt")
+            Path(path).touch()
+            for engine in ("single-pass", "mmap"):
+                with self.subTest(engine=engine):
+                    with self.assertRaisesRegex(Exception, "error while parsing line 0"):
+                        digest_input_files(precincts_path, path, engine=engine)
+            with self.assertRaisesRegex(Exception, "export file is empty"):
+                digest_input_files(precincts_path, path, engine="parallel")
+
+    def test_jobs__not_positive(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        for engine in (None, "parallel"):
+            for jobs in (0, -3):
+                with self.subTest(engine=engine, jobs=jobs):
+                    with self.assertRaisesRegex(Exception, "jobs should be a positive integer"):
+                        digest_input_files(precincts_path, export_path, engine=engine,
+                                           jobs=jobs)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_engine__fallback(self):
+        """Check that the NumPy engine declines a file with non-ASCII lines."""
+        from pywineds.vectorized import VectorizedParser
+
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        with open(export_path, encoding="utf-8") as f:
+            text = f.read()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = str(Path(temp_dir) / "export.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text.replace("VOTERS", "VÓTERS", 1))
+            parser = VectorizedParser(ElectionMeta(), ElectionResults())
+            self.assertFalse(parser.parse_path(path))
+            parser = VectorizedParser(ElectionMeta(), ElectionResults())
+            self.assertTrue(parser.parse_path(export_path))
+
+    def test_find_chunk_bounds(self):
+        data = b"aaaa\nbb\ncccccc\nd\n"
+        self.assertEqual(find_chunk_bounds(data, 1), [(0, 17)])
+        self.assertEqual(find_chunk_bounds(data, 2), [(0, 8), (8, 17)])
+        self.assertEqual(find_chunk_bounds(data, 3), [(0, 5), (5, 15), (15, 17)])
+        # Check requesting more chunks than lines.
+        self.assertEqual(find_chunk_bounds(data, 10),
+                         [(0, 5), (5, 8), (8, 15), (15, 17)])
+
+
+class LayoutTest(unittest.TestCase):
+
+    def test_sniff_layout(self):
+        for label, expected in (("simple", LAYOUT_SIMPLE), ("complete", LAYOUT_COMPLETE)):
+            with self.subTest(label=label):
+                precincts_path, export_path, expected_path = get_test_paths(label)
+                with open(export_path, encoding="utf-8") as f:
+                    lines = [next(f) for i in range(5)]
+                self.assertEqual(sniff_layout(lines), expected)
+        with self.assertRaisesRegex(Exception, "line lengths: 7"):
+            sniff_layout(["0123456\n"])
+
+    def test_custom_layout(self):
+        """Check converting a file whose columns have other widths."""
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        layout = get_line_layout("24,60,40,32,28,30")
+        split_line = LAYOUT_COMPLETE.make_splitter()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            new_export_path = str(Path(temp_dir) / "export.txt")
+            with open(export_path, encoding="utf-8") as f, \
+                  open(new_export_path, "w", encoding="utf-8") as new_file:
+                for line in f:
+                    values = split_line(line)
+                    new_file.write("".join(value.ljust(width) for value, width in
+                                           zip(values, layout.widths)) + "\n")
+            output_base = str(Path(temp_dir) / "output")
+            with open(expected_path, encoding="utf-8") as f:
+                expected = f.read()
+            for engine in ENGINES:
+                with self.subTest(engine=engine):
+                    tsv_path, excel_path = convert("Test Election (Complete Data)",
+                                                   precincts_path, new_export_path,
+                                                   output_base, now=now, engine=engine,
+                                                   layout="24,60,40,32,28,30")
+                    with open(tsv_path, encoding="utf-8") as f:
+                        self.assertEqual(f.read(), expected)
+
+
+class TrustTest(unittest.TestCase):
+
+    def test_iter_sampled_line_nos(self):
+        line_nos = TrustOptions(every=5).iter_sampled_line_nos(first_line_no=7)
+        self.assertEqual([next(line_nos) for i in range(3)], [10, 15, 20])
+        self.assertEqual(list(TrustOptions().iter_sampled_line_nos()), [])
+
+    def test_trusted_engines(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        expected_meta, areas_info, expected_results = digest_input_files(precincts_path,
+                                                                         export_path)
+        for engine in TRUSTED_INPUT_ENGINES:
+            for trust in (TrustOptions(), TrustOptions(every=7), TrustOptions(fraction=0.1)):
+                with self.subTest(engine=engine, trust=trust):
+                    meta, areas_info, results = digest_input_files(
+                        precincts_path, export_path, engine=engine, trust=trust)
+                    for attr in ('choices', 'parties', 'precincts'):
+                        self.assertEqual(getattr(meta, attr), getattr(expected_meta, attr))
+                    self.assertEqual(
+                        {contest_id: (contest.district_name, contest.precinct_ids)
+                         for contest_id, contest in meta.contests.items()},
+                        {contest_id: (contest.district_name, contest.precinct_ids)
+                         for contest_id, contest in expected_meta.contests.items()})
+                    self.assertEqual(results.contests, expected_results.contests)
+                    self.assertEqual(results.voted, expected_results.voted)
+                    self.assertEqual(meta.validation["lines"], 1551)
+
+    def test_inner_main__bad_options(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        for options, name in ((["--validate-every", "0"], "every"),
+                              (["--validate-fraction", "2"], "fraction")):
+            with self.subTest(options=options):
+                argv = (["wineds-convert", "Test", precincts_path, export_path, "temp_trust",
+                         "--trust-input"] + options)
+                with self.assertLogs("wineds") as logs, self.assertRaises(SystemExit):
+                    inner_main("", argv)
+                self.assertIn("ERROR: %s should be" % name, logs.output[0])
+
+    def test_duplicate_total(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        with open(export_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            new_export_path = str(Path(temp_dir) / "export.txt")
+            with open(new_export_path, "w", encoding="utf-8") as f:
+                f.writelines(lines + lines[:1])
+            with self.assertRaisesRegex(Exception, "registered voter lines but"):
+                digest_input_files(precincts_path, new_export_path, trust=TrustOptions())
+            with self.assertRaisesRegex(Exception, "does not support trusted input"):
+                digest_input_files(precincts_path, new_export_path, engine="two-pass",
+                                   trust=TrustOptions())
+
+
+class TablesTest(unittest.TestCase):
+
+    def get_info(self, label):
+        precincts_path, export_path, expected_path = get_test_paths(label)
+        election_meta, areas_info, results = digest_input_files(precincts_path, export_path)
+        return ElectionInfo(areas_info, election_meta, "Test Election", results)
+
+    def test_make_results_tables(self):
+        info = self.get_info("complete")
+        tables = make_results_tables(info)
+        self.assertEqual(list(tables), list(TABLE_COLUMNS))
+        for table_name, table in tables.items():
+            with self.subTest(table=table_name):
+                column_names = [name for name, type_ in TABLE_COLUMNS[table_name]]
+                self.assertEqual(list(table), column_names)
+                self.assertEqual(len(set(len(values) for values in table.values())), 1)
+
+        votes = tables["votes"]
+        expected = sum(sum(results.totals) for results in info.results.contests.values())
+        self.assertEqual(sum(votes["votes"]), expected)
+        self.assertEqual(set(votes["reporting_type"]), {"Election Day", "VBM"})
+        self.assertEqual(sum(tables["registered"]["registered"]),
+                         sum(info.results.registered.values()))
+
+    @unittest.skipIf(pyarrow is None, "PyArrow is not installed")
+    def test_columnar_writer(self):
+        from pywineds.columnar import ColumnarWriter
+        import pyarrow.parquet
+
+        info = self.get_info("simple")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = ColumnarWriter(str(Path(temp_dir) / "temp"), "parquet")
+            paths = writer.write(info)
+            table = pyarrow.parquet.read_table(paths[0])
+        votes = make_results_tables(info)["votes"]
+        self.assertEqual(table.column("votes").to_pylist(), votes["votes"])
+        self.assertEqual(table.column("choice_name").to_pylist(), votes["choice_name"])
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_digest_input_files_cached(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        calls = []
+        def digest(*args, **kwargs):
+            calls.append(args)
+            return digest_input_files(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            meta1, areas_info1, results1 = digest_input_files_cached(
+                digest, precincts_path, export_path, temp_dir)
+            meta2, areas_info2, results2 = digest_input_files_cached(
+                digest, precincts_path, export_path, temp_dir)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(meta2.choices, meta1.choices)
+        self.assertEqual(areas_info2.neighborhoods, areas_info1.neighborhoods)
+        self.assertEqual(results2.contests, results1.contests)
+        self.assertEqual(results2.voted, results1.voted)
+
+    def test_trusted_snapshot(self):
+        """Check that a snapshot of trusted input is not used when validating."""
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        with open(export_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        # Change the name of a choice on a single line.
+        i = [i for i, line in enumerate(lines) if "ELLEN H. BROWN" in line][1]
+        lines[i] = lines[i].replace("ELLEN H. BROWN", "ELLEN H. BRAWN")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            new_export_path = str(Path(temp_dir) / "export.txt")
+            with open(new_export_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            cache_dir = str(Path(temp_dir) / "cache")
+            digest_input_files_cached(digest_input_files, precincts_path, new_export_path,
+                                      cache_dir, trust=TrustOptions())
+            with self.assertRaisesRegex(Exception, "error while parsing line %d" % (i + 1)):
+                digest_input_files_cached(digest_input_files, precincts_path, new_export_path,
+                                          cache_dir)
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = SnapshotCache(temp_dir, max_size=0)
+            cache.store("a", "x" * 100)
+            cache.store("b", "y" * 100)
+            # Only the most recently stored snapshot is kept.
+            self.assertIsNone(cache.load("a"))
+            self.assertEqual(cache.load("b"), "y" * 100)
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def test_incremental(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        with open(export_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        # Change a vote total of the last contest.
+        index = max(i for i, line in enumerate(lines) if int(line[1:4]) > 2)
+        line = lines[index]
+        lines[index] = line[:11] + "%05d" % (int(line[11:16]) + 7) + line[16:]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            new_export_path = str(Path(temp_dir) / "export.txt")
+            with open(new_export_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+
+            def run(path, name, incremental):
+                output_base = str(Path(temp_dir) / name)
+                tsv_path, excel_path = convert("Test", precincts_path, path, output_base,
+                                               now=now, incremental=incremental)
+                with open(tsv_path, encoding="utf-8") as f:
+                    return f.read()
+
+            run(export_path, "incremental", incremental=True)
+            state = RenderState.load(str(Path(temp_dir) / "incremental.state"))
+            self.assertEqual(len(state.get_blocks("TSV")), len(state.digests))
+
+            actual = run(new_export_path, "incremental", incremental=True)
+            expected = run(new_export_path, "full", incremental=False)
+            self.assertEqual(actual, expected)
+
+            # Check that only the changed contest was discarded.
+            election_meta, areas_info, results = digest_input_files(precincts_path, export_path)
+            info = ElectionInfo(areas_info, election_meta, "Test", results)
+            state = RenderState.load(str(Path(temp_dir) / "incremental.state"))
+            self.assertEqual(state.update(info), [max(election_meta.contests)])
+
+
+class WatchTest(unittest.TestCase):
+
+    def test_export_watcher(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = str(Path(temp_dir) / "export.txt")
+            watcher = ExportWatcher(temp_dir)
+            with open(path, "w") as f:
+                f.write("partial")
+                f.flush()
+                # The file is not ready until its size is stable.
+                self.assertEqual(watcher.poll(), [])
+                f.write(" line\n")
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual(watcher.poll(), [path])
+            # The file is returned only once.
+            self.assertEqual(watcher.poll(), [])
+
+    def test_convert_ready(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        areas_info = parse_precinct_file(precincts_path)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            drop_dir = Path(temp_dir) / "drop"
+            drop_dir.mkdir()
+            output_base = str(Path(temp_dir) / "sov")
+            converter = WatchConverter(convert, "Test Election (Complete Data)", precincts_path,
+                                       output_base, areas_info, now=now)
+            watcher = ExportWatcher(str(drop_dir))
+            self.assertIsNone(converter.convert_ready(watcher))
+
+            with open(export_path, encoding="utf-8") as f:
+                (drop_dir / "export.txt").write_text(f.read(), encoding="utf-8")
+            self.assertIsNone(converter.convert_ready(watcher))
+            paths = converter.convert_ready(watcher)
+            self.assertEqual(paths, [output_base + ".tsv", output_base + ".xlsx"])
+            with open(paths[0], encoding="utf-8") as actual, \
+                  open(expected_path, encoding="utf-8") as expected:
+                self.assertEqual(actual.read(), expected.read())
+            # Check that no temporary output files remain.
+            self.assertEqual(sorted(p.name for p in Path(temp_dir).iterdir()),
+                             ["drop", "sov.tsv", "sov.xlsx"])
+
+    def test_watch__usage(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for args in ([], [temp_dir], [temp_dir, "extra", "--name", "x", "--precincts", "p"]):
+                with self.subTest(args=args):
+                    with redirect_stderr(StringIO()) as stderr, self.assertRaises(SystemExit):
+                        watch(args)
+                    self.assertIn("usage: wineds-convert watch", stderr.getvalue())
+
+
+class StreamingTest(unittest.TestCase):
+
+    def test_write_tsv_streaming(self):
+        """Check that only the files grouped by contest are streamed."""
+        for label, expected in (("simple", True), ("complete", True),
+                                ("dupe_contest_id", False), ("reporting_type", False)):
+            with self.subTest(label=label):
+                precincts_path, export_path, expected_path = get_test_paths(label)
+                areas_info = parse_precinct_file(precincts_path)
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    writer = TSVWriter(path=str(Path(temp_dir) / "output.tsv"))
+                    self.assertEqual(write_tsv_streaming(writer, areas_info, "Test",
+                                                         export_path), expected)
+
+    def test_convert(self):
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        for label, name in (("complete", "Test Election (Complete Data)"),
+                            ("dupe_contest_id", "Test Election (Dupe Contest ID)")):
+            with self.subTest(label=label):
+                precincts_path, export_path, expected_path = get_test_paths(label)
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    output_base = str(Path(temp_dir) / "output")
+                    paths = convert(name, precincts_path, export_path, output_base, now=now,
+                                    jobs=1, streaming=True)
+                    self.assertEqual(paths, (output_base + ".tsv", ))
+                    with open(paths[0], encoding="utf-8") as actual, \
+                          open(expected_path, encoding="utf-8") as expected:
+                        self.assertEqual(actual.read(), expected.read())
+        with self.assertRaisesRegex(Exception, "streaming does not support: sqlite"):
+            convert("Test", precincts_path, export_path, "temp_streaming", streaming=True,
+                    sqlite=True)
+        with self.assertRaisesRegex(Exception, "streaming does not support: jobs"):
+            convert("Test", precincts_path, export_path, "temp_streaming", streaming=True,
+                    jobs=2)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_time_it(self):
+        with record_metrics() as recorder:
+            with time_it("outer") as phase:
+                phase.lines = 10
+                with time_it("inner"):
+                    pass
+        self.assertEqual([(phase.name, phase.depth) for phase in recorder.phases],
+                         [("outer", 0), ("inner", 1)])
+        outer = recorder.to_dict()["phases"][0]
+        self.assertEqual(outer["lines"], 10)
+        self.assertEqual(outer["lines_per_second"], 10 / outer["wall_seconds"])
+        self.assertGreaterEqual(outer["cpu_seconds"], 0)
+
+    def test_convert(self):
+        """Check that the phases of the writer processes are recorded."""
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with record_metrics() as recorder:
+                convert("Test", precincts_path, export_path, str(Path(temp_dir) / "output"))
+        phases = {phase.name: phase for phase in recorder.phases}
+        phase = phases["parsing Results File (single pass, for election metadata and "
+                       "vote totals)"]
+        self.assertEqual(phase.lines, 1551)
+        self.assertEqual(phase.bytes, Path(export_path).stat().st_size)
+        for name in ("writing output file: TSV", "writing output file: Excel",
+                     "cleaning up Excel file"):
+            self.assertIn(name, phases)
+        self.assertEqual(phases["cleaning up Excel file"].depth, 2)
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_profile_cpu(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stats_path, summary_path = (str(Path(temp_dir) / name)
+                                        for name in ("run.pstats", "run.txt"))
+            self.assertEqual(profile_cpu(lambda: sum(range(10)), stats_path, summary_path), 45)
+            self.assertGreater(pstats.Stats(stats_path).total_calls, 0)
+            self.assertIn("function calls", Path(summary_path).read_text())
+
+    def test_memory_profiler(self):
+        profiler = MemoryProfiler(top=3)
+        with record_metrics(profiler), profiler.tracing():
+            with time_it("outer"):
+                with time_it("inner"):
+                    data = bytearray(2 ** 20)
+                    del data
+        inner, outer = (profiler.reports[phase] for phase in reversed(profiler.phases))
+        for peak, current, statistics in (inner, outer):
+            self.assertGreaterEqual(peak, 2 ** 20)
+            self.assertLess(current, 2 ** 20)
+            self.assertLessEqual(len(statistics), 3)
+        self.assertEqual(profiler.format_report().splitlines()[0][:13], "outer: peak 1")
+
+    def test_inner_main__streaming(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_base = str(Path(temp_dir) / "output")
+            inner_main("", ["wineds-convert", "Test", precincts_path, export_path, output_base,
+                            "--streaming", "--profile", "cpu"])
+            self.assertEqual(sorted(p.name for p in Path(temp_dir).iterdir()),
+                             ["output.cpu.txt", "output.pstats", "output.tsv"])
+
+
+class OutOfCoreTest(unittest.TestCase):
+
+    def test_spilled_contests(self):
+        precincts_path, export_path, expected_path = get_test_paths("dupe_contest_id")
+        expected_meta, areas_info, expected_results = digest_input_files(precincts_path,
+                                                                         export_path)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # A budget this small spills the records every 25 lines.
+            meta, areas_info, results = digest_input_files(
+                precincts_path, export_path, memory_budget=1000, spill_dir=temp_dir)
+            spill_files = results.contests.spill_files
+            self.assertEqual(len(spill_files.paths), len(expected_meta.contests))
+            self.assertEqual(dict(results.contests), expected_results.contests)
+            spill_files.close()
+            self.assertEqual(list(Path(temp_dir).iterdir()), [])
+        with self.assertRaisesRegex(Exception, "does not support a memory budget"):
+            digest_input_files(precincts_path, export_path, engine="mmap", memory_budget=1000)
+        with self.assertRaisesRegex(Exception, "memory_budget should be a positive integer"):
+            digest_input_files(precincts_path, export_path, memory_budget=0)
+
+    def test_inner_main__bad_memory_budget(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        for value in ("0", "-5"):
+            with self.subTest(value=value):
+                argv = ["wineds-convert", "Test", precincts_path, export_path, "temp_spill",
+                        "--memory-budget", value]
+                with self.assertLogs("wineds") as logs, self.assertRaises(SystemExit):
+                    inner_main("", argv)
+                self.assertIn("ERROR: --memory-budget should be a positive integer",
+                              logs.output[0])
+
+    def test_convert(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_base = str(Path(temp_dir) / "output")
+            tsv_path, excel_path = convert("Test Election (Complete Data)", precincts_path,
+                                           export_path, output_base, now=now,
+                                           memory_budget=1000, spill_dir=temp_dir)
+            with open(tsv_path, encoding="utf-8") as actual, \
+                  open(expected_path, encoding="utf-8") as expected:
+                self.assertEqual(actual.read(), expected.read())
+            # Check that the spill files were deleted.
+            self.assertEqual(sorted(p.name for p in Path(temp_dir).iterdir()),
+                             ["output.tsv", "output.xlsx"])
+
+
+class SyntheticTest(unittest.TestCase):
+
+    def make_files(self, temp_dir, layout, seed=0):
+        """
+        Write a synthetic election with all features, and return the paths.
+
+        """
+        election = SyntheticElection(seed=seed, precinct_count=40, contest_count=22,
+                                     choice_count=3, party_contest_count=2,
+                                     dupe_number_contest_count=2, omit_zeros=True,
+                                     negative_fraction=0.01, under_over=True)
+        paths = [str(Path(temp_dir) / name) for name in ("precincts.csv", "wineds.txt")]
+        with open(paths[0], "w", encoding="utf-8") as f:
+            election.write_precincts(f)
+        with open(paths[1], "w", encoding="utf-8") as f:
+            election.write_export(f, layout=layout)
+        return paths
+
+    def read_files(self, paths):
+        texts = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+        return texts
+
+    def test_seed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            texts = self.read_files(self.make_files(temp_dir, LAYOUT_COMPLETE, seed=1))
+            self.assertEqual(self.read_files(self.make_files(temp_dir, LAYOUT_COMPLETE, seed=1)),
+                             texts)
+            self.assertNotEqual(self.read_files(self.make_files(temp_dir, LAYOUT_COMPLETE, seed=2)),
+                                texts)
+
+    def test_engines(self):
+        for layout in (LAYOUT_SIMPLE, LAYOUT_COMPLETE):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                precincts_path, export_path = self.make_files(temp_dir, layout)
+                with open(export_path, encoding="utf-8") as f:
+                    self.assertEqual(sniff_layout(f.readlines()), layout)
+                expected_meta, _, expected_results = digest_input_files(
+                    precincts_path, export_path, engine="two-pass")
+                names = [contest.name for contest in expected_meta.contests.values()]
+                self.assertIn("DEM - County Central Committee, Seat 1", names)
+                self.assertEqual(len([contest_id for contest_id in expected_meta.contests
+                                      if contest_id[0] == 255]), 2)
+                for engine in ENGINES:
+                    with self.subTest(layout=layout.name, engine=engine):
+                        meta, _, results = digest_input_files(precincts_path, export_path,
+                                                              engine=engine)
+                        self.assertEqual(meta.choices, expected_meta.choices)
+                        for attr in ('contests', 'registered', 'voted'):
+                            self.assertEqual(getattr(results, attr),
+                                             getattr(expected_results, attr), msg=attr)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        options = dict(precinct_count=30, contest_count=3, choice_count=2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            case = run_benchmark("tiny", options, temp_dir, repeat=1)
+        self.assertEqual(case["config"]["engine"], "two-pass")
+        stages = case["stages"]
+        for name in ("converting", "parsing Precinct Index File",
+                     "parsing Results File (pass #1, for election metadata)",
+                     "parsing Results File (pass #2, for vote totals)", "initializing results",
+                     "writing output file: TSV", "writing output file: Excel"):
+            self.assertIn(name, stages)
+        self.assertEqual(stages["converting"]["lines"], case["lines"])
+        self.assertGreater(stages["parsing Results File (pass #2, for vote totals)"]
+                           ["lines_per_second"], 0)
+        self.assertIn("converting", format_results({"cases": {"tiny": case}}))
+
+    def test_compare_results(self):
+        def make_results(seconds, peak_rss, engine="two-pass"):
+            stages = {"parsing": {"wall_seconds": seconds},
+                      "tiny": {"wall_seconds": seconds / 100}}
+            case = {"config": {"engine": engine}, "peak_rss": peak_rss, "stages": stages}
+            return {"cases": {"small": case}}
+
+        baseline = make_results(1.0, 1000)
+        self.assertEqual(compare_results(make_results(1.05, 1050), baseline), [])
+        regressions = compare_results(make_results(1.2, 1200), baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(compare_results(make_results(1.2, 1000), baseline, threshold=25), [])
+        with self.assertRaisesRegex(Exception, "different configuration"):
+            compare_results(make_results(1.0, 1000, engine="mmap"), baseline)
+
+
+class EquivalenceTest(unittest.TestCase):
+
+    def test_check_all(self):
+        candidates = [Candidate("single-pass", {"engine": "single-pass"}),
+                      Candidate("streaming", {"streaming": True})]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cases = get_test_data_cases()[2:3] + make_random_cases(temp_dir, 2, seed=1)
+            checker = EquivalenceChecker(temp_dir)
+            self.assertEqual(checker.check_all(cases, candidates), [])
+            # A candidate that raises is a divergence.
+            bad_candidate = Candidate("bad", {"engine": "single-pass", "layout": "20,1,1,1,1"})
+            (divergence, ) = checker.check_all(cases[:1], [bad_candidate])
+            self.assertEqual(divergence[:2], ("dupe_contest_id", "bad"))
+
+    def test_compare_results(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        meta, areas_info, expected = digest_input_files(precincts_path, export_path)
+        meta, areas_info, actual = digest_input_files(precincts_path, export_path)
+        self.assertIsNone(compare_attrs("results", expected, actual, RESULTS_ATTRS))
+        contest_id = (120, "State Treasurer")
+        contest_results = actual.contests[contest_id]
+        i = contest_results.get_offset(1108, REPORTING_INDEX_VBM) + 1
+        contest_results.totals[i] += 1
+        self.assertEqual(compare_attrs("results", expected, actual, RESULTS_ATTRS),
+                         "results.contests[%r].totals: precinct 1108, reporting index %d, "
+                         "choice %d: expected %d, got %d" %
+                         (contest_id, REPORTING_INDEX_VBM, contest_results.choice_ids[1],
+                          contest_results.totals[i] - 1, contest_results.totals[i]))
+
+    def test_compare_texts(self):
+        expected = "Title\n\n*** Contest (1)\nheader\na\t1\nb\t2\n"
+        self.assertIsNone(compare_texts("TSV", expected, expected))
+        self.assertEqual(compare_texts("TSV", expected, expected.replace("b\t2", "b\t3")),
+                         "TSV: line 6 differs, in contest: Contest (1):\n"
+                         "    *** Contest (1)\n    header\n    a\t1\n  - b\t2\n  + b\t3")
+        self.assertEqual(compare_texts("TSV", expected, expected[:-5]).splitlines()[-1],
+                         "  + <end of file>")
+
+
+class SelectionTest(unittest.TestCase):
+
+    def test_line_filter(self):
+        selection = make_selection(contests=["120", "State Treasurer"], precincts=["1108"])
+        accept_line = selection.make_line_filter(LAYOUT_SIMPLE)
+        line = "0120002110800012" + " " * 10 + "State Treasurer".ljust(56)
+        self.assertTrue(accept_line(line))
+        # A registered voter line of the selected precinct.
+        self.assertTrue(accept_line("0001001110800827" + " " * 10))
+        self.assertFalse(accept_line(line.replace("1108", "1127", 1)))
+        # A different contest number but a selected contest name.
+        self.assertTrue(accept_line(line.replace("0120", "0121", 1)))
+        other_line = line.replace("0120", "0121", 1).replace("Treasurer", "Senator")
+        self.assertFalse(accept_line(other_line))
+        accept_bytes = selection.make_line_filter(LAYOUT_SIMPLE, encoding="utf-8")
+        self.assertTrue(accept_bytes(line.encode("utf-8")))
+        self.assertFalse(accept_bytes(line.replace("1108", "1127", 1).encode("utf-8")))
+
+    def test_make_selection(self):
+        self.assertIsNone(make_selection())
+        selection = make_selection(contests=["145,120", "US Senator"], precincts=["1108,1127"],
+                                   districts=["supervisorial:3", "Neighborhood:BAYVW/HTRSPT"],
+                                   areas_info=AreasInfo)
+        self.assertEqual(selection.contest_numbers, (120, 145))
+        self.assertEqual(selection.contest_names, ("US Senator", ))
+        self.assertEqual(selection.districts,
+                         (("Neighborhood", "BAYVW/HTRSPT"), ("Supervisorial", 3)))
+        with self.assertRaisesRegex(Exception, "TYPE:ID"):
+            make_selection(districts=["Ward:3"], areas_info=AreasInfo)
+
+    def test_engines(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        _, full_areas_info, full_results = digest_input_files(precincts_path, export_path)
+        precinct_ids = sorted(full_areas_info.supervisor[3])
+        selection = make_selection(contests=["120"], districts=["Supervisorial:3"],
+                                   areas_info=AreasInfo)
+        (contest_id, ) = [contest_id for contest_id in full_results.contests
+                          if contest_id[0] == 120]
+        for engine in ENGINES:
+            if engine not in SELECTING_ENGINES:
+                with self.assertRaisesRegex(Exception, "does not support selecting"):
+                    digest_input_files(precincts_path, export_path, engine=engine,
+                                       selection=selection)
+                continue
+            with self.subTest(engine=engine):
+                meta, areas_info, results = digest_input_files(
+                    precincts_path, export_path, engine=engine, selection=selection)
+                self.assertEqual(sorted(areas_info.city), precinct_ids)
+                self.assertEqual(list(areas_info.supervisor), [3])
+                self.assertEqual(list(meta.contests), [contest_id])
+                self.assertEqual(sorted(results.registered), precinct_ids)
+                contest_results = results.contests[contest_id]
+                full_contest_results = full_results.contests[contest_id]
+                for precinct_id in contest_results.precinct_ids:
+                    self.assertIn(precinct_id, precinct_ids)
+                    self.assertEqual(
+                        list(contest_results.get_totals(precinct_id, REPORTING_INDEX_VBM)),
+                        list(full_contest_results.get_totals(precinct_id, REPORTING_INDEX_VBM)))
+
+    def test_convert(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        now = datetime(2014, 9, 22, 22, 30, 13)
+        selection = make_selection(contests=["120"])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_base = str(Path(temp_dir) / "output")
+            tsv_path, excel_path = convert("Test Election (Complete Data)", precincts_path,
+                                           export_path, output_base, now=now,
+                                           selection=selection)
+            with open(tsv_path, encoding="utf-8") as f:
+                actual = f.read()
+        with open(expected_path, encoding="utf-8") as f:
+            expected = f.read()
+        # The TSV file has only the selected contest, as in the full file.
+        headers = [line for line in actual.splitlines() if line.startswith("***")]
+        self.assertEqual(headers, ["*** State Treasurer - CALIFORNIA (120)"])
+        contest_text = actual[actual.index(headers[0]):]
+        start = expected.index(headers[0])
+        self.assertEqual(contest_text, expected[start:start + len(contest_text)])
+        self.assertTrue(expected[start + len(contest_text):].startswith("\n\n***"))
+
+
+class SQLiteWriterTest(unittest.TestCase):
+
+    def test_area_totals(self):
+        precincts_path, export_path, expected_path = get_test_paths("complete")
+        election_meta, areas_info, results = digest_input_files(precincts_path, export_path)
+        info = ElectionInfo(areas_info, election_meta, "Test Election", results)
+        aggregates = aggregate_results(info)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = str(Path(temp_dir) / "temp.sqlite")
+            SQLiteWriter(path).write(info)
+            connection = sqlite3.connect(path)
+            try:
+                for contest_key, contest_id in enumerate(sorted(election_meta.contests), start=1):
+                    contest_aggregates = aggregates.contests[contest_id]
+                    rows = connection.execute(
+                        "SELECT areas.area_type, areas.area_id, votes.choice_id, "
+                        "SUM(votes.votes) FROM votes "
+                        "JOIN area_precincts USING (precinct_id) JOIN areas USING (area_key) "
+                        "WHERE votes.contest_key = ? AND areas.area_type = 'Supervisorial' "
+                        "AND votes.reporting_type = 'VBM' "
+                        "GROUP BY areas.area_key, votes.choice_id", (contest_key, ))
+                    for area_type_name, area_id, choice_id, total in rows:
+                        totals = contest_aggregates.get_totals(area_type_name, int(area_id),
+                                                               (REPORTING_INDEX_VBM, ))
+                        i = contest_aggregates.choice_ids.index(choice_id)
+                        self.assertEqual(total, totals.choice_totals[i])
+            finally:
+                connection.close()
+
+
 class EndToEndTest(unittest.TestCase):
 
     def assert_files_equal(self, actual_file, expected_file):
@@ -66,13 +918,27 @@ class EndToEndTest(unittest.TestCase):
 
     def check_end_to_end(self, label, name):
         now = datetime(2014, 9, 22, 22, 30, 13)
-        actual_path, expected_path = parse_test_file(label, name, now=now)
         def read(path):
             return open(path, "r", encoding="utf-8")
 
-        with read(actual_path) as actual_file, \
-              read(expected_path) as expected_file:
-            self.assert_files_equal(actual_file, expected_file)
+        # Also check rendering the contests in worker processes.
+        options_list = [dict(engine=engine) for engine in ENGINES] + [dict(jobs=2)]
+        for options in options_list:
+            with self.subTest(**options):
+                actual_path, expected_path = parse_test_file(label, name, now=now, **options)
+                with read(actual_path) as actual_file, \
+                      read(expected_path) as expected_file:
+                    self.assert_files_equal(actual_file, expected_file)
+
+    def test_write_results_files__error(self):
+        precincts_path, export_path, expected_path = get_test_paths("simple")
+        election_meta, areas_info, results = digest_input_files(precincts_path, export_path)
+        info = ElectionInfo(areas_info, election_meta, "Test Election", results)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bad_path = str(Path(temp_dir) / "missing" / "temp.tsv")
+            writers = [TSVWriter(path=bad_path), ExcelWriter(path=str(Path(temp_dir) / "t.xlsx"))]
+            with self.assertRaisesRegex(Exception, "while writing output file: TSV"):
+                write_results_files(info, writers)
 
     def test_end_to_end__simple(self):
         self.check_end_to_end("simple", "Test Election")
@@ -0,0 +1,193 @@
+"""
+Supports parsing export files without validating every line.
+
+By default, the parsers validate every line of an export file against
+the lines before it (e.g. that a choice ID always has the same name and
+contest, and that no total occurs twice).  For an export file that is
+already known to be valid (e.g. a re-run of the same file, or a
+certified feed), a TrustOptions object tells the parser to skip the
+per-line validation.  Only a sample of the lines, if any, is then
+validated in full, and aggregate checks are run once parsing is done.
+A TrustReport object records what was and was not validated.
+
+"""
+
+from collections import namedtuple, OrderedDict
+import logging
+import math
+import random
+import sys
+
+from pywineds.utils import prettify
+
+
+# The default seed for choosing a random sample of lines, so that runs
+# on the same file validate the same lines.
+DEFAULT_SAMPLE_SEED = 0
+
+# The line number used to mean that no further lines are validated.
+NO_LINE_NO = sys.maxsize
+
+_log = logging.getLogger("wineds")
+
+
+class TrustOptions(namedtuple('TrustOptions', ['every', 'fraction', 'seed'])):
+
+    """
+    Describes which lines of a trusted export file to validate in full.
+
+    Attributes:
+
+      every: validate every line whose line number is a multiple of this
+        integer, or None.
+      fraction: validate each line with this probability, or None.
+      seed: the seed for choosing the random sample.
+
+    At most one of every and fraction may be given.  If neither is,
+    no lines are validated in full.
+
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, every=None, fraction=None, seed=None):
+        if every is not None and fraction is not None:
+            raise Exception("only one of every and fraction may be given")
+        if every is not None and every < 1:
+            raise Exception("every should be a positive integer: %r" % every)
+        if fraction is not None and not 0 < fraction <= 1:
+            raise Exception("fraction should be greater than 0 and at most 1: %r" % fraction)
+        if seed is None:
+            seed = DEFAULT_SAMPLE_SEED
+        return super().__new__(cls, every, fraction, seed)
+
+    def describe(self):
+        if self.every is not None:
+            return "every %d lines" % self.every
+        if self.fraction is not None:
+            return "a random %g of lines (seed %d)" % (self.fraction, self.seed)
+        return "none"
+
+    def iter_sampled_line_nos(self, first_line_no=1):
+        """
+        Yield in increasing order the line numbers of the lines to
+        validate, starting from first_line_no.
+
+        The line numbers are relative to the whole file, so that a file
+        parsed in chunks is sampled as if it were parsed in one pass.
+
+        """
+        if self.every is not None:
+            line_no = -(-first_line_no // self.every) * self.every
+            while True:
+                yield line_no
+                line_no += self.every
+        if self.fraction is None:
+            return
+        if self.fraction == 1:
+            yield from range(first_line_no, NO_LINE_NO)
+            return
+        # Seed from the first line number so that the chunks of a file
+        # parsed in parallel are sampled independently.
+        rng = random.Random("%d:%d" % (self.seed, first_line_no))
+        log_q = math.log(1 - self.fraction)
+        line_no = first_line_no - 1
+        while True:
+            # The gap between sampled lines has a geometric distribution.
+            line_no += int(math.log(1 - rng.random()) / log_q) + 1
+            yield line_no
+
+
+class TrustReport(object):
+
+    """
+    Records what was validated when parsing a trusted export file.
+
+    Attributes:
+
+      line_count: the number of lines parsed.
+      validated_count: the number of lines validated in full.
+      registered_count: the number of "REGISTERED VOTERS - TOTAL" lines.
+      voted_count: the number of "BALLOTS CAST - TOTAL" lines.
+
+    """
+
+    def __init__(self, options):
+        self.options = options
+
+        self.line_count = 0
+        self.registered_count = 0
+        self.validated_count = 0
+        self.voted_count = 0
+
+    def merge(self, other):
+        """
+        Add the counts of the report of another part of the file.
+
+        """
+        self.line_count += other.line_count
+        self.registered_count += other.registered_count
+        self.validated_count += other.validated_count
+        self.voted_count += other.voted_count
+
+    def check(self, election_meta, results):
+        """
+        Run the aggregate checks, and return a list of their
+        descriptions.  An exception is raised if a check fails.
+
+        """
+        checks = []
+
+        precinct_count = len(election_meta.precincts)
+        registered_count = len(results.registered)
+        try:
+            assert registered_count == precinct_count
+        except AssertionError:
+            raise Exception("%d precincts but %d registered voter totals" %
+                            (precinct_count, registered_count))
+        checks.append("every precinct has one registered voter total")
+
+        # The totals of the unvalidated lines are stored without checking
+        # for duplicates, so a duplicate shows up as fewer stored totals
+        # than lines.
+        voted_count = sum(len(totals) for totals in results.voted.values())
+        for desc, line_count, total_count in (
+                ("registered voter", self.registered_count, registered_count),
+                ("ballots cast", self.voted_count, voted_count)):
+            try:
+                assert total_count == line_count
+            except AssertionError:
+                raise Exception("%d %s lines but %d distinct totals" %
+                                (line_count, desc, total_count))
+        checks.append("no duplicate registered voter or ballots cast totals")
+
+        return checks
+
+    def make_summary(self, checks):
+        return OrderedDict([
+            ("lines", self.line_count),
+            ("lines validated in full", self.validated_count),
+            ("sample", self.options.describe()),
+            ("aggregate checks passed", checks),
+            ("always checked", [
+                "the data chunk of each line has the expected form",
+                "no duplicate contest vote totals",
+                "the precincts match the precinct file",
+            ]),
+            ("not checked for the other lines", [
+                "a precinct ID always has the same precinct name",
+                "a choice ID always has the same contest and choice name",
+                "a contest always has the same district name",
+                "the names of the registered voter and ballots cast lines",
+                "party codes and names",
+            ]),
+        ])
+
+    def log(self, election_meta, results):
+        """
+        Run the aggregate checks, and log the summary.
+
+        """
+        summary = self.make_summary(self.check(election_meta, results))
+        _log.info("trusted input validation report:\n%s" % prettify(summary))
+        return summary
@@ -8,8 +8,16 @@ from collections import OrderedDict
 from contextlib import contextmanager
 import json
 import logging
+import sys
+import time
 import timeit
 
+try:
+    import resource
+except ImportError:
+    # Then the platform is not Unix, and peak memory is not measured.
+    resource = None
+
 
 REPORTING_INDEX_ALL = 0
 REPORTING_INDEX_ELD = 1
@@ -51,6 +59,14 @@ def get_reporting_index(reporting_field):
     return reporting_index
 
 
+def get_reporting_indices(has_reporting_type):
+    """
+    Return the reporting-type indices used to subdivide the vote totals.
+
+    """
+    return REPORTING_INDICES_COMPLETE if has_reporting_type else REPORTING_INDICES_SIMPLE
+
+
 def prettify(obj):
     return json.dumps(obj, indent=4)
 
@@ -90,17 +106,193 @@ def add_to_dict(mapping, key, value, desc=None):
     return False
 
 
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, or None
+    if it cannot be measured.
+
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The value is in kilobytes, except on macOS.
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class PhaseMetrics(object):
+
+    """
+    The metrics of a phase of a run (e.g. parsing a file).
+
+    Attributes:
+
+      name: the task description passed to time_it().
+      depth: the number of phases enclosing the phase.
+      wall_seconds: the elapsed wall-clock time.
+      cpu_seconds: the CPU time used by this process.
+      lines: the number of lines processed, or None.  This is set by
+        the code being timed.
+      bytes: the number of bytes processed (read or written), or None.
+        This is set by the code being timed.
+      peak_rss_delta: the number of bytes by which the peak resident set
+        size of this process grew during the phase, or None if it cannot
+        be measured.
+
+    """
+
+    def __init__(self, name, depth=0):
+        self.name = name
+        self.depth = depth
+
+        self.bytes = None
+        self.cpu_seconds = None
+        self.lines = None
+        self.peak_rss_delta = None
+        self.wall_seconds = None
+
+    @property
+    def lines_per_second(self):
+        if self.lines is None or not self.wall_seconds:
+            return None
+        return self.lines / self.wall_seconds
+
+    def to_dict(self):
+        return OrderedDict([
+            ("name", self.name),
+            ("depth", self.depth),
+            ("wall_seconds", self.wall_seconds),
+            ("cpu_seconds", self.cpu_seconds),
+            ("lines", self.lines),
+            ("bytes", self.bytes),
+            ("lines_per_second", self.lines_per_second),
+            ("peak_rss_delta", self.peak_rss_delta),
+        ])
+
+
+class MetricsRecorder(object):
+
+    """
+    Records a PhaseMetrics object for each phase timed by time_it().
+
+    Attributes:
+
+      phases: a list of the PhaseMetrics objects, in the order in which
+        the phases began.
+
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.phases = []
+
+    def begin_phase(self, phase):
+        """
+        Called by time_it() after a phase begins.
+
+        """
+        pass
+
+    def end_phase(self, phase):
+        """
+        Called by time_it() after a phase ends and its metrics are set.
+
+        """
+        pass
+
+    def to_dict(self):
+        return OrderedDict([("phases", [phase.to_dict() for phase in self.phases])])
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+            f.write("\n")
+
+
+# The MetricsRecorder object of the current run, or None if metrics are
+# not being recorded.
+_recorder = None
+
+
+@contextmanager
+def record_metrics(recorder=None):
+    """
+    A context manager for recording the metrics of the phases timed by
+    time_it(), yielding a MetricsRecorder object.
+
+    """
+    global _recorder
+    if recorder is None:
+        recorder = MetricsRecorder()
+    previous = _recorder
+    _recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+
+
+def call_recording_metrics(func, *args):
+    """
+    Call a function while recording metrics, and return a 2-tuple of:
+    the return value, and the list of PhaseMetrics objects recorded.
+
+    This is a module-level function so that it can be run in a worker
+    process, whose phases would otherwise not be recorded.
+
+    """
+    with record_metrics() as recorder:
+        value = func(*args)
+    return value, recorder.phases
+
+
+def add_phases(phases):
+    """
+    Add PhaseMetrics objects recorded elsewhere (e.g. in a worker
+    process) to the current run, if metrics are being recorded.
+
+    """
+    recorder = _recorder
+    if recorder is None:
+        return
+    for phase in phases:
+        phase.depth += recorder.depth
+        recorder.phases.append(phase)
+
+
 @contextmanager
 def time_it(task_desc):
     """
     A context manager for timing chunks of code and logging it.
 
+    This yields a PhaseMetrics object, on which the code being timed can
+    set the number of lines and bytes processed.  If metrics are being
+    recorded (see record_metrics()), the object is also recorded.
+
     Arguments:
       task_desc: task description for logging purposes
 
     """
+    recorder = _recorder
+    phase = PhaseMetrics(task_desc)
+    if recorder is not None:
+        phase.depth = recorder.depth
+        recorder.phases.append(phase)
+        recorder.depth += 1
+        recorder.begin_phase(phase)
+    start_rss = get_peak_rss()
+    start_cpu = time.process_time()
     start_time = timeit.default_timer()
     _log.info("begin: %s..." % task_desc)
-    yield
+    try:
+        yield phase
+    finally:
+        if recorder is not None:
+            recorder.depth -= 1
     elapsed = timeit.default_timer() - start_time
+    phase.wall_seconds = elapsed
+    phase.cpu_seconds = time.process_time() - start_cpu
+    if start_rss is not None:
+        phase.peak_rss_delta = get_peak_rss() - start_rss
+    if recorder is not None:
+        recorder.end_phase(phase)
     _log.info("elapsed (%s): %.4f seconds" % (task_desc, elapsed))
@@ -0,0 +1,490 @@
+"""
+Supports parsing WinEDS export files with NumPy.
+
+Since the lines of an export file have a fixed width, the file can be
+viewed as a 2-D array of bytes with one row per line.  The parser in
+this module decodes the numeric columns of all lines at once using
+column arithmetic, and it factorizes the name columns with np.unique()
+so that each distinct value is decoded and validated only once.
+
+This module requires NumPy, which is an optional dependency.
+
+"""
+
+from array import array
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    raise Exception("NumPy does not seem to be installed. "
+                    "It is required for the \"numpy\" export engine "
+                    "(see the \"numpy\" extra in setup.py).")
+
+from pywineds.main import (check_precincts, finish_election_meta, init_contests_results,
+                           log_contests, make_contest_id, parse_export_single_pass, DataField,
+                           ElectionMeta, ElectionMetaParser, ElectionResults, Fields,
+                           FILE_ENCODING)
+from pywineds.layouts import FIELD_NAMES
+from pywineds.utils import get_reporting_index, get_reporting_indices, time_it
+
+
+# The byte values of the characters "0" and "\n".
+ZERO_BYTE = ord("0")
+NEWLINE_BYTE = ord("\n")
+
+# An odd 64-bit multiplier for hashing rows of bytes.
+HASH_MULTIPLIER = np.uint64(0x100000001b3)
+
+# The data chunk for a vote total of -1.
+NEGATIVE_ONE = np.frombuffer(b"000-1", dtype=np.uint8)
+
+_log = logging.getLogger("wineds")
+
+
+def to_integers(digits):
+    """
+    Return the integers represented by the rows of a 2-D array of digits.
+
+    """
+    powers = 10 ** np.arange(digits.shape[1] - 1, -1, -1, dtype=np.int64)
+    return digits.astype(np.int64) @ powers
+
+
+def combine_columns(columns):
+    """
+    Combine a sequence of equal-length arrays of non-negative integers
+    into a single array of integers identifying each row.
+
+    """
+    dims = tuple(int(column.max()) + 1 if len(column) else 1 for column in columns)
+    return np.ravel_multi_index(columns, dims)
+
+
+def hash_rows(rows):
+    """
+    Return an array of 64-bit hashes of the rows of a 2-D byte array.
+
+    """
+    row_count, width = rows.shape
+    padded = np.zeros((row_count, -(-width // 8) * 8), dtype=np.uint8)
+    padded[:, :width] = rows
+    words = padded.view(np.uint64)
+    hashes = np.zeros(row_count, dtype=np.uint64)
+    for i in range(words.shape[1]):
+        hashes *= HASH_MULTIPLIER
+        hashes ^= words[:, i]
+    return hashes
+
+
+def find_duplicate(keys):
+    """
+    Return the index of the first element of an array that equals an
+    earlier element, or None if the elements are distinct.
+
+    """
+    first_indices = np.unique(keys, return_index=True)[1]
+    if len(first_indices) == len(keys):
+        return None
+    is_first = np.zeros(len(keys), dtype=bool)
+    is_first[first_indices] = True
+    return np.flatnonzero(~is_first)[0]
+
+
+def iter_first_occurrences(columns):
+    """
+    Return the distinct rows of the 2-D array formed by the given
+    columns, in the order in which they first occur, as an iterable
+    of 2-tuples: (row_index, row).
+
+    """
+    first_indices = np.unique(combine_columns(columns), return_index=True)[1]
+    first_indices.sort()
+    rows = np.stack([column[first_indices] for column in columns], axis=1)
+    return zip(first_indices.tolist(), rows.tolist())
+
+
+class Factorized:
+
+    """
+    Encapsulates a column (or group of adjacent columns) of a line array
+    as a list of distinct decoded values and an array of codes.
+
+    Attributes:
+
+      codes: an array with one integer per line, giving the index into
+        values of the value for that line.
+      first_indices: an array giving, for each value, the index of the
+        first line in which it occurs.
+      values: a list of the distinct values, decoded and (by default)
+        stripped.
+
+    """
+
+    def __init__(self, columns, strip=True):
+        # Sorting the hashes is much faster than sorting the rows
+        # themselves (e.g. with np.unique(axis=0)).
+        hashes = hash_rows(columns)
+        first_indices, codes = np.unique(hashes, return_index=True, return_inverse=True)[1:]
+        codes = codes.reshape(-1)
+        uniques = columns[first_indices]
+        if not (uniques[codes] == columns).all():
+            # Then there was a hash collision.
+            uniques, first_indices, codes = np.unique(columns, axis=0, return_index=True,
+                                                      return_inverse=True)
+            codes = codes.reshape(-1)
+        values = [bytes(row).decode(FILE_ENCODING) for row in uniques]
+        if strip:
+            values = [value.strip() for value in values]
+        self.codes = codes
+        self.first_indices = first_indices
+        self.values = values
+
+
+class VectorizedParser:
+
+    """
+    Parses a WinEDS export file viewed as a 2-D array of bytes.
+
+    The parser performs the same validation as SinglePassParser.  It
+    does this by validating each distinct combination of values once
+    (in the order in which the combinations first occur in the file),
+    and by checking for duplicate totals with array operations.
+
+    """
+
+    name = "Results File (vectorized)"
+
+    def __init__(self, info, results, layout=None):
+        """
+        Arguments:
+          info: an ElectionMeta object.
+          results: an ElectionResults object.
+          layout: the LineLayout object of the file, or None to detect it.
+
+        """
+        self.election_info = info
+        self.results = results
+        self.meta_parser = ElectionMetaParser(info, layout=layout)
+        self.lines = None
+
+    def get_line(self, index):
+        return bytes(self.lines[index]).decode(FILE_ENCODING)
+
+    def log_line(self, msg, index):
+        return '%s:\n>>> [L%d]:"%s"' % (msg, index + 1, self.get_line(index).strip())
+
+    def line_error(self, index):
+        return Exception("error while parsing line %d: %r" % (index + 1, self.get_line(index)))
+
+    def load(self, path):
+        """
+        Load the file as a line array, and return a string describing why
+        the file cannot be parsed by this class, or None if it can.
+
+        """
+        with open(path, "rb") as f:
+            first_line = f.readline()
+        has_reporting_type = self.meta_parser.detect_format(first_line.decode(FILE_ENCODING))
+        reporting_indices = get_reporting_indices(has_reporting_type)
+        self.results.reporting_indices = reporting_indices
+
+        layout = self.meta_parser.layout
+        # The offsets of the columns, as in LineLayout.make_splitter().
+        self.bounds = {name: layout.get_bounds(name) for name in FIELD_NAMES}
+
+        line_length = len(first_line)
+        self.width = len(first_line.rstrip(b"\r\n"))
+        if self.width < self.bounds["district_name"][1]:
+            return "the lines are shorter than the line layout"
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(data) % line_length:
+            return "the lines do not all have the same length"
+        lines = data.reshape(-1, line_length)
+        if not (lines[:, -1] == NEWLINE_BYTE).all():
+            return "the lines do not all have the same length"
+        if (lines >= 128).any():
+            return "the file contains non-ASCII characters"
+        self.lines = lines
+
+        return None
+
+    def decode_data(self):
+        """
+        Decode the numeric columns of the initial data chunk, and return
+        the index of the first line that does not have the expected form,
+        or None if all lines do.
+
+        """
+        lines = self.lines
+        digits = lines[:, 1:16].astype(np.int16) - ZERO_BYTE
+        is_digit = (digits >= 0) & (digits <= 9)
+        is_negative = (lines[:, 11:16] == NEGATIVE_ONE).all(axis=1)
+        is_valid = ((lines[:, 0] == ZERO_BYTE) & is_digit[:, :10].all(axis=1) &
+                    (is_digit[:, 10:].all(axis=1) | is_negative))
+        if not is_valid.all():
+            return np.flatnonzero(~is_valid)[0]
+
+        self.contest_numbers = to_integers(digits[:, 0:3])
+        self.choice_ids = to_integers(digits[:, 3:6])
+        self.precinct_ids = to_integers(digits[:, 6:10])
+        self.vote_totals = np.where(is_negative, -1, to_integers(digits[:, 10:15].clip(0)))
+
+        return None
+
+    def get_columns(self, field_name):
+        start, end = self.bounds[field_name]
+        return self.lines[:, start:end]
+
+    def split_tail(self, tail):
+        """
+        Split the value of a tail (see factorize_names()) into a 2-tuple
+        of: district_name, reporting_type.
+
+        """
+        start, end = self.bounds["district_name"]
+        i = end - start
+        return tail[:i].strip(), tail[i:].strip()
+
+    def factorize_names(self):
+        lines = self.lines
+        self.parties = Factorized(lines[:, 16:self.bounds["data_field"][1]])
+        # We factorize the contest name together with the contest number
+        # since together they make up the contest ID.
+        self.contests = Factorized(np.concatenate((lines[:, 1:4],
+                                                   self.get_columns("contest_name")), axis=1))
+        self.choice_names = Factorized(self.get_columns("choice_name"))
+        self.precinct_names = Factorized(self.get_columns("precinct_name"))
+        # This includes the district name and reporting type.  We don't
+        # strip the values so that we can split them later.
+        tail_start = self.bounds["district_name"][0]
+        self.tails = Factorized(lines[:, tail_start:self.width], strip=False)
+
+    def make_line_fields(self, index):
+        """
+        Return a 2-tuple of (Fields, DataField) objects for a line.
+
+        """
+        party_code = self.parties.values[self.parties.codes[index]]
+        contest_name = self.contests.values[self.contests.codes[index]][3:].strip()
+        choice_name = self.choice_names.values[self.choice_names.codes[index]]
+        precinct_name = self.precinct_names.values[self.precinct_names.codes[index]]
+        tail = self.tails.values[self.tails.codes[index]]
+        district_name, reporting_type = self.split_tail(tail)
+
+        data = DataField(int(self.choice_ids[index]), int(self.contest_numbers[index]),
+                         int(self.precinct_ids[index]), int(self.vote_totals[index]), party_code)
+        fields = Fields("", contest_name, choice_name, precinct_name, district_name,
+                        reporting_type)
+        return fields, data
+
+    def parse_meta(self):
+        """
+        Validate and store the election metadata.
+
+        """
+        meta_parser = self.meta_parser
+        precinct_names = self.precinct_names.values
+
+        # Each event is a 3-tuple of (line index, function, args).
+        events = []
+        columns = (self.precinct_ids, self.precinct_names.codes)
+        for index, (precinct_id, name_code) in iter_first_occurrences(columns):
+            events.append((index, meta_parser.add_precinct,
+                           (precinct_id, precinct_names[name_code])))
+
+        columns = (self.contests.codes, self.choice_ids, self.parties.codes,
+                   self.choice_names.codes, self.tails.codes)
+        for index, key in iter_first_occurrences(columns):
+            events.append((index, meta_parser.process_meta, self.make_line_fields(index)))
+
+        for index, func, args in sorted(events, key=lambda event: event[0]):
+            try:
+                func(*args)
+            except:
+                raise self.line_error(index)
+
+        # Look up the ContestInfo object for each contest code.  The value
+        # is None for the lines that do not correspond to a contest.
+        contests = self.election_info.contests
+        self.contest_ids = []
+        for key in self.contests.values:
+            contest_id = make_contest_id(int(key[:3]), key[3:].strip())
+            self.contest_ids.append(contest_id if contest_id in contests else None)
+
+        # Add the precincts of each contest.
+        has_district = np.array([bool(self.split_tail(tail)[0]) for tail in self.tails.values])
+        line_indices = np.flatnonzero(has_district[self.tails.codes])
+        columns = (self.contests.codes[line_indices], self.precinct_ids[line_indices])
+        for index, (contest_code, precinct_id) in iter_first_occurrences(columns):
+            contests[self.contest_ids[contest_code]].precinct_ids.add(precinct_id)
+
+    def check_duplicates(self, line_indices, columns, key_values):
+        """
+        Raise an exception if two lines have the same key.
+
+        Arguments:
+          line_indices: the indices of the lines being checked.
+          columns: the columns making up the key of each line.
+          key_values: the values to display for the key of each line.
+
+        """
+        index = find_duplicate(combine_columns(columns))
+        if index is None:
+            return
+        try:
+            raise Exception("total for key=%d was already stored" % (key_values[index], ))
+        except:
+            raise self.line_error(line_indices[index])
+
+    def parse_totals(self):
+        """
+        Store the vote totals.
+
+        """
+        results = self.results
+        r_values = []
+        for index, tail in zip(self.tails.first_indices, self.tails.values):
+            try:
+                r_values.append(get_reporting_index(self.split_tail(tail)[1]))
+            except:
+                raise self.line_error(index)
+        r_indices = np.array(r_values, dtype=np.int64)[self.tails.codes]
+
+        contest_numbers = self.contest_numbers
+        precinct_ids = self.precinct_ids
+        vote_totals = self.vote_totals
+
+        for index in np.flatnonzero(vote_totals < 0).tolist():
+            text = self.log_line("negative ballot total %d: choice_id=%d, "
+                                 "contest_number=%d, precinct_id=%d" %
+                                 (vote_totals[index], self.choice_ids[index],
+                                  contest_numbers[index], precinct_ids[index]), index)
+            _log.warning(text)
+
+        has_party = np.array([bool(code) for code in self.parties.values])[self.parties.codes]
+
+        # Registered voters.
+        line_indices = np.flatnonzero((contest_numbers == 1) & ~has_party)
+        line_precincts = precinct_ids[line_indices]
+        self.check_duplicates(line_indices, (line_precincts, ), line_precincts)
+        results.registered.update(zip(line_precincts.tolist(), vote_totals[line_indices].tolist()))
+
+        # Ballots cast.
+        voted = results.voted
+        for precinct_id in self.election_info.precincts:
+            voted[precinct_id] = {}
+        line_indices = np.flatnonzero((contest_numbers == 2) & ~has_party)
+        line_precincts = precinct_ids[line_indices]
+        line_r_indices = r_indices[line_indices]
+        self.check_duplicates(line_indices, (line_precincts, line_r_indices), line_r_indices)
+        for precinct_id, r_index, total in zip(line_precincts.tolist(), line_r_indices.tolist(),
+                                               vote_totals[line_indices].tolist()):
+            voted[precinct_id][r_index] = total
+
+        # Contest vote totals.
+        line_indices = np.flatnonzero((contest_numbers != 1) & (contest_numbers != 2))
+        line_contests = self.contests.codes[line_indices]
+        line_precincts = precinct_ids[line_indices]
+        line_r_indices = r_indices[line_indices]
+        line_choices = self.choice_ids[line_indices]
+        self.check_duplicates(line_indices,
+                              (line_contests, line_precincts, line_r_indices, line_choices),
+                              line_choices)
+
+        # The contest totals are stored after finish_election_meta() is
+        # called, since that is when the contest choices are final.
+        self.contest_totals = (line_contests, line_precincts, line_r_indices, line_choices,
+                               vote_totals[line_indices])
+
+    def make_contests_results(self):
+        """
+        Construct a ContestResults object for each contest, and store the
+        contest vote totals in its array.
+
+        """
+        with time_it("storing contest vote totals"):
+            self.store_contest_totals()
+        self.contest_totals = None
+
+    def store_contest_totals(self):
+        results = self.results
+        init_contests_results(self.election_info, results)
+
+        line_contests, line_precincts, line_r_indices, line_choices, line_totals = \
+            self.contest_totals
+        positions = np.zeros(max(results.reporting_indices) + 1, dtype=np.int64)
+        positions[list(results.reporting_indices)] = np.arange(len(results.reporting_indices))
+
+        # Group the lines by contest.
+        order = np.argsort(line_contests, kind="stable")
+        codes = line_contests[order]
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            contest_id = self.contest_ids[line_contests[group[0]]]
+            contest_results = results.contests[contest_id]
+            precinct_ids = np.array(contest_results.precinct_ids, dtype=np.int64)
+            choice_ids = np.array(contest_results.choice_ids, dtype=np.int64)
+            rows = (np.searchsorted(precinct_ids, line_precincts[group]) *
+                    len(contest_results.reporting_indices) +
+                    positions[line_r_indices[group]])
+            offsets = rows * contest_results.choice_count + np.searchsorted(
+                choice_ids, line_choices[group])
+
+            totals = np.zeros(contest_results.size, dtype=np.int64)
+            totals[offsets] = line_totals[group]
+            stored = np.zeros(contest_results.size, dtype=np.uint8)
+            stored[offsets] = 1
+            contest_results.totals = array('q', totals.tobytes())
+            contest_results.stored = bytearray(stored.tobytes())
+
+    def parse_path(self, path):
+        """
+        Parse the file at the given path, and return whether the file
+        could be parsed.
+
+        """
+        reason = self.load(path)
+        if reason is None:
+            index = self.decode_data()
+            if index is not None:
+                reason = "line %d has an unexpected data chunk" % (index + 1)
+        if reason is not None:
+            _log.info("cannot parse file with NumPy: %s" % reason)
+            return False
+
+        line_count = len(self.lines)
+        with time_it("parsing {0} ({1} lines)".format(self.name, line_count)) as phase:
+            phase.lines = line_count
+            phase.bytes = os.path.getsize(path)
+            self.factorize_names()
+            self.parse_meta()
+            self.parse_totals()
+
+        return True
+
+
+def parse_export_numpy(areas_info, wineds_path, layout=None):
+    """
+    Parse a WinEDS export file using VectorizedParser.
+
+    If the file does not have the regular form the parser requires,
+    this falls back to parse_export_single_pass().  The return value
+    is the same as for parse_export_single_pass().
+
+    """
+    election_info = ElectionMeta()
+    results = ElectionResults()
+    parser = VectorizedParser(election_info, results, layout=layout)
+    if not parser.parse_path(wineds_path):
+        return parse_export_single_pass(areas_info, wineds_path, layout=layout)
+
+    finish_election_meta(election_info)
+    parser.make_contests_results()
+    check_precincts(areas_info, election_info, wineds_path)
+    log_contests(election_info)
+
+    return election_info, results
@@ -0,0 +1,180 @@
+"""
+Supports converting export files as they are dropped into a directory.
+
+On election night, a new export file is produced after each batch of
+ballots is counted.  Rather than starting a new process for each file,
+a single long-lived process parses the precinct file once and polls the
+drop directory.  Each export file is converted once it is fully written,
+i.e. once its size and modification time are unchanged between two
+polls.  The output files are first written to temporary paths and then
+renamed, so readers never see partially written output files.
+
+"""
+
+import glob
+import logging
+import os
+import time
+
+from pywineds.incremental import RenderState
+from pywineds.utils import time_it
+
+
+# The number of seconds to wait between polls of the drop directory.
+DEFAULT_POLL_INTERVAL = 2
+
+EXPORT_FILE_PATTERN = "*.txt"
+
+# The string to append to the output base to get the base of the
+# temporary output paths.
+PARTIAL_SUFFIX = ".partial"
+
+_log = logging.getLogger("wineds")
+
+
+def publish_outputs(paths, final_paths):
+    """
+    Rename each of the given paths to the corresponding final path.
+
+    Each rename replaces an existing file atomically.
+
+    """
+    for path, final_path in zip(paths, final_paths):
+        os.replace(path, final_path)
+
+
+class ExportWatcher(object):
+
+    """
+    Polls a drop directory for export files that are fully written.
+
+    """
+
+    def __init__(self, drop_dir, pattern=None):
+        if pattern is None:
+            pattern = EXPORT_FILE_PATTERN
+        self.drop_dir = drop_dir
+        self.pattern = pattern
+        # A dict mapping path to the (size, mtime) 2-tuple of the file at
+        # the previous poll.
+        self.last_stats = {}
+        # A set of the (path, size, mtime) 3-tuples already returned.
+        self.seen = set()
+
+    def stat_files(self):
+        stats = {}
+        for path in glob.glob(os.path.join(self.drop_dir, self.pattern)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Then the file was removed after the glob.
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime)
+        return stats
+
+    def poll(self):
+        """
+        Return a list of the paths of the export files that became ready
+        since the previous poll, in order of modification time.
+
+        A file is ready if it is non-empty and its size and modification
+        time are the same as at the previous poll.  A file is returned
+        again if it changes and then becomes ready again.
+
+        """
+        stats = self.stat_files()
+        ready = []
+        for path, stat in stats.items():
+            size, mtime = stat
+            key = (path, size, mtime)
+            if size == 0 or key in self.seen or self.last_stats.get(path) != stat:
+                continue
+            self.seen.add(key)
+            ready.append((mtime, path))
+        self.last_stats = stats
+
+        return [path for mtime, path in sorted(ready)]
+
+
+class WatchConverter(object):
+
+    """
+    Converts export files to the same output files, keeping the parsed
+    precinct file and the rendered contests in memory between files.
+
+    """
+
+    def __init__(self, convert, election_name, precincts_path, output_base, areas_info,
+                 **kwargs):
+        """
+        Arguments:
+          convert: the convert() function.
+          areas_info: the AreasInfo object parsed from precincts_path.
+          kwargs: additional keyword arguments to pass to convert().
+
+        """
+        self.areas_info = areas_info
+        self.convert_function = convert
+        self.election_name = election_name
+        self.kwargs = kwargs
+        self.output_base = output_base
+        self.precincts_path = precincts_path
+        self.render_state = RenderState()
+
+    def convert(self, export_path):
+        """
+        Convert an export file, and return the published output paths.
+
+        """
+        partial_base = self.output_base + PARTIAL_SUFFIX
+        with time_it("converting and publishing: %s" % export_path):
+            paths = self.convert_function(self.election_name, self.precincts_path, export_path,
+                                          partial_base, areas_info=self.areas_info,
+                                          render_state=self.render_state, **self.kwargs)
+            final_paths = [self.output_base + path[len(partial_base):] for path in paths]
+            publish_outputs(paths, final_paths)
+        _log.info("published: %s" % ", ".join(final_paths))
+
+        return final_paths
+
+    def convert_ready(self, watcher):
+        """
+        Convert the most recent export file that became ready, if any, and
+        return the published output paths, or None.
+
+        The older export files that became ready at the same time are
+        skipped since their totals are superseded.
+
+        """
+        paths = watcher.poll()
+        if not paths:
+            return None
+        for path in paths[:-1]:
+            _log.info("skipping superseded export file: %s" % path)
+        export_path = paths[-1]
+        try:
+            return self.convert(export_path)
+        except Exception:
+            # Keep watching so that the next export file can still be
+            # published.  The renders of this file may be incomplete, so
+            # we discard them.
+            _log.exception("error converting export file: %s" % export_path)
+            self.render_state = RenderState()
+            return None
+
+    def watch(self, drop_dir, interval=None):
+        """
+        Poll the drop directory forever.
+
+        """
+        if interval is None:
+            interval = DEFAULT_POLL_INTERVAL
+        watcher = ExportWatcher(drop_dir)
+        # Skip the files already present so that only new exports are
+        # converted.  Files still being written are converted once ready.
+        for path, (size, mtime) in watcher.stat_files().items():
+            watcher.seen.add((path, size, mtime))
+        _log.info("watching for export files: %s" % os.path.join(drop_dir, watcher.pattern))
+        while True:
+            self.convert_ready(watcher)
+            time.sleep(interval)
@@ -16,9 +16,16 @@ setup(
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.9',
     ],
+    python_requires='>=3.9',
     packages=find_packages(),
+    extras_require={
+        # For the "numpy" export engine.
+        'numpy': ['numpy'],
+        # For the --columnar output files.
+        'columnar': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'wineds-convert=pywineds.run:main',